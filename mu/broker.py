@@ -0,0 +1,286 @@
+"""
+Copyright (c) 2015-2016 Nicholas H.Tollervey and others (see the AUTHORS file).
+
+Based upon work done for Puppy IDE by Dan Pope, Nicholas Tollervey and Damien
+George.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import contextlib
+import logging
+import threading
+import time
+from PyQt5.QtCore import QObject, pyqtSignal
+from serial.serialutil import SerialException
+from mu.resources import pyboard
+
+
+logger = logging.getLogger(__name__)
+
+
+#: Seconds each read for a listener waits for data, and so the longest a
+#: lease waits for the listener to let go of the port.
+READ_INTERVAL = 0.05
+
+_brokers = {}
+_brokers_lock = threading.Lock()
+
+
+class PortBusyError(Exception):
+    """
+    Raised when a lease can't be had in time because someone else holds it.
+    """
+
+
+def get_broker(port):
+    """
+    Return the PortBroker for the port, creating it the first time.
+    """
+    with _brokers_lock:
+        broker = _brokers.get(port)
+        if broker is None:
+            broker = _brokers[port] = PortBroker(port)
+        return broker
+
+
+class PortBroker:
+    """
+    Owns the connection to the board on a serial port, and shares it between
+    the REPL, file transfers and running scripts.
+
+    Anything which talks to the board takes a lease, which is exclusive:
+    leases on a port are granted one after another, while each port has its
+    own broker so boards on different ports don't wait for each other. The
+    REPL listens instead, and is passed whatever the board sends while
+    nobody holds a lease. The port is opened when first needed and stays
+    open between leases, so handing it from one user to the next is free.
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self._board = None
+        self._condition = threading.Condition()
+        self._leased = False
+        self._waiting = 0
+        self._reading = False
+        self._listener = None
+        self._reader = None
+        # Written by the listener while the port was leased.
+        self._pending = bytearray()
+
+    def _open(self):
+        """
+        Return the Pyboard connected to the port, connecting if need be.
+        Called with the condition held.
+        """
+        if self._board is None:
+            self._board = pyboard.Pyboard(self.port)
+            # Pyboard only reads what's waiting, so this only bounds the
+            # listener's reads.
+            self._board.serial.timeout = READ_INTERVAL
+        return self._board
+
+    def _drop(self):
+        """
+        Close the connection after an error, so the next user reconnects.
+        Called with the condition held.
+        """
+        board, self._board = self._board, None
+        if board is not None:
+            try:
+                board.close()
+            except (SerialException, OSError):
+                pass
+
+    @contextlib.contextmanager
+    def lease(self, timeout=None):
+        """
+        Wait until the port is free, then return (as a context manager) the
+        pyboard.Pyboard connected to it, which is the caller's alone until
+        the with block ends. If the block fails with a serial error the
+        connection is closed, and the next user reconnects.
+
+        If another lease is still held after timeout seconds, PortBusyError
+        is raised instead; a timeout of 0 only takes the port if it's free,
+        so the user interface can lease without freezing.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            self._waiting += 1
+            try:
+                while self._leased or self._reading:
+                    # The listener only ever holds the port for a read.
+                    if self._leased and deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise PortBusyError(
+                                'The port {} is in use.'.format(self.port))
+                        self._condition.wait(remaining)
+                    else:
+                        self._condition.wait()
+                board = self._open()
+                self._leased = True
+            finally:
+                self._waiting -= 1
+                self._condition.notify_all()
+        try:
+            yield board
+        except (SerialException, OSError):
+            with self._condition:
+                self._drop()
+            raise
+        finally:
+            with self._condition:
+                self._leased = False
+                listener = self._listener
+                # Whatever the board sent after the lease holder stopped
+                # reading, such as a script's output, is the listener's.
+                left_over = board.read_buffered() if listener else b''
+                if self._pending and self._board is board:
+                    self._write(bytes(self._pending))
+                del self._pending[:]
+                self._condition.notify_all()
+            if left_over:
+                listener(left_over)
+
+    def listen(self, listener):
+        """
+        Pass whatever the board sends while the port isn't leased to
+        listener, which is called from another thread. The port is opened
+        now, so this raises if it can't be.
+        """
+        with self._condition:
+            self._open()
+            self._listener = listener
+            if self._reader is None:
+                self._reader = threading.Thread(target=self._read_loop,
+                                                daemon=True)
+                self._reader.start()
+
+    def unlisten(self):
+        """
+        Stop passing data to the listener.
+        """
+        with self._condition:
+            self._listener = None
+            self._condition.notify_all()
+
+    def write(self, data):
+        """
+        Send the listener's data to the board, or once the current lease
+        ends if the port is leased.
+        """
+        with self._condition:
+            if self._leased or self._waiting or self._board is None:
+                self._pending.extend(data)
+            else:
+                self._write(data)
+
+    def _write(self, data):
+        """
+        Write to the board, which the listener can't do anything about
+        failing. Called with the condition held.
+        """
+        try:
+            self._board.serial.write(data)
+        except (SerialException, OSError) as ex:
+            logger.error(ex)
+
+    def _read_loop(self):
+        """
+        Read from the board for the listener whenever the port isn't leased,
+        until there's no listener or the connection fails.
+        """
+        while True:
+            with self._condition:
+                while self._listener and (self._leased or self._waiting):
+                    self._condition.wait()
+                if self._listener is None or self._board is None:
+                    self._reader = None
+                    return
+                serial = self._board.serial
+                self._reading = True
+            data = b''
+            try:
+                data = serial.read(max(1, serial.inWaiting()))
+            except (SerialException, OSError) as ex:
+                logger.error(ex)
+                with self._condition:
+                    self._drop()
+            finally:
+                with self._condition:
+                    self._reading = False
+                    listener = self._listener
+                    self._condition.notify_all()
+            if data and listener:
+                listener(data)
+
+
+class SharedPort(QObject):
+    """
+    Stands in for a QSerialPort, reading and writing through the port's
+    PortBroker so the REPL shares the connection to the board rather than
+    opening one of its own.
+    """
+
+    #: Emitted when there is data to read with readAll.
+    readyRead = pyqtSignal()
+    # Carries data from the broker's thread to this one.
+    _received = pyqtSignal(bytes)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._port = None
+        self._broker = None
+        self._buffer = bytearray()
+        self._error = ''
+        self._received.connect(self._on_received)
+
+    def setPortName(self, port):
+        self._port = port
+
+    def setBaudRate(self, baud_rate):
+        # The broker connects at Pyboard's default, the REPL's 115200 baud.
+        return True
+
+    def open(self, mode):
+        """
+        Start listening to the port, returning False if it can't be opened.
+        """
+        try:
+            self._broker = get_broker(self._port)
+            self._broker.listen(self._received.emit)
+        except (SerialException, OSError, pyboard.PyboardError) as ex:
+            self._error = str(ex)
+            return False
+        return True
+
+    def error(self):
+        return self._error
+
+    def readAll(self):
+        data = bytes(self._buffer)
+        del self._buffer[:]
+        return data
+
+    def write(self, data):
+        self._broker.write(data)
+
+    def close(self):
+        if self._broker:
+            self._broker.unlisten()
+
+    def _on_received(self, data):
+        self._buffer.extend(data)
+        self.readyRead.emit()
@@ -9,12 +9,20 @@ You may:
 * rm - remove a named file on the device. Based on the Unix command.
 * put - copy a named local file onto the device a la equivalent FTP command.
 * get - copy a named file from the device to the local file system a la FTP.
+* shell - run any of the above, over one connection, until told to exit.
 """
 from __future__ import print_function
 import ast
 import argparse
+import binascii
+import cmd
+import contextlib
+import fnmatch
+import glob
+import shlex
 import sys
 import os
+import struct
 import time
 import os.path
 from serial.tools.list_ports import comports as list_serial_ports
@@ -24,7 +32,20 @@ from serial import Serial
 PY2 = sys.version_info < (3,)
 
 
-__all__ = ['ls', 'rm', 'put', 'get', 'get_serial']
+#: Seconds to wait for the micro:bit to send something before giving up.
+TIMEOUT = 10
+
+#: What the micro:bit prints on entering raw mode.
+_RAW_BANNER = b'raw REPL; CTRL-B to exit\r\n>'
+
+_now = getattr(time, 'monotonic', time.time)
+
+#: The ids of the serial connections kept in raw mode by session, with how
+#: many sessions each is in.
+_sessions = {}
+
+
+__all__ = ['ls', 'rm', 'put', 'get', 'get_serial', 'session', 'shell']
 
 
 #: The help text to be shown when requested.
@@ -34,8 +55,10 @@ You may use the following commands:
 
 'ls' - list files on the device (based on the equivalent Unix command);
 'rm' - remove a named file on the device (based on the Unix command);
-'put' - copy a named local file onto the device just like the FTP command; and,
-'get' - copy a named file from the device to the local file system a la FTP.
+'put' - copy a named local file onto the device just like the FTP command;
+'get' - copy a named file from the device to the local file system a la FTP;
+and, 'shell' - run commands (read from stdin, unless it's a terminal) until
+'exit'.
 
 For example, 'ufs ls' will list the files on a connected BBC micro:bit.
 """
@@ -54,23 +77,91 @@ def find_microbit():
     return None
 
 
+def read_until(serial, terminator, timeout=TIMEOUT):
+    """
+    Reads from the serial connection until the terminator arrives and returns
+    everything read, including the terminator.
+
+    Each read blocks (for up to the connection's own timeout) until data
+    arrives, and only the newly arrived end of the response is searched. If
+    the micro:bit sends nothing for timeout seconds an IOError is raised.
+    """
+    response = bytearray()
+    deadline = _now() + timeout
+    while True:
+        start = max(0, len(response) - len(terminator) + 1)
+        data = serial.read(max(1, serial.in_waiting))
+        if data:
+            response.extend(data)
+            if response.find(terminator, start) != -1:
+                return bytes(response)
+            deadline = _now() + timeout
+        elif _now() >= deadline:
+            raise IOError('Timed out waiting for the micro:bit to respond.')
+
+
+def read_exact(serial, size, timeout=TIMEOUT):
+    """
+    Reads exactly size bytes from the serial connection, raising an IOError
+    if the micro:bit sends nothing for timeout seconds.
+    """
+    response = bytearray()
+    deadline = _now() + timeout
+    while len(response) < size:
+        data = serial.read(size - len(response))
+        if data:
+            response.extend(data)
+            deadline = _now() + timeout
+        elif _now() >= deadline:
+            raise IOError('Timed out waiting for the micro:bit to respond.')
+    return bytes(response)
+
+
 def raw_on(serial):
     """
-    Puts the device into raw mode.
+    Puts the device into raw mode, unless a session already has.
     """
-    serial.write(b'\x03')  # Send CTRL-C to break out of loop.
-    serial.read_until(b'\n>')  # Flush buffer until prompt.
-    serial.write(b'\x01')  # Go into raw mode.
-    serial.read_until(b'\r\n>OK')  # Flush buffer until raw mode prompt.
+    if id(serial) not in _sessions:
+        _enter_raw_mode(serial)
+
+
+def _enter_raw_mode(serial):
+    serial.write(b'\r\x03\x03')  # Send CTRL-C twice to break out of loop.
+    serial.reset_input_buffer()
+    serial.write(b'\r\x01')  # Go into raw mode.
+    read_until(serial, _RAW_BANNER)  # Flush buffer until raw mode prompt.
 
 
 def raw_off(serial):
     """
-    Takes the device out of raw mode.
+    Takes the device out of raw mode, unless a session is keeping it there.
     """
+    if id(serial) in _sessions:
+        return
     serial.write(b'\x02')  # Send CTRL-B to get out of raw mode.
 
 
+@contextlib.contextmanager
+def session(serial):
+    """
+    Keeps the device in raw mode for every command sent over serial inside
+    the with block, rather than entering and leaving it for each one.
+    Sessions may be nested.
+    """
+    key = id(serial)
+    if key not in _sessions:
+        raw_on(serial)
+        _sessions[key] = 0
+    _sessions[key] += 1
+    try:
+        yield serial
+    finally:
+        _sessions[key] -= 1
+        if not _sessions[key]:
+            del _sessions[key]
+            raw_off(serial)
+
+
 def get_serial():
     """
     Detect if a micro:bit is connected and return a serial object to talk to
@@ -82,7 +173,70 @@ def get_serial():
     return Serial(port, 115200, timeout=1, parity='N')
 
 
-def execute(commands, serial):
+def raw_paste_write(serial, command_bytes, timeout=TIMEOUT):
+    """
+    Writes the command in raw-paste mode, which the micro:bit has agreed to.
+
+    The micro:bit says how many bytes its input buffer can take, and sends a
+    CTRL-A each time it has made room for that many more, so the command is
+    sent as fast as the device can take it.
+    """
+    window = struct.unpack('<H', read_exact(serial, 2, timeout))[0]
+    remaining = window
+    i = 0
+    while i < len(command_bytes):
+        while remaining == 0 or serial.in_waiting:
+            flag = read_exact(serial, 1, timeout)
+            if flag == b'\x01':
+                remaining += window
+            elif flag == b'\x04':
+                # The micro:bit stopped reading early: acknowledge it.
+                serial.write(b'\x04')
+                return
+            else:
+                raise IOError('Unexpected response from the micro:bit: '
+                              '{!r}'.format(flag))
+        chunk = command_bytes[i:i + remaining]
+        serial.write(chunk)
+        remaining -= len(chunk)
+        i += len(chunk)
+    serial.write(b'\x04')  # End of data.
+    # Wait for the micro:bit to acknowledge it.
+    while read_exact(serial, 1, timeout) != b'\x04':
+        pass
+
+
+def write_command(serial, command_bytes, raw_paste=True, timeout=TIMEOUT):
+    """
+    Writes the command to the micro:bit, which must be in raw mode, and tells
+    it to evaluate it.
+
+    Unless raw_paste is False, raw-paste mode is tried first so that writes
+    are paced by the micro:bit itself. Returns whether it was used: if not,
+    the micro:bit's firmware is too old for it, the command is written in
+    small slices instead and the response begins with 'OK'.
+    """
+    if raw_paste:
+        serial.write(b'\x05A\x01')
+        flag = read_exact(serial, 2, timeout)
+        if flag == b'R\x01':
+            raw_paste_write(serial, command_bytes, timeout)
+            return True
+        if flag != b'R\x00':
+            # Older firmware doesn't know raw-paste mode, and the CTRL-A
+            # just printed the raw mode prompt again (the start of which was
+            # just read).
+            read_until(serial, _RAW_BANNER[2:], timeout)
+    # There's no way to tell how much the micro:bit can take, so give it
+    # time to read each slice.
+    for i in range(0, len(command_bytes), 32):
+        serial.write(command_bytes[i:min(i + 32, len(command_bytes))])
+        time.sleep(0.01)
+    serial.write(b'\x04')
+    return False
+
+
+def execute(commands, serial, timeout=TIMEOUT):
     """
     Sends the command to the connected micro:bit via serial and returns the
     result.
@@ -90,25 +244,29 @@ def execute(commands, serial):
     For this to work correctly, a particular sequence of commands needs to be
     sent to put the device into a good state to process the incoming command.
 
-    Returns the stdout and stderr output from the micro:bit.
+    Returns the stdout and stderr output from the micro:bit. Raises an
+    IOError if the micro:bit sends nothing for timeout seconds.
     """
     result = b''
+    err = b''
+    raw_paste = True
     raw_on(serial)
-    # Write the actual command and send CTRL-D to evaluate.
-    for command in commands:
-        command_bytes = command.encode('utf-8')
-        for i in range(0, len(command_bytes), 32):
-            serial.write(command_bytes[i:min(i + 32, len(command_bytes))])
-            time.sleep(0.01)
-        serial.write(b'\x04')
-        response = bytearray()
-        while not response.endswith(b'\x04>'):  # Read until prompt.
-            response.extend(serial.read_all())
-        out, err = response[2:-2].split(b'\x04', 1)  # Split stdout, stderr
-        result += out
-        if err:
-            return b'', err
-    raw_off(serial)
+    try:
+        # Write the actual command and send CTRL-D to evaluate.
+        for command in commands:
+            raw_paste = write_command(serial, command.encode('utf-8'),
+                                      raw_paste, timeout)
+            # Read until prompt.
+            response = read_until(serial, b'\x04>', timeout)
+            if not raw_paste:
+                response = response[2:]  # Drop the 'OK'.
+            # Split stdout, stderr
+            out, err = response[:-2].split(b'\x04', 1)
+            result += out
+            if err:
+                return b'', err
+    finally:
+        raw_off(serial)
     return result, err
 
 
@@ -156,63 +314,380 @@ def rm(serial, filename):
     return True
 
 
-def put(serial, filename):
+def _response(serial, data, timeout=TIMEOUT):
+    """
+    Finishes reading the response to a command, of which data has already
+    arrived, and returns its stdout and stderr.
+    """
+    if not data.endswith(b'\x04>'):
+        data += read_until(serial, b'\x04>', timeout)
+    out, err = data[:-2].split(b'\x04', 1)
+    return out, err
+
+
+def _start(serial, command, timeout=TIMEOUT):
+    """
+    Sends the command, which must print a line before anything else, and
+    returns that line. Raises an IOError if the command fails first.
+    """
+    if not write_command(serial, command.encode('utf-8'), timeout=timeout):
+        read_exact(serial, 2, timeout)  # The 'OK'.
+    # Read a byte at a time so as not to read past the end of the line.
+    line = b''
+    while not line.endswith(b'\n'):
+        line += read_exact(serial, 1, timeout)
+        if line.endswith(b'\x04'):
+            out, err = _response(serial, line, timeout)
+            raise IOError(clean_error(err))
+    return line.decode('utf-8').strip()
+
+
+#: The bytes put and get send or receive at a time.
+BLOCK_SIZE = 256
+
+#: Receives a file on the micro:bit. It prints B if it reads binary data, or
+#: H if it reads hex because the port can't. Each block is sent with a two
+#: byte length before it and is acknowledged with a '.', and an empty block
+#: ends the file.
+_PUT = """
+import sys
+def _put(name):
+    try:
+        from ubinascii import unhexlify
+    except ImportError:
+        def unhexlify(h):
+            return bytes(int(h[i:i + 2], 16) for i in range(0, len(h), 2))
+    try:
+        import micropython
+        i = sys.stdin.buffer
+        micropython.kbd_intr(-1)
+        r = i.read
+        mode = 'B'
+    except (ImportError, AttributeError):
+        micropython = None
+        def r(n):
+            return unhexlify(sys.stdin.read(2 * n))
+        mode = 'H'
+    f = open(name, 'wb')
+    try:
+        print(mode)
+        while True:
+            h = r(2)
+            n = h[0] | h[1] << 8
+            if not n:
+                break
+            f.write(r(n))
+            print('.', end='')
+    finally:
+        f.close()
+        if micropython:
+            micropython.kbd_intr(3)
+_put({0!r})
+"""
+
+#: Sends a file from the micro:bit. It prints the size of the file and B if
+#: binary data follows, or H if lines of hex follow because the port can't
+#: write binary data.
+_GET = """
+import sys
+def _get(name, block):
+    try:
+        import uos as os
+    except ImportError:
+        import os
+    try:
+        from ubinascii import hexlify
+        h = lambda d: hexlify(d).decode()
+    except ImportError:
+        h = lambda d: ''.join('%02x' % c for c in d)
+    try:
+        size = os.stat(name)[6]
+    except AttributeError:
+        size = os.size(name)
+    o = getattr(sys.stdout, 'buffer', None)
+    f = open(name, 'rb')
+    try:
+        print(size, 'B' if o else 'H')
+        while True:
+            d = f.read(block)
+            if not d:
+                break
+            if o:
+                o.write(d)
+            else:
+                print(h(d))
+    finally:
+        f.close()
+_get({0!r}, {1})
+"""
+
+
+def put(serial, filename, target=None, progress=None, timeout=TIMEOUT):
     """
     Puts a referenced file on the LOCAL file system onto the
-    file system on the BBC micro:bit.
+    file system on the BBC micro:bit, as target (or the same name if
+    unspecified).
+
+    The file is streamed a block at a time, each of which the micro:bit
+    acknowledges, so it is never held in memory at either end. If given,
+    progress is called with the number of bytes sent so far and the size of
+    the file as each block is acknowledged. Any exception it raises stops
+    the upload (leaving what was written so far) and is then raised.
 
     Returns True for success or raises an IOError if there's a problem.
     """
     if not os.path.isfile(filename):
         raise IOError('No such file.')
+    if target is None:
+        target = os.path.basename(filename)
+    size = os.path.getsize(filename)
+    if progress:
+        progress(0, size)
     with open(filename, 'rb') as local:
-        content = local.read()
-    filename = os.path.basename(filename)
-    commands = [
-        "fd = open('{}', 'wb')".format(filename),
-        "f = fd.write",
-    ]
-    while content:
-        line = content[:64]
-        if PY2:
-            commands.append('f(b' + repr(line) + ')')
-        else:
-            commands.append('f(' + repr(line) + ')')
-        content = content[64:]
-    commands.append('fd.close()')
-    out, err = execute(commands, serial)
+        raw_on(serial)
+        try:
+            if _start(serial, _PUT.format(target), timeout) == 'B':
+                encode = bytes
+            else:
+                encode = binascii.hexlify
+            receiving = True
+            try:
+                while True:
+                    block = local.read(BLOCK_SIZE)
+                    serial.write(encode(struct.pack('<H', len(block)) +
+                                        block))
+                    if not block:
+                        receiving = False
+                        out, err = _response(serial, b'', timeout)
+                        break
+                    ack = read_exact(serial, 1, timeout)
+                    if ack != b'.':
+                        receiving = False
+                        out, err = _response(serial, ack, timeout)
+                        break
+                    if progress:
+                        progress(local.tell(), size)
+            except BaseException:
+                if receiving:
+                    # Tell the micro:bit the file ends here.
+                    serial.write(encode(b'\x00\x00'))
+                    try:
+                        _response(serial, b'', timeout)
+                    except IOError:
+                        pass
+                raise
+        finally:
+            raw_off(serial)
     if err:
         raise IOError(clean_error(err))
     return True
 
 
-def get(serial, filename, target=None):
+def get(serial, filename, target=None, progress=None, timeout=TIMEOUT):
     """
     Gets a referenced file on the device's file system and copies it to the
     target (or current working directory if unspecified).
 
+    The file is written to the target as it arrives. If given, progress is
+    called with the number of bytes received so far and the size of the
+    file as each block arrives.
+
     Returns True for success or raises an IOError if there's a problem.
     """
     if target is None:
         target = filename
-    commands = [
-        "from microbit import uart",
-        "f = open('{}', 'rb')".format(filename),
-        "r = f.read",
-        "result = True",
-        "while result:\n    result = r(32)\n    if result:\n        "
-        "uart.write(result)\n",
-        "f.close()",
-    ]
-    out, err = execute(commands, serial)
+    raw_on(serial)
+    try:
+        size, mode = _start(serial, _GET.format(filename, BLOCK_SIZE),
+                            timeout).split()
+        size = int(size)
+        received = 0
+        with open(target, 'wb') as local:
+            if progress:
+                progress(received, size)
+            while received < size:
+                length = min(BLOCK_SIZE, size - received)
+                if mode == 'B':
+                    block = read_exact(serial, length, timeout)
+                else:
+                    # A line of hex, ending with '\r\n'.
+                    line = read_exact(serial, 2 * length + 2, timeout)
+                    block = binascii.unhexlify(line[:-2])
+                local.write(block)
+                received += length
+                if progress:
+                    progress(received, size)
+        out, err = _response(serial, b'', timeout)
+    finally:
+        raw_off(serial)
     if err:
         raise IOError(clean_error(err))
-    # Recombine the bytes while removing "b'" from start and "'" from end.
-    with open(target, 'wb') as f:
-        f.write(out)
     return True
 
 
+class Shell(cmd.Cmd):
+    """
+    Runs ufs commands one after another over the same serial connection.
+
+    File names may be glob patterns, which put matches against local files
+    and get and rm against the files on the device.
+    """
+    intro = "Type 'help' for a list of commands, or 'exit' to leave."
+    prompt = 'ufs> '
+
+    def __init__(self, serial, stdin=None, stdout=None):
+        cmd.Cmd.__init__(self, stdin=stdin, stdout=stdout)
+        self.serial = serial
+        #: Whether any command has failed.
+        self.failed = False
+
+    def onecmd(self, line):
+        try:
+            return cmd.Cmd.onecmd(self, line)
+        except Exception as ex:
+            self.failed = True
+            print(ex, file=self.stdout)
+
+    def emptyline(self):
+        # Don't repeat the last command.
+        pass
+
+    def get_names(self):
+        # Leave EOF out of the help.
+        return [name for name in cmd.Cmd.get_names(self) if name != 'do_EOF']
+
+    def default(self, line):
+        raise ValueError('Unknown command: {}'.format(line.split()[0]))
+
+    def _args(self, line, command):
+        args = shlex.split(line)
+        if not args:
+            raise ValueError('{0}: missing filename. (e.g. "{0} foo.txt")'
+                             .format(command))
+        return args
+
+    def _remote(self, patterns):
+        """
+        Returns the names of the files on the device matching the patterns.
+        """
+        files = None
+        names = []
+        for pattern in patterns:
+            if not glob.has_magic(pattern):
+                names.append(pattern)
+                continue
+            if files is None:
+                files = ls(self.serial)
+            matches = fnmatch.filter(files, pattern)
+            if not matches:
+                raise IOError('No such file: {}'.format(pattern))
+            names.extend(matches)
+        return names
+
+    def do_ls(self, line):
+        """ls - list the files on the device."""
+        list_of_files = ls(self.serial)
+        if list_of_files:
+            print(' '.join(list_of_files), file=self.stdout)
+
+    def do_rm(self, line):
+        """rm FILE... - remove the named files on the device."""
+        for name in self._remote(self._args(line, 'rm')):
+            rm(self.serial, name)
+
+    def do_put(self, line):
+        """put FILE... - copy the named local files onto the device."""
+        for pattern in self._args(line, 'put'):
+            paths = sorted(glob.glob(pattern)) if glob.has_magic(pattern) \
+                else [pattern]
+            if not paths:
+                raise IOError('No such file: {}'.format(pattern))
+            for path in paths:
+                put(self.serial, path)
+
+    def do_get(self, line):
+        """get FILE... - copy the named files on the device to here."""
+        for name in self._remote(self._args(line, 'get')):
+            get(self.serial, name)
+
+    def do_exit(self, line):
+        """exit - leave the shell."""
+        return True
+
+    do_quit = do_exit
+
+    def do_EOF(self, line):
+        if self.use_rawinput:
+            # End the prompt's line.
+            print(file=self.stdout)
+        return True
+
+
+def shell(serial, stdin=None, stdout=None):
+    """
+    Runs the shell, keeping the device in raw mode until it exits.
+    Commands are read from stdin (defaulting to sys.stdin), which unless it
+    is a terminal is run as a batch with no prompts.
+
+    Returns False if any command failed.
+    """
+    stdin = sys.stdin if stdin is None else stdin
+    interactive = stdin.isatty()
+    ufs_shell = Shell(serial, stdin, stdout)
+    if interactive:
+        history = _read_history()
+    else:
+        ufs_shell.use_rawinput = False
+        ufs_shell.intro = None
+        ufs_shell.prompt = ''
+    try:
+        with session(serial):
+            while True:
+                try:
+                    ufs_shell.cmdloop()
+                    break
+                except KeyboardInterrupt:
+                    # Stop the command, but not the shell.
+                    print(file=ufs_shell.stdout)
+                    ufs_shell.intro = None
+                    # The device may have been left anywhere.
+                    _enter_raw_mode(serial)
+    finally:
+        if interactive:
+            _write_history(history)
+    return not ufs_shell.failed
+
+
+#: Where the shell keeps the history of commands typed into it.
+HISTORY_FILE = os.path.join(os.path.expanduser('~'), '.ufs_history')
+
+
+def _read_history():
+    """
+    Loads the shell's history, returning the readline module (or None if
+    there isn't one) to save it with.
+    """
+    try:
+        import readline
+    except ImportError:
+        return None
+    try:
+        readline.read_history_file(HISTORY_FILE)
+    except (IOError, OSError):
+        pass
+    return readline
+
+
+def _write_history(readline):
+    if readline is None:
+        return
+    try:
+        readline.set_history_length(1000)
+        readline.write_history_file(HISTORY_FILE)
+    except (IOError, OSError):
+        pass
+
+
 def main(argv=None):
     """
     Entry point for the command line tool 'ufs'.
@@ -226,7 +701,8 @@ def main(argv=None):
     try:
         parser = argparse.ArgumentParser(description=_HELP_TEXT)
         parser.add_argument('command', nargs='?', default=None,
-                            help="One of 'ls', 'rm', 'put' or 'get'.")
+                            help="One of 'ls', 'rm', 'put', 'get' or "
+                                 "'shell'.")
         parser.add_argument('path', nargs='?', default=None,
                             help="Use when a file needs referencing.")
         args = parser.parse_args(argv)
@@ -253,6 +729,10 @@ def main(argv=None):
                     get(serial, args.path)
             else:
                 print('get: missing filename. (e.g. "ufs get foo.txt")')
+        elif args.command == 'shell':
+            with get_serial() as serial:
+                if not shell(serial):
+                    sys.exit(1)
         else:
             # Display some help.
             parser.print_help()
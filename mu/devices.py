@@ -0,0 +1,243 @@
+"""
+Copyright (c) 2015-2016 Nicholas H.Tollervey and others (see the AUTHORS file).
+
+Based upon work done for Puppy IDE by Dan Pope, Nicholas Tollervey and Damien
+George.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import collections
+import logging
+import os
+import re
+import select
+import socket
+import threading
+import time
+from serial.tools.list_ports import comports as list_serial_ports
+from mu.contrib import uflash
+
+
+logger = logging.getLogger(__name__)
+
+
+#: List of supported board USB IDs.  Each board is a tuple of unique USB vendor
+# ID, USB product ID.
+BOARD_IDS = set([
+    (0x0D28, 0x0204),  # micro:bit USB VID, PID
+    (0x239A, 0x800B),  # Adafruit Feather M0 CDC only USB VID, PID
+    (0x239A, 0x8016),  # Adafruit Feather M0 CDC + MSC USB VID, PID
+    (0x239A, 0x8014),  # metro m0 PID
+    (0x239A, 0x8019),  # circuitplayground m0 PID
+    (0x239A, 0x801B),  # feather m0 express PID
+    (0x1366, 0x0105)   # Silicon Labs Thunderboard Sense
+])
+#: The micro:bit's USB IDs, under which its drive is recorded where drives
+#: can only be found by their volume name.
+MICROBIT_ID = (0x0D28, 0x0204)
+#: Seconds between rescans where there are no hotplug events to wait for.
+RESCAN_INTERVAL = 5
+#: Seconds between rescans with hotplug events, in case any were missed.
+HOTPLUG_RESCAN_INTERVAL = 60
+#: Seconds to let a burst of hotplug events settle before rescanning.
+SETTLE_TIME = 0.5
+#: Where Linux lists block devices and mounted file systems.
+SYS_BLOCK = '/sys/class/block'
+MOUNTS = '/proc/self/mounts'
+
+_NETLINK_KOBJECT_UEVENT = 15
+
+#: A board's serial port: the device to open, and the name Qt gives it.
+Port = collections.namedtuple('Port', 'device name')
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_registry(board_ids=BOARD_IDS):
+    """
+    Return the DeviceRegistry of the boards with the given USB IDs, creating
+    and starting it the first time.
+    """
+    key = frozenset(board_ids)
+    with _registries_lock:
+        registry = _registries.get(key)
+        if registry is None:
+            registry = _registries[key] = DeviceRegistry(key)
+            registry.start()
+        return registry
+
+
+def _usb_ids(path):
+    """
+    Return the (vendor ID, product ID) of the USB device the sysfs path
+    belongs to, or None if it isn't one.
+    """
+    path = os.path.realpath(path)
+    while True:
+        try:
+            with open(os.path.join(path, 'idVendor')) as vendor, \
+                    open(os.path.join(path, 'idProduct')) as product:
+                return int(vendor.read(), 16), int(product.read(), 16)
+        except (OSError, ValueError):
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+
+
+def _mounted_devices():
+    """
+    Yield (device, mount point) for each mounted device on Linux.
+    """
+    with open(MOUNTS) as mounts:
+        for line in mounts:
+            fields = line.split()
+            if len(fields) > 1 and fields[0].startswith('/dev/'):
+                # Spaces and the like in the path are octal escapes.
+                yield fields[0], re.sub(r'\\([0-7]{3})',
+                                        lambda m: chr(int(m.group(1), 8)),
+                                        fields[1])
+
+
+def _hotplug_socket():
+    """
+    Return a socket which becomes readable as the kernel adds or removes
+    devices, or None where there isn't one (anywhere but Linux).
+    """
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                             _NETLINK_KOBJECT_UEVENT)
+    except (AttributeError, OSError):
+        return None
+    try:
+        sock.bind((0, 1))
+        sock.setblocking(False)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+class DeviceRegistry:
+    """
+    Keeps track of the serial ports and mounted drives of connected boards
+    with the given USB IDs, so finding one needs no scan.
+
+    A thread rescans when the kernel says devices have come or gone, or the
+    mounted file systems have changed (on Linux), and otherwise every so
+    often. The tables are replaced rather than changed, so they can be read
+    without locking.
+    """
+
+    def __init__(self, board_ids):
+        self.board_ids = frozenset(board_ids)
+        #: Maps (vendor ID, product ID) to the Ports of such boards.
+        self.ports = {}
+        #: Maps (vendor ID, product ID) to where such a board is mounted.
+        self.mounts = {}
+        self._stopping = threading.Event()
+
+    def scan(self):
+        """
+        Update the tables with the boards connected now.
+        """
+        ports = {}
+        for info in list_serial_ports():
+            ids = (info.vid, info.pid)
+            if ids in self.board_ids:
+                port = Port(info.device, info.name or info.device)
+                ports.setdefault(ids, []).append(port)
+        mounts = {}
+        if os.path.isdir(SYS_BLOCK) and os.path.exists(MOUNTS):
+            for device, mount_point in _mounted_devices():
+                name = os.path.basename(os.path.realpath(device))
+                ids = _usb_ids(os.path.join(SYS_BLOCK, name))
+                if ids in self.board_ids:
+                    mounts.setdefault(ids, mount_point)
+        elif MICROBIT_ID in self.board_ids:
+            try:
+                mount_point = uflash.find_microbit()
+            except NotImplementedError:
+                mount_point = None
+            if mount_point:
+                mounts[MICROBIT_ID] = mount_point
+        self.ports = ports
+        self.mounts = mounts
+
+    def find_port(self):
+        """
+        Return the Port of a connected board, or None if there isn't one.
+        """
+        for ports in self.ports.values():
+            return ports[0]
+        return None
+
+    def find_mount(self):
+        """
+        Return where a connected board's drive is mounted, or None.
+        """
+        for mount_point in self.mounts.values():
+            return mount_point
+        return None
+
+    def start(self):
+        """
+        Scan for boards, then keep watching for them in a thread.
+        """
+        self.scan()
+        threading.Thread(target=self._watch, daemon=True).start()
+
+    def stop(self):
+        """
+        Stop watching, once the thread next wakes.
+        """
+        self._stopping.set()
+
+    def _watch(self):
+        """
+        Rescan whenever devices or mounts may have changed, until stopped.
+        """
+        sock = _hotplug_socket()
+        mounts = None
+        if sock:
+            try:
+                mounts = open(MOUNTS)
+            except OSError:
+                pass
+        try:
+            while not self._stopping.is_set():
+                if sock:
+                    readable = select.select(
+                        [sock], [], [mounts] if mounts else [],
+                        HOTPLUG_RESCAN_INTERVAL)[0]
+                    if readable:
+                        # A board brings several devices with it.
+                        time.sleep(SETTLE_TIME)
+                        try:
+                            while sock.recv(65536):
+                                pass
+                        except OSError:
+                            pass
+                elif self._stopping.wait(RESCAN_INTERVAL):
+                    break
+                try:
+                    self.scan()
+                except Exception as ex:
+                    logger.error(ex)
+        finally:
+            if sock:
+                sock.close()
+            if mounts:
+                mounts.close()
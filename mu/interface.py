@@ -31,12 +31,12 @@ from PyQt5.QtWidgets import (QToolBar, QAction, QStackedWidget, QDesktopWidget,
 from PyQt5.QtGui import (QKeySequence, QColor, QTextCursor, QFontDatabase,
                          QCursor)
 from PyQt5.Qsci import QsciScintilla, QsciLexerPython, QsciAPIs
-from PyQt5.QtSerialPort import QSerialPort
 from mu import __version__
-from mu.contrib import microfs
+from mu.broker import SharedPort
+from mu.devices import get_registry
 from mu.resources import load_icon, load_stylesheet, load_font_data
-from mu.resources import pyboard
-from mu.resources import files
+from mu.resources.minify import TracebackMapper
+from mu.transfer import TransferManager
 
 #: The default font size.
 DEFAULT_FONT_SIZE = 14
@@ -765,6 +765,8 @@ class Window(QStackedWidget):
         self.splitter.setSizes([66, 33])
         self.fs.setFocus()
         self.connect_zoom(self.fs)
+        # Find out how much space is free in the background.
+        self.fs.transfers.df()
 
     def add_repl(self, repl):
         """
@@ -792,6 +794,7 @@ class Window(QStackedWidget):
         """
         Removes the file system pane from the application.
         """
+        self.fs.transfers.stop()
         self.fs.setParent(None)
         self.fs.deleteLater()
         self.fs = None
@@ -800,6 +803,7 @@ class Window(QStackedWidget):
         """
         Removes the REPL pane from the application.
         """
+        self.repl.disconnect()
         self.repl.setParent(None)
         self.repl.deleteLater()
         self.repl = None
@@ -974,8 +978,10 @@ class REPLPane(QTextEdit):
         self.setContextMenuPolicy(Qt.CustomContextMenu)
         self.customContextMenuRequested.connect(self.context_menu)
         self.setObjectName('replpane')
-        # open the serial port
-        self.serial = QSerialPort(self)
+        # Tracebacks from minified scripts give their original line numbers.
+        self.tracebacks = TracebackMapper()
+        # open the serial port, shared with anything else using the board
+        self.serial = SharedPort(self)
         self.serial.setPortName(port)
         if self.serial.open(QIODevice.ReadWrite):
             self.serial.setBaudRate(115200)
@@ -1033,7 +1039,8 @@ class REPLPane(QTextEdit):
         """
         Called when the application gets data from the connected device.
         """
-        self.process_bytes(bytes(self.serial.readAll()))
+        data = bytes(self.serial.readAll())
+        self.process_bytes(self.tracebacks.feed(data))
 
     def keyPressEvent(self, data):
         """
@@ -1057,6 +1064,10 @@ class REPLPane(QTextEdit):
             msg = b'\x1B[H'
         elif key == Qt.Key_End:
             msg = b'\x1B[F'
+        elif key in (Qt.Key_Return, Qt.Key_Enter):
+            # What's typed is also <stdin>, so tracebacks from now on are no
+            # longer from the script which was run.
+            self.tracebacks.maps.pop('<stdin>', None)
         elif (platform.system() == 'Darwin' and
                 data.modifiers() == Qt.MetaModifier) or \
              (platform.system() != 'Darwin' and
@@ -1204,45 +1215,30 @@ class MicrobitFileList(MuFileList):
         self.setDragDropMode(QListWidget.DragDrop)
 
     def dropEvent(self, event):
+        """
+        Queue copying the file dropped from the local list to the device. The
+        lists are refreshed once the transfer is done.
+        """
         source = event.source()
-        self.disable(source)
         if isinstance(source, LocalFileList):
-            file_exists = self.findItems(source.currentItem().text(),
-                                         Qt.MatchExactly)
+            microbit_filename = source.currentItem().text()
+            file_exists = self.findItems(microbit_filename, Qt.MatchExactly)
             if not file_exists or \
                     file_exists and self.show_confirm_overwrite_dialog():
-                local_filename = os.path.join(self.home,
-                                              source.currentItem().text())
+                local_filename = os.path.join(self.home, microbit_filename)
                 logger.info("Putting {}".format(local_filename))
-                try:
-                    with microfs.get_serial() as serial:
-                        logger.info(serial.port)
-                        microfs.put(serial, local_filename)
-                    super().dropEvent(event)
-                except Exception as ex:
-                    logger.error(ex)
-        self.enable(source)
-        if self.parent() is not None:
-            self.parent().ls()
+                self.parent().transfers.put(local_filename, microbit_filename)
+                super().dropEvent(event)
 
     def contextMenuEvent(self, event):
         menu = QMenu(self)
         delete_action = menu.addAction("Delete (cannot be undone)")
         action = menu.exec_(self.mapToGlobal(event.pos()))
         if action == delete_action:
-            self.setDisabled(True)
-            self.setAcceptDrops(False)
             microbit_filename = self.currentItem().text()
             logger.info("Deleting {}".format(microbit_filename))
-            try:
-                with microfs.get_serial() as serial:
-                    logger.info(serial.port)
-                    microfs.rm(serial, microbit_filename)
-                self.takeItem(self.currentRow())
-            except Exception as ex:
-                logger.error(ex)
-            self.setDisabled(False)
-            self.setAcceptDrops(True)
+            self.parent().transfers.rm(microbit_filename)
+            self.takeItem(self.currentRow())
 
 
 class LocalFileList(MuFileList):
@@ -1256,8 +1252,11 @@ class LocalFileList(MuFileList):
         self.setDragDropMode(QListWidget.DragDrop)
 
     def dropEvent(self, event):
+        """
+        Queue copying the file dropped from the device list to the local
+        directory. The lists are refreshed once the transfer is done.
+        """
         source = event.source()
-        self.disable(source)
         if isinstance(source, MicrobitFileList):
             file_exists = self.findItems(source.currentItem().text(),
                                          Qt.MatchExactly)
@@ -1268,21 +1267,8 @@ class LocalFileList(MuFileList):
                                               microbit_filename)
                 logger.debug("Getting {} to {}".format(microbit_filename,
                                                        local_filename))
-                try:
-                    with microfs.get_serial() as serial:
-                        logger.info(serial.port)
-                        # microfs.get(serial, microbit_filename, local_filename)
-                        board = pyboard.Pyboard(serial.port)
-                        board_files = files.Files(board)
-                        fileBytes = board_files.get(microbit_filename)
-                        with open(local_filename, 'wb') as local:
-                            local.write(fileBytes)
-                    super().dropEvent(event)
-                except Exception as ex:
-                    logger.error(ex)
-        self.enable(source)
-        if self.parent() is not None:
-            self.parent().ls()
+                self.parent().transfers.get(microbit_filename, local_filename)
+                super().dropEvent(event)
 
 
 class FileSystemPane(QFrame):
@@ -1296,6 +1282,14 @@ class FileSystemPane(QFrame):
         super().__init__(parent)
         self.home = home
         self.font = Font().load()
+        # File operations are queued and run in the background, so the
+        # window doesn't freeze while they talk to the device.
+        port = get_registry().find_port()
+        self.transfers = TransferManager(port and port.device, self)
+        self.transfers.job_finished.connect(self.on_job_finished)
+        self.transfers.disk_usage.connect(self.on_disk_usage)
+        self.transfers.listing.connect(self.on_listing)
+        self.transfers.idle.connect(self.ls_local)
         microbit_fs = MicrobitFileList(home)
         local_fs = LocalFileList(home)
         layout = QGridLayout()
@@ -1304,8 +1298,10 @@ class FileSystemPane(QFrame):
         microbit_label.setText('Files on your board:')
         local_label = QLabel()
         local_label.setText('Files on your computer:')
+        microbit_space = QLabel()
         self.microbit_label = microbit_label
         self.local_label = local_label
+        self.microbit_space = microbit_space
         self.microbit_fs = microbit_fs
         self.local_fs = local_fs
         self.set_font_size()
@@ -1313,25 +1309,53 @@ class FileSystemPane(QFrame):
         layout.addWidget(local_label, 0, 1)
         layout.addWidget(microbit_fs, 1, 0)
         layout.addWidget(local_fs, 1, 1)
+        layout.addWidget(microbit_space, 2, 0)
         self.ls()
 
     def ls(self):
         """
-        Gets a list of the files on the micro:bit.
+        Lists the files on the computer, and queues getting a list of the
+        files on the micro:bit, which on_listing shows once it arrives.
+        """
+        self.transfers.ls()
+        self.ls_local()
 
-        Naive implementation for simplicity's sake.
+    def ls_local(self):
+        """
+        Lists the files in the user's code directory.
         """
-        self.microbit_fs.clear()
         self.local_fs.clear()
-        microbit_files = microfs.ls(microfs.get_serial())
-        for f in microbit_files:
-            self.microbit_fs.addItem(f)
         local_files = [f for f in os.listdir(self.home)
                        if os.path.isfile(os.path.join(self.home, f))]
         local_files.sort()
         for f in local_files:
             self.local_fs.addItem(f)
 
+    def on_listing(self, microbit_files):
+        """
+        Show the files on the micro:bit.
+        """
+        self.microbit_fs.clear()
+        for f in microbit_files:
+            self.microbit_fs.addItem(f)
+
+    def on_disk_usage(self, usage):
+        """
+        Show how much space is free on the board.
+        """
+        if usage.block_size:
+            self.microbit_space.setText('{:,} KB free of {:,} KB'.format(
+                usage.free // 1024, usage.size // 1024))
+        else:
+            self.microbit_space.setText('')
+
+    def on_job_finished(self, job_id, error):
+        """
+        Log why a queued file operation failed.
+        """
+        if error is not None:
+            logger.error(error)
+
     def set_theme(self, theme):
         """
         Sets the theme / look for the FileSystemPane.
@@ -1348,6 +1372,7 @@ class FileSystemPane(QFrame):
         self.font.setPointSize(new_size)
         self.microbit_label.setFont(self.font)
         self.local_label.setFont(self.font)
+        self.microbit_space.setFont(self.font)
         self.microbit_fs.setFont(self.font)
         self.local_fs.setFont(self.font)
 
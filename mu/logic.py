@@ -31,7 +31,6 @@ import webbrowser
 from shutil import copyfile
 from time import sleep
 from PyQt5.QtWidgets import QMessageBox
-from PyQt5.QtSerialPort import QSerialPortInfo
 from pyflakes.api import check
 from serial.tools.list_ports import comports as list_serial_ports
 from serial.serialutil import SerialException
@@ -40,24 +39,16 @@ try:  # pragma: no cover
     from pycodestyle import StyleGuide, Checker
 except ImportError:  # pragma: no cover
     from pep8 import StyleGuide, Checker
-from mu.contrib import uflash, appdirs, microfs
+from mu.contrib import uflash, appdirs
 from mu.contrib.atomicfile import open_atomic
 from mu import __version__
+from mu.broker import PortBusyError, get_broker
+from mu.devices import get_registry
 
 from mu.resources import pyboard
 from mu.resources import files
+from mu.resources import minify
 
-#: List of supported board USB IDs.  Each board is a tuple of unique USB vendor
-# ID, USB product ID.
-BOARD_IDS = set([
-    (0x0D28, 0x0204),  # micro:bit USB VID, PID
-    (0x239A, 0x800B),  # Adafruit Feather M0 CDC only USB VID, PID
-    (0x239A, 0x8016),  # Adafruit Feather M0 CDC + MSC USB VID, PID
-    (0x239A, 0x8014),  # metro m0 PID
-    (0x239A, 0x8019),  # circuitplayground m0 PID
-    (0x239A, 0x801B),  # feather m0 express PID
-	(0x1366, 0x0105)   # Silicon Labs Thunderboard Sense
-])
 #: The user's home directory.
 HOME_DIRECTORY = os.path.expanduser('~')
 # Name of the directory within the home folder to use by default
@@ -90,27 +81,25 @@ logger = logging.getLogger(__name__)
 
 def find_microbit():
     """
-    Returns the port for the first microbit it finds connected to the host
-    computer. If no microbit is found, returns None.
+    Returns the port (the device to open) for the first microbit it finds
+    connected to the host computer. If no microbit is found, returns None.
     """
-    available_ports = QSerialPortInfo.availablePorts()
-    for port in available_ports:
-        pid = port.productIdentifier()
-        vid = port.vendorIdentifier()
-        # Look for the port VID & PID in the list of known board IDs.
-        if vid == 0x1366 and ("tty" in port.portName() or "COM" in port.portName()):
-            port_name = port.portName()
-            logger.info('Found micro:bit with portName: {}'.format(port_name))
-            return port_name
+    port = get_registry().find_port()
+    if port:
+        logger.info('Found micro:bit with portName: {}'.format(port.name))
+        return port.device
     logger.warning('Could not find micro:bit.')
-    logger.debug('Available ports:')
-    logger.debug(['PID:{} VID:{} PORT:{}'.format(p.productIdentifier(),
-                                                 p.vendorIdentifier(),
-                                                 p.portName())
-                 for p in available_ports])
     return None
 
 
+def find_microbit_path():
+    """
+    Returns the path where the first microbit connected to the host computer
+    is mounted, or None if there isn't one.
+    """
+    return get_registry().find_mount()
+
+
 def get_settings_path():
     """
     The settings file default location is the application data directory.
@@ -349,7 +338,9 @@ class REPL:
     def __init__(self, port):
         if os.name == 'posix':
             # If we're on Linux or OSX reference the port is like this...
-            self.port = "/dev/{}".format(port)
+            if not port.startswith('/'):
+                port = "/dev/{}".format(port)
+            self.port = port
         elif os.name == 'nt':
             # On Windows simply return the port (e.g. COM0).
             self.port = port
@@ -395,6 +386,10 @@ class Editor:
                 logger.debug(old_session)
                 if 'theme' in old_session:
                     self.theme = old_session['theme']
+                if 'minify' in old_session:
+                    files.Files.minify = old_session['minify']
+                if 'rename_locals' in old_session:
+                    files.Files.rename_locals = old_session['rename_locals']
                 if 'paths' in old_session:
                     for path in old_session['paths']:
                         # if the os passed in a file, defer loading it now
@@ -425,6 +420,17 @@ class Editor:
         python_script = tab.text().encode('utf-8')
         logger.debug('Python script:')
         logger.debug(python_script)
+        # The device runs the script as __main__.
+        minify.line_maps.pop('__main__', None)
+        if files.Files.minify:
+            try:
+                result = minify.minify(python_script,
+                                       files.Files.rename_locals)
+                python_script = result.source.encode('utf-8')
+                minify.line_maps['__main__'] = result.line_map
+            except SyntaxError:
+                # Flash it as it is, so the device reports the error.
+                pass
         if len(python_script) >= 8192:
             message = 'Unable to flash "{}"'.format(tab.label)
             information = ("Your script is too long!")
@@ -432,7 +438,7 @@ class Editor:
             return
         # Determine the location of the BBC micro:bit. If it can't be found
         # fall back to asking the user to locate it.
-        path_to_microbit = uflash.find_microbit()
+        path_to_microbit = find_microbit_path()
         if path_to_microbit is None:
             # Has the path to the device already been specified?
             if self.user_defined_microbit_path:
@@ -488,36 +494,24 @@ class Editor:
         # Save program
         self.save()
         
-        portNum = find_microbit()
-
-        if os.name == 'posix':
-            # If we're on Linux or OSX reference the port is like this...
-            port = "/dev/{}".format(portNum)
-        elif os.name == 'nt':
-            # On Windows simply return the port (e.g. COM0).
-            port = portNum
-        else:
-            # No idea how to deal with other OS's so fail.
-            logger.debug('OS not supported.')
-            raise NotImplementedError('OS not supported.')
+        port = find_microbit()
 
         try:
-            if self.repl:
-                logger.debug('Temporarily disconnecting REPL')
-                self._view.disconnect_repl(self.repl)
-
-            # Call AMPY
-            board = pyboard.Pyboard(port)
-            board_files = files.Files(board)
-            # Save the program as main.py to make it load after a reset
-            # with open(tab.path, 'rb') as infile:
-               # board_files.put("main.py", infile.read())
-            board_files.run(tab.path, False)
-            board.close()
-            
-            if self.repl:
-                logger.debug('Reconnecting REPL')
-                self._view.connect_repl(self.repl)
+            # The REPL, if open, shares the connection to the board: it is
+            # paused while the script is sent, then shows its output. File
+            # transfers hold it for longer, so rather than freeze the window
+            # until they're done the script isn't sent.
+            with get_broker(port).lease(timeout=0) as board:
+                board_files = files.Files(board)
+                # Save the program as main.py to make it load after a reset
+                # with open(tab.path, 'rb') as infile:
+                #     board_files.put("main.py", infile.read())
+                board_files.run(tab.path, False)
+        except PortBusyError:
+            message = 'The device is busy.'
+            information = ("Please wait for the file transfers to finish,"
+                           " then try again.")
+            self._view.show_message(message, information)
         except (SerialException, IOError, pyboard.PyboardError) as e:
             message = 'Could not find an attached board.'
             information = ("Please make sure the device is plugged into this"
@@ -535,11 +529,10 @@ class Editor:
         """
         if self.repl is None:
             if self.fs is None:
-                try:
-                    microfs.get_serial()
+                if find_microbit():
                     self._view.add_filesystem(home=get_workspace_dir())
                     self.fs = True
-                except IOError:
+                else:
                     message = 'Could not find an attached BBC micro:bit.'
                     information = ("Please make sure the device is plugged "
                                    "into this computer.\n\nThe device must "
@@ -780,6 +773,8 @@ class Editor:
                 paths.append(widget.path)
         session = {
             'theme': self.theme,
+            'minify': files.Files.minify,
+            'rename_locals': files.Files.rename_locals,
             'paths': paths,
             'workspace': get_workspace_dir(),
             'microbit_runtime_hex': get_runtime_hex_path()
@@ -0,0 +1,291 @@
+"""
+A small agent which stays on a board and answers file requests.
+
+Without it every operation sends the board a new snippet of Python to
+compile, which is slow and fragments the heap of a small board.  Once the
+agent is installed (Files.install_agent copies it to AGENT_PATH) it is
+imported once and answers framed requests on the raw REPL's stdin instead.
+
+Each request is an opcode letter and the length of its argument as eight hex
+digits, followed by the argument: for example b'l00000001/' lists the root.
+The header is read with Ctrl-C enabled, so a host which starts again can
+always interrupt an idle agent; only the argument, which is binary, is read
+with it disabled, giving up if the host goes quiet.  Each answer is a status
+letter (K for success, E for an error) and the length of the result in the
+same way, followed by the result.  An error's result is the exception as a
+traceback would end with it, e.g. 'OSError: [Errno 2] ENOENT'.  A q request
+stops the agent, leaving the board in the raw REPL.
+
+    if agent.start(pyboard) == agent.VERSION:
+        board = agent.Agent(pyboard)
+        print(board.ls('/'))
+        board.stop()
+"""
+import ast
+
+from .pyboard import PyboardError
+
+
+#: The version of the agent, which is upgraded on boards with another one.
+VERSION = 1
+#: Where the agent is installed on a board.
+AGENT_PATH = '/mu_agent.py'
+#: Seconds the agent waits for the rest of a request before giving up.
+TIMEOUT = 10
+
+#: The agent's source, as installed on the board.
+SOURCE = """\
+import sys, uos
+VERSION = {version}
+
+
+def df(name):
+    try:
+        s = uos.statvfs(name[:name.rfind('/') + 1] or '.')
+        s = s[1], s[2], s[4]
+    except (AttributeError, OSError):
+        s = 0, 0, 0
+    try:
+        old = uos.stat(name)[6]
+    except OSError:
+        old = 0
+    return s[0], s[1], s[2], old
+
+
+def rename(old, new):
+    try:
+        uos.rename(old, new)
+    except OSError:
+        uos.remove(new)
+        uos.rename(old, new)
+
+
+def _ls(a):
+    return repr(uos.listdir(a.decode())).encode()
+
+
+def _stat(a):
+    return repr(uos.stat(a.decode())).encode()
+
+
+def _read(a):
+    offset, size, path = a.decode().split(' ', 2)
+    with open(path, 'rb') as f:
+        f.seek(int(offset))
+        return f.read(int(size))
+
+
+def _write(a):
+    i = a.find(b'\\0')
+    with open(a[1:i].decode(), 'ab' if a[0] == 97 else 'wb') as f:
+        f.write(memoryview(a)[i + 1:])
+    return b''
+
+
+def _rm(a):
+    uos.remove(a.decode())
+    return b''
+
+
+def _mkdir(a):
+    uos.mkdir(a.decode())
+    return b''
+
+
+def _hash(a):
+    h = None
+    for m in ('uhashlib', 'hashlib'):
+        try:
+            h = __import__(m).sha256()
+            break
+        except (ImportError, AttributeError):
+            pass
+    if not h:
+        return b''
+    buf = bytearray(256)
+    with open(a.decode(), 'rb') as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(memoryview(buf)[:n])
+    return __import__('ubinascii').hexlify(h.digest())
+
+
+def _exec(a):
+    return repr(eval(a.decode(), globals())).encode()
+
+
+_OPS = {{'l': _ls, 's': _stat, 'r': _read, 'w': _write, 'd': _rm,
+        'm': _mkdir, 'h': _hash, 'x': _exec}}
+
+
+def serve(timeout):
+    import micropython
+    # Fail now, before the hello, on boards which can't run the agent.
+    k = micropython.kbd_intr
+    i = sys.stdin.buffer
+    o = sys.stdout.buffer
+    try:
+        import uselect
+        p = uselect.poll()
+        p.register(i, uselect.POLLIN)
+    except (ImportError, AttributeError):
+        p = None
+
+    def read(n):
+        d = b''
+        while len(d) < n:
+            if p and not p.poll(timeout):
+                raise OSError(110)
+            d += i.read(n - len(d))
+        return d
+
+    o.write(('MA%02x' % VERSION).encode())
+    while True:
+        h = b''
+        while len(h) < 9:
+            h += i.read(9 - len(h))
+        op = chr(h[0])
+        if op == 'q':
+            return
+        k(-1)
+        try:
+            a = read(int(h[1:], 16))
+        finally:
+            k(3)
+        try:
+            r = _OPS[op](a)
+            s = 'K'
+        except Exception as e:
+            r = ('%s: %s' % (type(e).__name__, e)).encode()
+            s = 'E'
+        o.write(('%s%08x' % (s, len(r))).encode())
+        o.write(r)
+""".format(version=VERSION)
+
+# Imports the agent (again, if an earlier version was imported) and starts
+# it, or prints the version the board has: 0 for none, -1 for a broken one.
+_START = """
+import sys
+def start(version, timeout):
+    try:
+        import mu_agent
+        if mu_agent.VERSION != version:
+            del sys.modules['mu_agent']
+            import mu_agent
+        found = mu_agent.VERSION
+    except ImportError:
+        found = 0
+    except Exception:
+        found = -1
+    if found != version:
+        print(found)
+        return
+    mu_agent.serve(timeout)
+start({0}, {1})
+"""
+
+
+def start(pyboard):
+    """Start the agent on the board, which must be in raw REPL mode, if it
+    has this version of it.  Returns the version of the agent the board has
+    (0 if none, -1 if it's broken): unless this is VERSION, the agent wasn't
+    started and the board is still in the raw REPL.
+    """
+    pyboard.exec_raw_no_follow(_START.format(VERSION, TIMEOUT * 1000))
+    tag = pyboard.read_exact(1)
+    if tag == b'M':
+        hello = pyboard.read_exact(3)
+        if hello[:1] == b'A':
+            return int(hello[1:], 16)
+        tag += hello
+    if tag == b'\x04':
+        # It printed nothing before failing.
+        tag = b''
+        out = b''
+        err = pyboard.read_until(1, b'\x04')[:-1]
+    else:
+        out, err = pyboard.follow(10)
+    if err:
+        raise PyboardError('exception', tag + out, err)
+    return int(tag + out)
+
+
+class Agent(object):
+    """Make requests of the agent running on a board (see start).  Errors on
+    the board are raised as PyboardError, with the error as it would end a
+    traceback.
+    """
+
+    def __init__(self, pyboard):
+        self._pyboard = pyboard
+        #: False once the agent has stopped, or can't be trusted to be
+        #: waiting for a request because talking to it failed.
+        self.running = True
+
+    def _call(self, op, argument=b''):
+        """Send the request and return the result."""
+        try:
+            self._pyboard.serial.write(op + b'%08x' % len(argument))
+            self._pyboard.serial.write(argument)
+            header = self._pyboard.read_exact(9)
+            result = self._pyboard.read_exact(int(header[1:], 16))
+        except BaseException:
+            self.running = False
+            raise
+        if header[:1] != b'K':
+            raise PyboardError('exception', b'', result)
+        return result
+
+    def ls(self, path):
+        """Return the names of the files in the directory path."""
+        out = self._call(b'l', path.encode('utf-8'))
+        return ast.literal_eval(out.decode('utf-8'))
+
+    def stat(self, path):
+        """Return the uos.stat tuple of path."""
+        out = self._call(b's', path.encode('utf-8'))
+        return ast.literal_eval(out.decode('utf-8'))
+
+    def read(self, path, offset, size):
+        """Return up to size bytes of the file at path, from offset."""
+        request = '{0} {1} {2}'.format(offset, size, path)
+        return self._call(b'r', request.encode('utf-8'))
+
+    def write(self, path, data, append=False):
+        """Write data to the file at path, or add it to the end if append is
+        True.
+        """
+        mode = b'a' if append else b'w'
+        self._call(b'w', mode + path.encode('utf-8') + b'\0' + bytes(data))
+
+    def rm(self, path):
+        """Remove the file (or empty directory) at path."""
+        self._call(b'd', path.encode('utf-8'))
+
+    def mkdir(self, path):
+        """Create the directory path."""
+        self._call(b'm', path.encode('utf-8'))
+
+    def hash(self, path):
+        """Return the hex SHA256 of the file at path, or '' if the board
+        can't hash.
+        """
+        return self._call(b'h', path.encode('utf-8')).decode('ascii')
+
+    def exec_(self, expression):
+        """Evaluate the expression on the board, with the agent's globals,
+        and return the repr of its value.
+        """
+        return self._call(b'x', expression.encode('utf-8')).decode('utf-8')
+
+    def stop(self):
+        """Stop the agent, leaving the board in the raw REPL."""
+        if not self.running:
+            return
+        self.running = False
+        self._pyboard.serial.write(b'q00000000')
+        out, err = self._pyboard.follow(10)
+        if err:
+            raise PyboardError('exception', out, err)
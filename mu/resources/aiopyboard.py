@@ -0,0 +1,238 @@
+"""
+asyncio interface to MicroPython boards.
+
+AsyncPyboard wraps a connected pyboard.Pyboard and provides coroutine
+versions of its raw REPL operations.  Rather than polling, it registers the
+transport's file descriptor (serial port, pty, process pipe or telnet socket)
+with the event loop, so a single thread can drive many boards at once:
+
+    async def ls(device):
+        board = AsyncPyboard.open(device)
+        await board.enter_raw_repl()
+        out = await board.exec_('import uos; print(uos.listdir())')
+        board.exit_raw_repl()
+        board.close()
+        return out
+
+    loop.run_until_complete(asyncio.gather(*[ls(d) for d in devices]))
+"""
+import asyncio
+import struct
+
+from .pyboard import Pyboard, PyboardError
+
+
+class AsyncPyboard:
+    """
+    Coroutine based counterpart of Pyboard, driven by an event loop reader on
+    the underlying transport.
+    """
+
+    def __init__(self, pyboard, loop=None):
+        """
+        Wrap an already connected Pyboard.  Its receive buffer is shared, so
+        synchronous and asynchronous calls may be mixed on the same board.
+        """
+        self.pyboard = pyboard
+        self.serial = pyboard.serial
+        self.loop = loop or asyncio.get_event_loop()
+        self._rx = pyboard._rx
+        self._data = asyncio.Event()
+        self._eof = False
+        self._fd = self.serial.fileno()
+        self.loop.add_reader(self._fd, self._on_readable)
+
+    @classmethod
+    def open(cls, device, baudrate=115200, user='micro', password='python',
+             loop=None):
+        """
+        Connect to the device (as for Pyboard) and wrap the connection.
+        """
+        return cls(Pyboard(device, baudrate, user, password), loop)
+
+    def close(self):
+        """
+        Stop watching the transport and close the connection.
+        """
+        self.loop.remove_reader(self._fd)
+        self.pyboard.close()
+
+    def _on_readable(self):
+        n = self.serial.inWaiting()
+        if n:
+            self._rx.extend(self.serial.read(n))
+        else:
+            # Readable with nothing to read: the other end has gone away.
+            self._eof = True
+            self.loop.remove_reader(self._fd)
+        self._data.set()
+
+    async def _wait_data(self, timeout):
+        """
+        Wait up to timeout seconds (None for ever) for more data to arrive.
+        Returns False if nothing arrived in time.
+        """
+        if self._eof:
+            raise PyboardError('connection to the board was lost')
+        self._data.clear()
+        try:
+            await asyncio.wait_for(self._data.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        if self._eof:
+            raise PyboardError('connection to the board was lost')
+        return True
+
+    async def _read(self, size):
+        """
+        Read exactly size bytes.
+        """
+        while len(self._rx) < size:
+            await self._wait_data(None)
+        data = bytes(self._rx[:size])
+        del self._rx[:size]
+        return data
+
+    async def read_until(self, min_num_bytes, ending, timeout=10,
+                         data_consumer=None):
+        """
+        Coroutine version of Pyboard.read_until: the timeout is an idle
+        timeout, restarted whenever new data arrives.
+        """
+        while len(self._rx) < min_num_bytes:
+            await self._wait_data(None)
+        scan = 0
+        consumed = 0
+        while True:
+            idx = self._rx.find(ending, scan)
+            if idx >= 0:
+                end = idx + len(ending)
+                break
+            scan = max(0, len(self._rx) - len(ending) + 1)
+            if data_consumer and consumed < len(self._rx):
+                data_consumer(bytes(self._rx[consumed:]))
+                consumed = len(self._rx)
+            if not await self._wait_data(timeout):
+                end = len(self._rx)
+                break
+        if data_consumer and consumed < end:
+            data_consumer(bytes(self._rx[consumed:end]))
+        data = bytes(self._rx[:end])
+        del self._rx[:end]
+        return data
+
+    async def enter_raw_repl(self, soft_reset=True):
+        """
+        Coroutine version of Pyboard.enter_raw_repl.
+        """
+        self.serial.write(b'\r\x03\x03')
+        # Give the board a moment to stop, then discard what it printed.
+        await asyncio.sleep(0.01)
+        del self._rx[:]
+        self.serial.write(b'\r\x01')
+        data = await self.read_until(1, b'raw REPL; CTRL-B to exit\r\n')
+        if not data.endswith(b'raw REPL; CTRL-B to exit\r\n'):
+            raise PyboardError('could not enter raw repl: {!r}'.format(data))
+        if soft_reset:
+            self.serial.write(b'\x04')
+            data = await self.read_until(1, b'soft reboot\r\n')
+            if not data.endswith(b'soft reboot\r\n'):
+                raise PyboardError('could not enter raw repl: {!r}'.format(
+                                   data))
+            data = await self.read_until(1, b'raw REPL; CTRL-B to exit\r\n')
+            if not data.endswith(b'raw REPL; CTRL-B to exit\r\n'):
+                raise PyboardError('could not enter raw repl: {!r}'.format(
+                                   data))
+        self.pyboard.in_raw_repl = True
+
+    def exit_raw_repl(self):
+        """
+        Leave the raw REPL (writing never blocks for long).
+        """
+        self.pyboard.exit_raw_repl()
+
+    async def follow(self, timeout, data_consumer=None):
+        """
+        Coroutine version of Pyboard.follow.
+        """
+        data = await self.read_until(1, b'\x04', timeout=timeout,
+                                     data_consumer=data_consumer)
+        if not data.endswith(b'\x04'):
+            raise PyboardError('timeout waiting for first EOF reception')
+        data_err = await self.read_until(1, b'\x04', timeout=timeout)
+        if not data_err.endswith(b'\x04'):
+            raise PyboardError('timeout waiting for second EOF reception')
+        return data[:-1], data_err[:-1]
+
+    async def _raw_paste_write(self, command_bytes):
+        window_size = struct.unpack('<H', await self._read(2))[0]
+        window_remain = window_size
+        i = 0
+        while i < len(command_bytes):
+            while window_remain == 0 or self._rx:
+                data = await self._read(1)
+                if data == b'\x01':
+                    window_remain += window_size
+                elif data == b'\x04':
+                    self.serial.write(b'\x04')
+                    return
+                else:
+                    raise PyboardError(
+                        'unexpected read during raw paste: {!r}'.format(data))
+            chunk = command_bytes[i:i + window_remain]
+            self.serial.write(chunk)
+            window_remain -= len(chunk)
+            i += len(chunk)
+        self.serial.write(b'\x04')
+        data = await self.read_until(1, b'\x04')
+        if not data.endswith(b'\x04'):
+            raise PyboardError('could not complete raw paste: {!r}'.format(
+                               data))
+
+    async def exec_raw_no_follow(self, command):
+        """
+        Coroutine version of Pyboard.exec_raw_no_follow, including the
+        raw-paste negotiation and its fallback.
+        """
+        if isinstance(command, bytes):
+            command_bytes = command
+        else:
+            command_bytes = bytes(command, encoding='utf8')
+        data = await self.read_until(1, b'>')
+        if not data.endswith(b'>'):
+            raise PyboardError('could not enter raw repl')
+        if self.pyboard.use_raw_paste:
+            self.serial.write(b'\x05A\x01')
+            data = await self._read(2)
+            if data == b'R\x01':
+                return await self._raw_paste_write(command_bytes)
+            elif data != b'R\x00':
+                data = await self.read_until(1, b'w REPL; CTRL-B to exit\r\n>')
+                if not data.endswith(b'w REPL; CTRL-B to exit\r\n>'):
+                    raise PyboardError('could not enter raw repl: {!r}'.format(
+                                       data))
+            self.pyboard.use_raw_paste = False
+        for i in range(0, len(command_bytes), 256):
+            self.serial.write(command_bytes[i:i + 256])
+            await asyncio.sleep(0.01)
+        self.serial.write(b'\x04')
+        data = await self._read(2)
+        if data != b'OK':
+            raise PyboardError('could not exec command (response: %s)' % data)
+
+    async def exec_raw(self, command, timeout=10, data_consumer=None):
+        """
+        Run the command and return its (stdout, stderr) output.
+        """
+        await self.exec_raw_no_follow(command)
+        return await self.follow(timeout, data_consumer)
+
+    async def exec_(self, command):
+        """
+        Run the command and return its output, raising PyboardError (with
+        the same arguments as Pyboard.exec_) if it failed.
+        """
+        ret, ret_err = await self.exec_raw(command)
+        if ret_err:
+            raise PyboardError('exception', ret, ret_err)
+        return ret
@@ -20,26 +20,127 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import ast
+import binascii
+import collections
+import contextlib
+import hashlib
+import io
+import os
+import struct
 import textwrap
+import time
+import zlib
 
+from . import agent
+from .minify import line_maps, map_traceback, minify as minify_source
 from .pyboard import PyboardError
 
 
+AGENT_TRANSFER_SIZE = 4096  # Largest file put and get send through the agent.
 BUFFER_SIZE = 32  # Amount of data to read or write to the serial port at a time.
                   # This is kept small because small chips and USB to serial
                   # bridges usually have very small buffers.
+BATCH_SIZE = 32   # Number of commands to send to the board in one go.
+COMPRESSED_BLOCK_SIZE = 1024  # Amount of data put compresses into each block.
+DOWNLOAD_BLOCK_SIZE = 1024  # Largest block get asks the board to send at once.
+MANIFEST_NAME = '.mu_manifest.json'  # Where sync keeps hashes on the board.
+PARTIAL_SUFFIX = '.part'  # Added to the names of unfinished transfers.
+UPLOAD_BLOCK_SIZE = 256  # Size of the binary blocks put sends to the board.
+# Number of blocks put sends before waiting for the board to acknowledge one.
+UPLOAD_WINDOW = 2
+# Seconds the board waits for the next block before giving up on an upload.
+UPLOAD_TIMEOUT = 10
+CANCEL_OFFSET = 0xFFFFFFFF  # Offset of the empty block which cancels a put.
+CANCEL_BYTE = b'\x18'  # Sent to the board to cancel a get.
 
 
 class DirectoryExistsError(Exception):
     pass
 
 
+class NotEnoughSpaceError(Exception):
+    pass
+
+
+FileInfo = collections.namedtuple('FileInfo', 'path is_dir size mtime')
+
+
+class TransferStats(collections.namedtuple(
+        'TransferStats', 'filename size wire_bytes codec seconds')):
+    """How a put or get went: size bytes of the file were transferred as
+    wire_bytes bytes over the serial link, compressed with the board's codec
+    module (None if the data wasn't compressed), in the given time.
+    """
+
+    @property
+    def speedup(self):
+        """How many times fewer bytes were sent than without compression."""
+        return self.size / self.wire_bytes if self.wire_bytes else 1.0
+
+
+class DiskUsage(collections.namedtuple(
+        'DiskUsage', 'block_size blocks free_blocks')):
+    """The capacity of a board's filesystem, as uos.statvfs reports it: the
+    size of its blocks in bytes, how many it has and how many are free.  A
+    block_size of 0 means the board couldn't say.
+    """
+
+    @property
+    def size(self):
+        """The size of the filesystem in bytes."""
+        return self.block_size * self.blocks
+
+    @property
+    def free(self):
+        """The free space in bytes."""
+        return self.block_size * self.free_blocks
+
+    def blocks_for(self, size):
+        """Return how many blocks a file of size bytes takes up."""
+        return -(-size // self.block_size) if self.block_size else 0
+
+
+def _compress(data):
+    """Compress data as a zlib stream with a 1KB window, small enough for
+    the board to decompress.
+    """
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 10)
+    return compressor.compress(data) + compressor.flush()
+
+
+# Device code shared by commands which remove a directory tree.  It keeps
+# the directories still to clear in a list rather than recursing or changing
+# directory, so a deep tree doesn't exhaust the board's stack and an error
+# partway leaves the board's current directory alone.
+_RMTREE = """\
+def rmtree(top):
+    dirs = [top.rstrip('/') or '/']
+    i = 0
+    while i < len(dirs):
+        d = dirs[i]
+        i += 1
+        for name in uos.listdir(d):
+            p = d.rstrip('/') + '/' + name
+            if uos.stat(p)[0] & 0x4000:
+                dirs.append(p)
+            else:
+                uos.remove(p)
+    for d in reversed(dirs):
+        uos.rmdir(d)
+"""
+
+
 class Files(object):
     """Class to interact with a MicroPython board files over a serial connection.
     Provides functions for listing, uploading, and downloading files from the
     board's filesystem.
     """
 
+    compress = True  # Compress transfers if the board supports it.
+    minify = False   # Minify Python source before uploading or running it.
+    rename_locals = False  # Also rename local variables when minifying.
+    use_agent = True  # Use the board's agent, if installed, in sessions.
+
     def __init__(self, pyboard):
         """Initialize the MicroPython board files class using the provided pyboard
         instance.  In most cases you should create a Pyboard instance (from
@@ -47,36 +148,447 @@ class Files(object):
         it in, but you can pass in other objects for testing, etc.
         """
         self._pyboard = pyboard
+        self._local_hashes = {}
+        self._sessions = 0
+        self._usage = None
+        self._agent = None
+        self._agent_version = None
+        self.last_transfer = None
+
+    @contextlib.contextmanager
+    def session(self, soft_reset=True):
+        """Return a context manager which keeps the board in raw REPL mode so
+        every call made inside it reuses the same session instead of entering
+        (and soft resetting) raw mode again.  Pass soft_reset=False to only
+        interrupt the running program rather than reboot the board, e.g.:
+
+            with board_files.session(soft_reset=False):
+                board_files.ls()
+                board_files.put('main.py', data)
+
+        The board's disk usage (see df) is only asked for once in a session,
+        and if the board has the agent (see install_agent) it is started once
+        and used for the operations it can do.
+        """
+        with self._pyboard.raw_repl(soft_reset):
+            self._sessions += 1
+            try:
+                yield
+            finally:
+                self._sessions -= 1
+                if not self._sessions:
+                    self._usage = None
+                    self._agent_version = None
+                    self._stop_agent()
+
+    def _raw_repl(self):
+        """Return the pyboard's raw REPL context manager, stopping the agent
+        first if it's running, as commands can't be sent until it stops.
+        """
+        self._stop_agent()
+        return self._pyboard.raw_repl()
+
+    def _stop_agent(self):
+        client, self._agent = self._agent, None
+        if client is not None:
+            client.stop()
+
+    def _agent_client(self):
+        """Return an Agent to make requests of, or None to send commands
+        instead.  The agent is only used inside a session, where it is
+        started (first replacing the board's copy if it's out of date) unless
+        the board turned out not to have it.
+        """
+        if self._agent is not None:
+            if self._agent.running:
+                return self._agent
+            # Talking to it failed, so don't try again in this session.
+            self._agent = None
+            self._agent_version = -1
+        if not (self.use_agent and self._sessions) or \
+                self._agent_version not in (None, agent.VERSION):
+            return None
+        with self._pyboard.raw_repl():
+            try:
+                version = agent.start(self._pyboard)
+                if version not in (0, agent.VERSION):
+                    self._agent_version = version
+                    self.install_agent()
+                    version = agent.start(self._pyboard)
+            except PyboardError as ex:
+                if len(ex.args) < 3:
+                    raise
+                # The board can't run it, e.g. it has no binary stdin.
+                version = 0
+        self._agent_version = version
+        if version == agent.VERSION:
+            self._agent = agent.Agent(self._pyboard)
+        return self._agent
+
+    def install_agent(self):
+        """Install the agent on the board, or bring it up to date.  Sessions
+        then use it instead of sending commands for ls, mkdir, rm and small
+        gets and puts, which saves the board compiling each command.  Copies
+        of other versions are replaced automatically when a session finds
+        them.
+        """
+        source = minify_source(agent.SOURCE).source
+        self._put(agent.AGENT_PATH, source.encode('utf-8'))
+        # Start it, rather than whichever version was there, from now on.
+        self._stop_agent()
+        self._agent_version = None
+
+    def df(self):
+        """Return a DiskUsage tuple of the size and free space of the board's
+        filesystem.  Inside a session the board is only asked once, and the
+        answer is kept up to date as files are uploaded (other changes make
+        it ask again).
+        """
+        if self._usage is None:
+            with self._raw_repl():
+                usage = self._statvfs()[0]
+            if not self._sessions:
+                return usage
+            self._usage = usage
+        return self._usage
+
+    def _statvfs(self, filename=None):
+        """Return the DiskUsage of the filesystem holding filename (or the
+        root) and the size of filename, or 0 if it doesn't exist.
+        """
+        command = """
+            import uos
+            def df(name):
+                try:
+                    s = uos.statvfs(name[:name.rfind('/') + 1] or '.')
+                    s = s[1], s[2], s[4]
+                except (AttributeError, OSError):
+                    s = 0, 0, 0
+                try:
+                    old = uos.stat(name)[6]
+                except OSError:
+                    old = 0
+                print(s[0], s[1], s[2], old)
+            df({0!r})
+        """.format(filename or '/')
+        out = self._pyboard.exec_(textwrap.dedent(command))
+        numbers = [int(n) for n in out.split()]
+        return DiskUsage(*numbers[:3]), numbers[3]
+
+    def _check_space(self, filename, usage, size, kept=0, freed=0):
+        """Raise NotEnoughSpaceError if a board with the given DiskUsage can't
+        hold size bytes of filename, given that the first kept bytes are
+        already written and a file of freed bytes is removed first.  Space is
+        counted in whole blocks, as files take it up.
+        """
+        if not usage.block_size:
+            return
+        needed = usage.blocks_for(size) - usage.blocks_for(kept)
+        free = usage.free_blocks + usage.blocks_for(freed)
+        if needed > free:
+            raise NotEnoughSpaceError(
+                'Not enough space for {0}: it needs {1} blocks of {2} bytes '
+                'but only {3} are free'.format(filename, needed,
+                                               usage.block_size, free))
 
     def get(self, filename):
         """Retrieve the contents of the specified file and return its contents
         as a byte string.
         """
-        # Open the file and read it a few bytes at a time and print out the
-        # raw bytes.  Be careful not to overload the UART buffer so only write
-        # a few bytes at a time, and don't use print since it adds newlines and
-        # expects string data.
+        out = io.BytesIO()
+        self.get_to(filename, out)
+        return out.getvalue()
+
+    def get_to(self, filename, dest, block_size=DOWNLOAD_BLOCK_SIZE,
+               progress=None):
+        """Download the specified file to dest, either the path of a local
+        file or a binary file object, a block at a time so the file is never
+        held in memory.  The board also sends a SHA256 hash of what it read,
+        which is checked at the end.  Returns the number of bytes written.
+        If given, progress is called with the number of bytes downloaded so
+        far and the size of the file as each block arrives.  Any exception it
+        raises stops the download and is then raised.
+
+        A download to a path goes to a temporary file which is only renamed
+        once complete.  If an earlier download to the same path was cut
+        short, this one carries on from the end of it (the hash covers the
+        whole file, so a stale partial download is caught).
+        """
+        if isinstance(dest, str):
+            part = dest + PARTIAL_SUFFIX
+            digest = hashlib.sha256()
+            if os.path.exists(part):
+                with open(part, 'rb') as infile:
+                    for block in iter(lambda: infile.read(65536), b''):
+                        digest.update(block)
+            with open(part, 'ab') as outfile:
+                try:
+                    size = self._get_stream(filename, outfile, block_size,
+                                            outfile.tell(), digest, progress)
+                except RuntimeError:
+                    os.remove(part)
+                    raise
+            os.replace(part, dest)
+            return size
+        return self._get_stream(filename, dest, block_size, 0,
+                                hashlib.sha256(), progress)
+
+    def _get_stream(self, filename, dest, block_size, offset, digest,
+                    progress=None):
+        """Download the specified file from offset onwards to dest.  digest
+        is a hashlib object which has already been given the data before
+        offset.  Returns the size of the whole file.
+        """
+        client = self._agent_client()
+        if client is not None:
+            try:
+                total = client.stat(filename)[6]
+            except PyboardError as ex:
+                if ex.args[2].decode('utf-8').find('OSError: [Errno 2] ENOENT') != -1:
+                    raise RuntimeError('No such file: {0}'.format(filename))
+                raise ex
+            if total <= AGENT_TRANSFER_SIZE:
+                return self._get_agent(client, filename, dest, block_size,
+                                       offset, digest, total, progress)
+        # Send the file as frames on the binary stdout: 'S' and the four byte
+        # offset the data starts from and size of the file, 'D' followed by
+        # a two byte length and
+        # the data, then 'H' followed by the length and hex digest of the
+        # hash of the whole file.  A board which can't hash sends an empty
+        # digest, and the whole file, as the partial download can't be
+        # checked.  If the board can compress (and compress is True) blocks
+        # which get smaller are sent as 'Z' frames of zlib data instead of
+        # 'D' frames.  The buffer is shrunk until it fits in the board's free
+        # memory.  A board which can poll stdin stops early, sending a 'C'
+        # frame instead of the hash, if the host sends CANCEL_BYTE.
+        command = """
+            import sys, uos
+            def send(name, size, offset, compress):
+                out = sys.stdout.buffer
+                f = open(name, 'rb')
+                total = uos.stat(name)[6]
+                h = None
+                for m in ('uhashlib', 'hashlib'):
+                    try:
+                        h = __import__(m).sha256()
+                        break
+                    except (ImportError, AttributeError):
+                        pass
+                if not h:
+                    offset = 0
+                z = None
+                if compress:
+                    try:
+                        import deflate, io
+                        def z(b):
+                            s = io.BytesIO()
+                            d = deflate.DeflateIO(s, deflate.ZLIB, 10)
+                            d.write(b)
+                            d.close()
+                            return s.getvalue()
+                        z(b'x')
+                    except Exception:
+                        z = None
+                try:
+                    import uselect
+                    poll = uselect.poll()
+                    poll.register(sys.stdin, uselect.POLLIN)
+                except (ImportError, AttributeError):
+                    poll = None
+                out.write(b'S' + bytes((offset & 0xff, offset >> 8 & 0xff,
+                                        offset >> 16 & 0xff, offset >> 24)))
+                out.write(bytes((total & 0xff, total >> 8 & 0xff,
+                                 total >> 16 & 0xff, total >> 24)))
+                while True:
+                    try:
+                        buf = bytearray(size)
+                        break
+                    except MemoryError:
+                        size //= 2
+                buf = memoryview(buf)
+                while True:
+                    if poll and poll.poll(0):
+                        sys.stdin.buffer.read(1)
+                        f.close()
+                        out.write(b'C')
+                        return
+                    n = f.readinto(buf)
+                    if not n:
+                        break
+                    if h:
+                        h.update(buf[:n])
+                    if n > offset:
+                        data = buf[offset:n]
+                        tag = b'D'
+                        if z:
+                            c = z(data)
+                            if len(c) < len(data):
+                                data = c
+                                tag = b'Z'
+                        k = len(data)
+                        out.write(tag + bytes((k & 0xff, k >> 8)))
+                        out.write(data)
+                    offset = max(0, offset - n)
+                f.close()
+                digest = b''
+                if h:
+                    digest = __import__('ubinascii').hexlify(h.digest())
+                out.write(b'H' + bytes((len(digest), 0)) + digest)
+            send('{0}', {1}, {2}, {3})
+        """.format(filename, block_size, offset, self.compress)
+        expected = None
+        size = offset
+        started = time.monotonic()
+        received = 0
+        codec = None
+        total = None
+        cancel = None
+
+        def report(done):
+            nonlocal cancel
+            if progress and cancel is None:
+                try:
+                    progress(done, total)
+                except Exception as ex:
+                    # Ask the board to stop, and take what it has already
+                    # sent in the meantime.
+                    cancel = ex
+                    self._pyboard.serial.write(CANCEL_BYTE)
+
+        with self._raw_repl():
+            self._pyboard.exec_raw_no_follow(textwrap.dedent(command))
+            tag = self._pyboard.read_exact(1)
+            if tag == b'S':
+                header = self._pyboard.read_exact(8)
+                start, total = struct.unpack('<II', header)
+                if start != offset:
+                    # Start again from the beginning.
+                    dest.truncate(0)
+                    digest = hashlib.sha256()
+                    size = offset = start
+                report(size)
+                tag = self._pyboard.read_exact(1)
+            while tag in (b'D', b'Z', b'H'):
+                length = struct.unpack('<H', self._pyboard.read_exact(2))[0]
+                data = self._pyboard.read_exact(length)
+                received += 3 + length
+                if tag == b'H':
+                    expected = data.decode('ascii')
+                else:
+                    if tag == b'Z':
+                        data = zlib.decompress(data)
+                        codec = 'deflate'
+                    dest.write(data)
+                    digest.update(data)
+                    size += len(data)
+                    report(size)
+                tag = self._pyboard.read_exact(1)
+            if tag == b'C':
+                tag = self._pyboard.read_exact(1)
+            elif cancel is not None:
+                # The board finished without reading CANCEL_BYTE, so it is
+                # waiting in the raw REPL's line: Ctrl-C clears it.
+                self._pyboard.serial.write(b'\x03')
+            # The program has finished: collect the rest of what it printed.
+            if tag == b'\x04':
+                out = b''
+                err = self._pyboard.read_until(1, b'\x04')[:-1]
+            else:
+                out, err = self._pyboard.follow(10)
+                out = tag + out
+            if err:
+                message = err.decode('utf-8')
+                # Check if this is an OSError #2, i.e. file doesn't exist and
+                # rethrow it as something more descriptive.
+                if message.find('OSError: [Errno 2] ENOENT') != -1:
+                    raise RuntimeError('No such file: {0}'.format(filename))
+                # Boards without a binary stdout send the file as hex.
+                if size == offset and message.find('AttributeError') != -1:
+                    if offset:
+                        dest.truncate(0)
+                    return self._get_hex(filename, dest, block_size)
+                raise PyboardError('exception', out, err)
+        if cancel is not None:
+            raise cancel
+        if out or expected is None or \
+                (expected and expected != digest.hexdigest()):
+            raise RuntimeError('Download of {0} is corrupt'.format(filename))
+        self.last_transfer = TransferStats(filename, size - offset, received,
+                                           codec, time.monotonic() - started)
+        return size
+
+    def _get_agent(self, client, filename, dest, block_size, offset, digest,
+                   total, progress=None):
+        """Download a small file of total bytes through the agent, as
+        _get_stream does.
+        """
+        started = time.monotonic()
+        received = 0
+        if offset > total:
+            # Start again from the beginning.
+            dest.truncate(0)
+            digest = hashlib.sha256()
+            offset = 0
+        size = offset
+        if progress:
+            progress(size, total)
+        while size < total:
+            data = client.read(filename, size, block_size)
+            if not data:
+                break
+            received += 9 + len(data)
+            dest.write(data)
+            digest.update(data)
+            size += len(data)
+            if progress:
+                progress(size, total)
+        expected = client.hash(filename)
+        if size != total or (expected and expected != digest.hexdigest()):
+            raise RuntimeError('Download of {0} is corrupt'.format(filename))
+        self.last_transfer = TransferStats(filename, size - offset, received,
+                                           None, time.monotonic() - started)
+        return size
+
+    def _get_hex(self, filename, dest, block_size):
+        """Download the specified file to dest as lines of hex, for boards
+        which can't write binary data to stdout.
+        """
         command = """
-            import sys
+            import ubinascii
             with open('{0}', 'rb') as infile:
                 while True:
                     result = infile.read({1})
                     if result == b'':
                         break
-                    len = sys.stdout.write(result)
-        """.format(filename, BUFFER_SIZE)
-        self._pyboard.enter_raw_repl()
+                    print(ubinascii.hexlify(result).decode())
+        """.format(filename, block_size // 2)
+        size = 0
         try:
-            out = self._pyboard.exec_(textwrap.dedent(command))
+            for hexdata in self._exec_lines(command):
+                data = binascii.unhexlify(hexdata)
+                dest.write(data)
+                size += len(data)
         except PyboardError as ex:
-            # Check if this is an OSError #2, i.e. file doesn't exist and
-            # rethrow it as something more descriptive.
             if ex.args[2].decode('utf-8').find('OSError: [Errno 2] ENOENT') != -1:
                 raise RuntimeError('No such file: {0}'.format(filename))
-            else:
-                raise ex
-        self._pyboard.exit_raw_repl()
-        return out
+            raise ex
+        return size
+
+    def _exec_lines(self, command):
+        """Run the command and yield each line it prints as it arrives,
+        raising PyboardError at the end if it failed.
+        """
+        line = ''
+        err = []
+        for stream, text in self._pyboard.iter_exec(textwrap.dedent(command)):
+            if stream == 'stderr':
+                err.append(text)
+                continue
+            *lines, line = (line + text).split('\n')
+            for complete in lines:
+                yield complete.rstrip('\r')
+        if err:
+            raise PyboardError('exception', b'', ''.join(err).encode('utf-8'))
 
     def ls(self, directory='/'):
         """List the contents of the specified directory (or root if none is
@@ -88,46 +600,458 @@ class Files(object):
             import uos
             print(uos.listdir('{0}'))
         """.format(directory)
-        self._pyboard.enter_raw_repl()
+        client = self._agent_client()
         try:
-            out = self._pyboard.exec_(textwrap.dedent(command))
+            if client is not None:
+                return client.ls(directory)
+            with self._raw_repl():
+                out = self._pyboard.exec_(textwrap.dedent(command))
         except PyboardError as ex:
             # Check if this is an OSError #2, i.e. directory doesn't exist and
             # rethrow it as something more descriptive.
-            if ex.args[2].decode('utf-8').find('OSError: [Errno 2] ENOENT') != -1:
+            message = ex.args[2].decode('utf-8')
+            if message.find('OSError: [Errno 2] ENOENT') != -1:
                 raise RuntimeError('No such directory: {0}'.format(directory))
             else:
                 raise ex
-        self._pyboard.exit_raw_repl()
         # Parse the result list and return it.
         return ast.literal_eval(out.decode('utf-8'))
 
+    def walk(self, root='/'):
+        """Walk the whole tree below root on the board, yielding a FileInfo
+        tuple of (path, is_dir, size, mtime) for every file and directory in
+        it.  The board makes a single pass over the tree and entries are
+        yielded as they arrive, so even a big tree takes one round trip and
+        little memory at either end.  Directories are yielded before their
+        contents.
+        """
+        # Directories still to list are kept on a stack rather than
+        # recursing, so a deep tree doesn't exhaust the board's stack.
+        command = """
+            import uos
+            def walk(top):
+                stack = [top.rstrip('/')]
+                while stack:
+                    path = stack.pop()
+                    for name in uos.listdir(path or '/'):
+                        p = path + '/' + name
+                        st = uos.stat(p)
+                        d = st[0] & 0x4000
+                        print('%s\\t%d\\t%d\\t%s' % ('D' if d else 'F',
+                                                   st[6], st[8], p))
+                        if d:
+                            stack.append(p)
+            walk('{0}')
+        """.format(root)
+        with self._raw_repl():
+            try:
+                for line in self._exec_lines(command):
+                    kind, size, mtime, path = line.split('\t', 3)
+                    yield FileInfo(path, kind == 'D', int(size), int(mtime))
+            except PyboardError as ex:
+                # Check if this is an OSError #2, i.e. directory doesn't exist
+                # and rethrow it as something more descriptive.
+                message = ex.args[2].decode('utf-8')
+                if message.find('OSError: [Errno 2] ENOENT') != -1:
+                    raise RuntimeError('No such directory: {0}'.format(root))
+                else:
+                    raise ex
+
     def mkdir(self, directory):
         """Create the specified directory.  Note this cannot create a recursive
-        hierarchy of directories, instead each one should be created separately.
+        hierarchy of directories, use makedirs for that.
         """
+        self._usage = None
         # Execute os.mkdir command on the board.
         command = """
             import uos
             uos.mkdir('{0}')
         """.format(directory)
-        self._pyboard.enter_raw_repl()
+        client = self._agent_client()
         try:
-            out = self._pyboard.exec_(textwrap.dedent(command))
+            if client is not None:
+                client.mkdir(directory)
+            else:
+                with self._raw_repl():
+                    self._pyboard.exec_(textwrap.dedent(command))
         except PyboardError as ex:
             # Check if this is an OSError #17, i.e. directory already exists.
             if ex.args[2].decode('utf-8').find('OSError: [Errno 17] EEXIST') != -1:
                 raise DirectoryExistsError('Directory already exists: {0}'.format(directory))
             else:
                 raise ex
-        self._pyboard.exit_raw_repl()
 
-    def put(self, filename, data):
-        """Create or update the specified file with the provided data.
+    def makedirs(self, directory, exist_ok=True):
+        """Create the specified directory along with any of its parents which
+        don't exist yet, in a single command.  Returns the list of directories
+        which were created, parents first.  Raises DirectoryExistsError if the
+        directory already exists and exist_ok is False, or RuntimeError if a
+        file is in the way.
+        """
+        self._usage = None
+        # Each directory on the way is reported as created (+), already
+        # there (=) or a file (!), which stops it.
+        command = """
+            import uos
+            def makedirs(path):
+                p = ''
+                for name in path.split('/'):
+                    p += name
+                    if name:
+                        try:
+                            uos.mkdir(p)
+                            print('+' + p)
+                        except OSError as e:
+                            if e.args[0] != 17:
+                                raise
+                            if not uos.stat(p)[0] & 0x4000:
+                                print('!' + p)
+                                return
+                            print('=' + p)
+                    p += '/'
+            makedirs({0!r})
+        """.format(directory)
+        with self._raw_repl():
+            lines = list(self._exec_lines(command))
+        created = []
+        for line in lines:
+            if line.startswith('+'):
+                created.append(line[1:])
+            elif line.startswith('!'):
+                raise RuntimeError('Not a directory: {0}'.format(line[1:]))
+        if not created and not exist_ok:
+            raise DirectoryExistsError(
+                'Directory already exists: {0}'.format(directory))
+        return created
+
+    def put(self, filename, data, progress=None):
+        """Create or update the specified file with the provided data.  If
+        given, progress is called with the number of bytes written so far
+        and the size of the data as the upload goes on.  Any exception it
+        raises stops the upload (where the board allows, keeping what was
+        written for a later put of the same data to carry on from) and is
+        then raised.
+        """
+        self._put(filename, data, progress)
+
+    def _put(self, filename, data, progress=None):
+        if filename.endswith('.py'):
+            data = self._minify(filename, data)
+        # A successful upload brings the disk usage up to date again.
+        self._usage = None
+        if len(data) <= AGENT_TRANSFER_SIZE:
+            client = self._agent_client()
+            if client is not None:
+                self._put_agent(client, filename, data, progress)
+                return
+        with self._raw_repl():
+            if not self._put_stream(filename, data, progress):
+                # The board can't read binary data from stdin, so send the
+                # data as Python source instead.
+                self._put_batched(filename, data, progress)
+
+    def _put_stream(self, filename, data, progress=None):
+        """Upload data by running a small receiver on the board which reads
+        binary blocks from stdin and acknowledges each one, keeping a window
+        of blocks in flight.  The data goes to a temporary file which is only
+        renamed to filename once complete; if an earlier upload of the same
+        data was cut short, it carries on from the end of what the board
+        kept.  Returns False (before sending anything) if the board doesn't
+        support this.
         """
+        # The receiver first reports the size and hash of any earlier partial
+        # upload, which zlib decompressor it has, the block size, total and
+        # free blocks of the filesystem and the size of any file being
+        # replaced.  It is told to give up (X) if the data won't fit, or else
+        # whether to append to the partial upload (A) or start again (W),
+        # and whether the blocks will be compressed (Z) or not (R).  It then
+        # signals it is ready with a \x01 byte and sends another after each
+        # block.  Each block is preceded by its length and offset in the
+        # file, which must follow on from the previous block.  A block with
+        # no data ends the upload, or cancels it (keeping the partial upload)
+        # if its offset is CANCEL_OFFSET.  Ctrl-C is disabled while it runs,
+        # as the data may contain \x03 bytes, so where possible it gives up if
+        # the host goes quiet.  If a write fails the rest of the blocks are
+        # still read (and thrown away) so the raw REPL isn't left to
+        # interpret them, then the error is raised.
+        command = """
+            import sys, micropython, uos
+            def recv(name, part):
+                stdin = sys.stdin.buffer
+                intr = micropython.kbd_intr
+                size = 0
+                digest = '-'
+                try:
+                    size = uos.stat(part)[6]
+                    import ubinascii
+                    try:
+                        import uhashlib as hashlib
+                    except ImportError:
+                        import hashlib
+                    h = hashlib.sha256()
+                    buf = bytearray(256)
+                    with open(part, 'rb') as f:
+                        while True:
+                            n = f.readinto(buf)
+                            if not n:
+                                break
+                            h.update(buf[:n])
+                    digest = ubinascii.hexlify(h.digest()).decode()
+                except (OSError, ImportError, AttributeError):
+                    pass
+                codec = '-'
+                try:
+                    import deflate, io
+                    unz = lambda b: deflate.DeflateIO(
+                        io.BytesIO(b), deflate.ZLIB).read()
+                    codec = 'deflate'
+                except ImportError:
+                    for m in ('uzlib', 'zlib'):
+                        try:
+                            unz = __import__(m).decompress
+                            codec = m
+                            break
+                        except (ImportError, AttributeError):
+                            pass
+                try:
+                    s = uos.statvfs(name[:name.rfind('/') + 1] or '.')
+                    s = '%d %d %d' % (s[1], s[2], s[4])
+                except (AttributeError, OSError):
+                    s = '0 0 0'
+                try:
+                    old = uos.stat(name)[6]
+                except OSError:
+                    old = 0
+                try:
+                    import uselect
+                    poll = uselect.poll()
+                    poll.register(stdin, uselect.POLLIN)
+                except (ImportError, AttributeError):
+                    poll = None
+                def read(n):
+                    data = b''
+                    while len(data) < n:
+                        if poll and not poll.poll({timeout}):
+                            raise OSError(110)
+                        data += stdin.read(n - len(data))
+                    return data
+                f = None
+                error = None
+                cancelled = False
+                intr(-1)
+                try:
+                    print(size, digest, codec, s, old)
+                    mode = read(2)
+                    if mode[0] == 88:  # X
+                        return
+                    if mode[0] == 87:  # W
+                        size = 0
+                    z = mode[1] == 90  # Z
+                    f = open(part, 'ab' if size else 'wb')
+                    sys.stdout.write('\\x01')
+                    blocks = 0
+                    while True:
+                        n = read(6)
+                        offset = n[2] | n[3] << 8 | n[4] << 16 | n[5] << 24
+                        n = n[0] | n[1] << 8
+                        if not n:
+                            cancelled = offset == {cancel}
+                            break
+                        block = read(n)
+                        if error is None:
+                            try:
+                                if z:
+                                    block = unz(block)
+                                if offset != size:
+                                    raise ValueError(
+                                        'block at %d, expected %d' % (
+                                            offset, size))
+                                f.write(block)
+                                size += len(block)
+                                blocks += 1
+                                if not blocks % 16:
+                                    f.flush()
+                            except Exception as e:
+                                error = e
+                        sys.stdout.write('\\x01')
+                finally:
+                    intr(3)
+                    if f:
+                        f.close()
+                if error is not None:
+                    uos.remove(part)
+                    raise error
+                if cancelled:
+                    print(-1)
+                    return
+                try:
+                    uos.rename(part, name)
+                except OSError:
+                    uos.remove(name)
+                    uos.rename(part, name)
+                print(size)
+            recv('{0}', '{0}{1}')
+        """.format(filename, PARTIAL_SUFFIX, timeout=UPLOAD_TIMEOUT * 1000,
+                   cancel=CANCEL_OFFSET)
+        view = memoryview(data)
+        blocks = None
+        compress = False
+        ready = False
+        in_flight = collections.deque()  # where each unacknowledged block ends
+        cancel = None
+        start = time.monotonic()
+        sent = 0
+        info = ''
+        out = []
+        err = []
+        output = self._pyboard.iter_exec(textwrap.dedent(command),
+                                         chunk_size=1)
+        for stream, text in output:
+            if stream == 'stdout' and blocks is None:
+                info += text
+                if info.endswith('\n'):
+                    # Carry on from an earlier attempt if it sent the same
+                    # data as this one, as far as it got.
+                    size, digest, codec, *space = info.split()
+                    offset = int(size)
+                    if not 0 < offset <= len(data):
+                        offset = 0
+                    elif digest != hashlib.sha256(view[:offset]).hexdigest():
+                        offset = 0
+                    resumed = offset
+                    # Refuse before sending anything if the data won't fit,
+                    # as starting again frees what the partial upload took.
+                    space = [int(n) for n in space] or [0, 0, 0, 0]
+                    usage = DiskUsage(*space[:3])
+                    try:
+                        self._check_space(filename, usage, len(data), offset,
+                                          0 if offset else int(size))
+                    except NotEnoughSpaceError as ex:
+                        cancel = ex
+                        blocks = []
+                        self._pyboard.serial.write(b'XX')
+                        continue
+                    # Only compress if the board can decompress, and the data
+                    # (judging by its start) is worth compressing.
+                    block_size = UPLOAD_BLOCK_SIZE
+                    if self.compress and codec != '-':
+                        sample = view[offset:offset + COMPRESSED_BLOCK_SIZE]
+                        compress = len(_compress(sample)) < len(sample) * 0.9
+                    if compress:
+                        block_size = COMPRESSED_BLOCK_SIZE
+                    else:
+                        codec = None
+                    mode = b'A' if offset else b'W'
+                    mode += b'Z' if compress else b'R'
+                    self._pyboard.serial.write(mode)
+                    blocks = [(i, view[i:i + block_size])
+                              for i in range(offset, len(data), block_size)]
+                    # A zero length block marks the end.
+                    blocks.append((0, b''))
+                    blocks.reverse()
+            elif stream == 'stdout' and text == '\x01':
+                # Ready, or a block was acknowledged: send some more.
+                credit = 1 if ready else UPLOAD_WINDOW
+                done = in_flight.popleft() if ready else resumed
+                ready = True
+                if progress and cancel is None:
+                    try:
+                        progress(done, len(data))
+                    except Exception as ex:
+                        # Send nothing more but the cancelling block, and
+                        # let the board acknowledge what is in flight.
+                        cancel = ex
+                        blocks = [(CANCEL_OFFSET, b'')]
+                while credit and blocks:
+                    offset, block = blocks.pop()
+                    if block:
+                        in_flight.append(offset + len(block))
+                    if compress and block:
+                        block = _compress(block)
+                    header = struct.pack('<HI', len(block), offset)
+                    self._pyboard.serial.write(header)
+                    self._pyboard.serial.write(block)
+                    sent += 6 + len(block)
+                    credit -= 1
+            elif stream == 'stdout':
+                out.append(text)
+            else:
+                err.append(text)
+        out = ''.join(out)
+        err = ''.join(err)
+        if err:
+            unsupported = 'AttributeError' in err or 'ImportError' in err
+            if blocks is None and unsupported:
+                return False
+            raise PyboardError('exception', out.encode('utf-8'),
+                               err.encode('utf-8'))
+        if cancel is not None:
+            raise cancel
+        if int(out) != len(data):
+            raise RuntimeError(
+                'Upload of {0} failed: wrote {1} of {2} bytes'.format(
+                    filename, out.strip(), len(data)))
+        self.last_transfer = TransferStats(filename, len(data) - resumed, sent,
+                                           codec, time.monotonic() - start)
+        if self._sessions and usage.block_size:
+            # The partial upload and the file it replaced became the new one.
+            freed = usage.blocks_for(int(size)) + usage.blocks_for(space[3])
+            free_blocks = usage.free_blocks + freed
+            self._usage = usage._replace(
+                free_blocks=free_blocks - usage.blocks_for(len(data)))
+        return True
+
+    def _put_agent(self, client, filename, data, progress=None):
+        """Upload a small file through the agent, checking first that it
+        will fit.  As with _put_stream, the data goes to a temporary file
+        which is only renamed to filename once complete.
+        """
+        started = time.monotonic()
+        space = ast.literal_eval(client.exec_('df({0!r})'.format(filename)))
+        usage = DiskUsage(*space[:3])
+        # The file being replaced is only removed once the new one is
+        # complete.
+        self._check_space(filename, usage, len(data))
+        part = filename + PARTIAL_SUFFIX
+        sent = 0
+        try:
+            if progress:
+                progress(0, len(data))
+            # An empty file still needs writing.
+            for offset in range(0, len(data), UPLOAD_BLOCK_SIZE) or [0]:
+                block = data[offset:offset + UPLOAD_BLOCK_SIZE]
+                client.write(part, block, append=offset > 0)
+                sent += 11 + len(part) + len(block)
+                if progress:
+                    progress(offset + len(block), len(data))
+            client.exec_('rename({0!r}, {1!r})'.format(part, filename))
+        except BaseException:
+            # Unlike a streamed upload this one isn't resumed, so don't
+            # leave the partial file taking up space.
+            if client.running:
+                try:
+                    client.rm(part)
+                except PyboardError:
+                    pass
+            raise
+        self.last_transfer = TransferStats(filename, len(data), sent, None,
+                                           time.monotonic() - started)
+        if self._sessions and usage.block_size:
+            free_blocks = usage.free_blocks + usage.blocks_for(space[3])
+            self._usage = usage._replace(
+                free_blocks=free_blocks - usage.blocks_for(len(data)))
+
+    def _put_batched(self, filename, data, progress=None):
+        """Upload data as Python source, for boards which can't read binary
+        data from stdin.  Progress is reported after each batch; if it raises
+        the file is closed, leaving what was written so far.
+        """
+        usage, old_size = self._statvfs(filename)
+        self._check_space(filename, usage, len(data), freed=old_size)
         # Open the file for writing on the board and write chunks of data.
-        self._pyboard.enter_raw_repl()
-        self._pyboard.exec_("f = open('{0}', 'wb')".format(filename))
+        # The commands are sent in batches, so a small file is a single round
+        # trip while a large one never needs much memory on the board.
+        commands = ["f = open('{0}', 'wb')".format(filename)]
         size = len(data)
         # Loop through and write a buffer size chunk of data at a time.
         for i in range(0, size, BUFFER_SIZE):
@@ -136,19 +1060,51 @@ class Files(object):
             # Make sure to send explicit byte strings (handles python 2 compatibility).
             if not chunk.startswith('b'):
                 chunk = 'b' + chunk
-            self._pyboard.exec_("f.write({0})".format(chunk))
-        self._pyboard.exec_('f.close()')
-        self._pyboard.exit_raw_repl()
+            commands.append("f.write({0})".format(chunk))
+        commands.append('f.close()')
+        for i in range(0, len(commands), BATCH_SIZE):
+            self._pyboard.exec_batch(commands[i:i + BATCH_SIZE])
+            if progress and i + BATCH_SIZE < len(commands):
+                try:
+                    # Every command but the first writes a chunk.
+                    done = (i + BATCH_SIZE - 1) * BUFFER_SIZE
+                    progress(min(done, size), size)
+                except Exception:
+                    self._pyboard.exec_('f.close()')
+                    raise
+        if progress:
+            progress(size, size)
+
+    def _minify(self, name, source):
+        """Return the source minified if minify is True, keeping its line map
+        under name, the file name the board's tracebacks give it.  Source
+        which isn't valid Python is left for the board to report on.
+        """
+        name = name.lstrip('/')
+        line_maps.pop(name, None)
+        if not self.minify:
+            return source
+        try:
+            result = minify_source(source, self.rename_locals)
+        except (SyntaxError, ValueError):
+            return source
+        line_maps[name] = result.line_map
+        return result.source.encode('utf-8')
 
     def rm(self, filename):
         """Remove the specified file or directory."""
+        self._usage = None
         command = """
             import uos
             uos.remove('{0}')
         """.format(filename)
-        self._pyboard.enter_raw_repl()
+        client = self._agent_client()
         try:
-            out = self._pyboard.exec_(textwrap.dedent(command))
+            if client is not None:
+                client.rm(filename)
+            else:
+                with self._raw_repl():
+                    self._pyboard.exec_(textwrap.dedent(command))
         except PyboardError as ex:
             message = ex.args[2].decode('utf-8')
             # Check if this is an OSError #2, i.e. file/directory doesn't exist
@@ -160,61 +1116,486 @@ class Files(object):
                 raise RuntimeError('Directory is not empty: {0}'.format(filename))
             else:
                 raise ex
-        self._pyboard.exit_raw_repl()
+
+    def rm_many(self, paths, recursive=False):
+        """Remove each of the specified files and directories in a single
+        command.  Directories must be empty unless recursive is True, when
+        everything in them is removed too.  Unlike rm, a path which can't be
+        removed doesn't stop the others: returns a dict mapping each path to
+        None if it was removed, or else a message saying why not.
+        """
+        self._usage = None
+        paths = list(paths)
+        status = dict((path, None) for path in paths)
+        if not paths:
+            return status
+        # Only the paths which couldn't be removed are reported, by their
+        # index in the list, along with the error number.
+        command = """
+            def rm_many(paths, recursive):
+                for i, p in enumerate(paths):
+                    try:
+                        if not uos.stat(p)[0] & 0x4000:
+                            uos.remove(p)
+                        elif recursive:
+                            rmtree(p)
+                        else:
+                            uos.rmdir(p)
+                    except OSError as e:
+                        print('%d %d' % (i, e.args[0]))
+            rm_many({0!r}, {1!r})
+        """.format(paths, recursive)
+        with self._raw_repl():
+            program = 'import uos\n' + _RMTREE + textwrap.dedent(command)
+            lines = list(self._exec_lines(program))
+        messages = {
+            2: 'No such file/directory',
+            13: 'Directory is not empty',
+            39: 'Directory is not empty',
+        }
+        for line in lines:
+            index, errno = (int(n) for n in line.split())
+            status[paths[index]] = messages.get(
+                errno, 'OSError: [Errno {0}]'.format(errno))
+        return status
 
     def rmdir(self, directory):
         """Forcefully remove the specified directory and all its children."""
-        # Build a script to walk an entire directory structure and delete every
-        # file and subfolder.  This is tricky because MicroPython has no os.walk
-        # or similar function to walk folders, so this code does it manually
-        # with recursion and changing directories.  For each directory it lists
-        # the files and deletes everything it can, i.e. all the files.  Then
-        # it lists the files again and assumes they are directories (since they
-        # couldn't be deleted in the first pass) and recursively clears those
-        # subdirectories.  Finally when finished clearing all the children the
-        # parent directory is deleted.
+        self._usage = None
+        # MicroPython has no os.walk or shutil.rmtree, so _RMTREE does it by
+        # hand: it lists every directory in the tree, removing the files it
+        # finds on the way, then removes the directories deepest first.
         command = """
-            import uos
-            def rmdir(directory):
-                uos.chdir(directory)
-                for f in uos.listdir():
-                    try:
-                        uos.remove(f)
-                    except OSError:
-                        pass
-                for f in uos.listdir():
-                    rmdir(f)
-                uos.chdir('..')
-                uos.rmdir(directory)
-            rmdir('{0}')
+            rmtree({0!r})
         """.format(directory)
-        self._pyboard.enter_raw_repl()
-        try:
-            out = self._pyboard.exec_(textwrap.dedent(command))
-        except PyboardError as ex:
-            message = ex.args[2].decode('utf-8')
-            # Check if this is an OSError #2, i.e. directory doesn't exist
-            # and rethrow it as something more descriptive.
-            if message.find('OSError: [Errno 2] ENOENT') != -1:
-                raise RuntimeError('No such directory: {0}'.format(directory))
-            else:
-                raise ex
-        self._pyboard.exit_raw_repl()
+        with self._raw_repl():
+            try:
+                program = 'import uos\n' + _RMTREE + textwrap.dedent(command)
+                self._pyboard.exec_(program)
+            except PyboardError as ex:
+                message = ex.args[2].decode('utf-8')
+                # Check if this is an OSError #2, i.e. directory doesn't exist
+                # and rethrow it as something more descriptive.
+                if message.find('OSError: [Errno 2] ENOENT') != -1:
+                    raise RuntimeError(
+                        'No such directory: {0}'.format(directory))
+                else:
+                    raise ex
 
     def run(self, filename, wait_output=True):
         """Run the provided script and return its output.  If wait_output is True
         (default) then wait for the script to finish and then print its output,
-        otherwise just run the script and don't wait for any output.
+        otherwise just run the script and don't wait for any output.  Note
+        that a script which is not waited for keeps the board busy, so it
+        should be the last command of a session.
         """
-        self._pyboard.enter_raw_repl()
+        self._usage = None
         out = None
-        if wait_output:
-            # Run the file and wait for output to return.
-            out = self._pyboard.execfile(filename)
-        else:
-            # Read the file and run it using lower level pyboard functions that
-            # won't wait for it to finish or return output.
-            with open(filename, 'rb') as infile:
-                self._pyboard.exec_raw_no_follow(infile.read())
-        self._pyboard.exit_raw_repl()
+        with open(filename, 'rb') as infile:
+            # The board calls a script it is sent <stdin>.
+            source = self._minify('<stdin>', infile.read())
+        with self._raw_repl():
+            if wait_output:
+                # Run the file and wait for output to return.
+                try:
+                    out = self._pyboard.exec_(source)
+                except PyboardError as ex:
+                    if len(ex.args) < 3:
+                        raise
+                    raise PyboardError(ex.args[0], ex.args[1],
+                                       map_traceback(ex.args[2]))
+            else:
+                # Run it using lower level pyboard functions that won't wait
+                # for it to finish or return output.
+                self._pyboard.exec_raw_no_follow(source)
         return out
+
+    def sync(self, local_dir, remote_dir='/', dry_run=False, delete=True):
+        """Make remote_dir on the board a copy of local_dir, transferring only
+        what differs.  The board hashes its files in a single pass, using the
+        hashes in a manifest left by the last sync for files whose size and
+        modification time haven't changed since, and these are compared with
+        hashes of the local files.  Remote files and directories which don't
+        exist locally are removed unless delete is False.
+
+        Returns a list of (action, path) tuples, where action is one of
+        'rm', 'rmdir', 'mkdir' or 'put' and path is relative to remote_dir.
+        If dry_run is True nothing is changed and the list says what would
+        be done.  Otherwise NotEnoughSpaceError is raised, before anything is
+        changed, if the board hasn't room for the files to upload.
+        """
+        local_dirs, local_files = self._scan_local(local_dir)
+        with self._raw_repl():
+            exists, remote_dirs, remote_files, remote_sizes = \
+                self._scan_remote(remote_dir)
+            actions = []
+            if delete:
+                actions += [('rm', path) for path in sorted(remote_files)
+                            if path not in local_files]
+                actions += [('rmdir', path)
+                            for path in sorted(remote_dirs, reverse=True)
+                            if path not in local_dirs]
+            if not exists:
+                actions.append(('mkdir', ''))
+            actions += [('mkdir', path) for path in sorted(local_dirs)
+                        if path not in remote_dirs]
+            actions += [('put', path)
+                        for path, digest in sorted(local_files.items())
+                        if remote_files.get(path) != digest]
+            if dry_run:
+                return actions
+            self._check_sync_space(local_dir, remote_dir, actions,
+                                   remote_sizes)
+            self._usage = None
+            commands = ['import uos']
+            for action, path in actions:
+                target = self._remote_path(remote_dir, path)
+                if action == 'rm':
+                    commands.append('uos.remove({0!r})'.format(target))
+                elif action == 'rmdir':
+                    commands.append('uos.rmdir({0!r})'.format(target))
+                elif action == 'mkdir':
+                    commands.append('uos.mkdir({0!r})'.format(target))
+            if len(commands) > 1:
+                self._pyboard.exec_batch(commands)
+            for action, path in actions:
+                if action == 'put':
+                    local = os.path.join(local_dir, *path.split('/'))
+                    with open(local, 'rb') as infile:
+                        self._put(self._remote_path(remote_dir, path),
+                                  infile.read())
+            if actions or not exists:
+                self._write_manifest(remote_dir, local_files)
+        return actions
+
+    def _check_sync_space(self, local_dir, remote_dir, actions, remote_sizes):
+        """Raise NotEnoughSpaceError if carrying out the actions of a sync in
+        order would fill the board up, given the sizes of its files.
+        """
+        if not any(action == 'put' for action, path in actions):
+            return
+        usage = self.df()
+        if not usage.block_size:
+            return
+        free = usage.free_blocks
+        for action, path in actions:
+            if action == 'rm':
+                free += usage.blocks_for(remote_sizes.get(path, 0))
+            elif action == 'mkdir':
+                free -= 1
+            elif action == 'put':
+                local_path = os.path.join(local_dir, *path.split('/'))
+                size = os.path.getsize(local_path)
+                # The file being replaced is only removed once the new one
+                # is complete.
+                self._check_space(self._remote_path(remote_dir, path),
+                                  usage._replace(free_blocks=free), size)
+                free -= usage.blocks_for(size) - \
+                    usage.blocks_for(remote_sizes.get(path, 0))
+
+    def _scan_local(self, local_dir):
+        """Return the set of directories and a dict of files (mapped to the
+        hex SHA256 of their contents) below local_dir, with paths relative
+        to it and separated by '/'.  Hidden files and __pycache__ are skipped.
+        Hashes are cached for files which haven't changed since last time.
+        """
+        dirs = set()
+        found = {}
+        for root, dirnames, filenames in os.walk(local_dir):
+            dirnames[:] = [d for d in dirnames
+                           if not d.startswith('.') and d != '__pycache__']
+            rel = os.path.relpath(root, local_dir).replace(os.sep, '/')
+            prefix = '' if rel == '.' else rel + '/'
+            for name in dirnames:
+                dirs.add(prefix + name)
+            for name in filenames:
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(root, name)
+                st = os.stat(path)
+                key = (st.st_size, st.st_mtime_ns)
+                cached = self._local_hashes.get(path)
+                if cached is None or cached[0] != key:
+                    digest = hashlib.sha256()
+                    with open(path, 'rb') as infile:
+                        for block in iter(lambda: infile.read(65536), b''):
+                            digest.update(block)
+                    cached = (key, digest.hexdigest())
+                    self._local_hashes[path] = cached
+                found[prefix + name] = cached[1]
+        return dirs, found
+
+    def _scan_remote(self, remote_dir):
+        """Return whether remote_dir exists on the board, the set of
+        directories in it, a dict of its files mapped to their hashes (or
+        None if the board can't hash) and a dict of their sizes, all in a
+        single pass on the board.
+        """
+        # Each line is D<tab>path or F<tab>hash<tab>size<tab>path; the
+        # manifest holds [size, mtime, hash] for each path and is written by
+        # _write_manifest.  Directories still to scan are kept on a stack, as
+        # in walk, so a deep tree doesn't exhaust the board's stack.
+        command = """
+            import uos, ubinascii
+            def scan(root, manifest):
+                try:
+                    uos.stat(root)
+                except OSError:
+                    return
+                print('R')
+                root = root.rstrip('/')
+                try:
+                    import ujson
+                    with open(root + '/' + manifest) as f:
+                        known = ujson.load(f)
+                except Exception:
+                    known = {{}}
+                sha256 = None
+                for m in ('uhashlib', 'hashlib'):
+                    try:
+                        sha256 = __import__(m).sha256
+                        break
+                    except (ImportError, AttributeError):
+                        pass
+                buf = bytearray(256)
+                stack = [(root, '')]
+                while stack:
+                    path, rel = stack.pop()
+                    for name in uos.listdir(path or '/'):
+                        p = path + '/' + name
+                        st = uos.stat(p)
+                        if st[0] & 0x4000:
+                            print('D\\t' + rel + name)
+                            stack.append((p, rel + name + '/'))
+                            continue
+                        if rel + name == manifest:
+                            continue
+                        k = known.get(rel + name)
+                        if k and k[0] == st[6] and k[1] == st[8]:
+                            digest = k[2]
+                        elif sha256:
+                            h = sha256()
+                            with open(p, 'rb') as f:
+                                while True:
+                                    n = f.readinto(buf)
+                                    if not n:
+                                        break
+                                    h.update(buf[:n])
+                            digest = ubinascii.hexlify(h.digest()).decode()
+                        else:
+                            digest = '-'
+                        print('F\\t%s\\t%d\\t%s' % (digest, st[6],
+                                                   rel + name))
+            scan({0!r}, {1!r})
+        """.format(remote_dir, MANIFEST_NAME)
+        exists = False
+        dirs = set()
+        found = {}
+        sizes = {}
+        for line in self._exec_lines(command):
+            if line == 'R':
+                exists = True
+            elif line.startswith('D\t'):
+                dirs.add(line[2:])
+            elif line.startswith('F\t'):
+                digest, size, path = line[2:].split('\t', 2)
+                found[path] = None if digest == '-' else digest
+                sizes[path] = int(size)
+        return exists, dirs, found, sizes
+
+    def _write_manifest(self, remote_dir, hashes):
+        """Record the hash of every file in remote_dir, along with its size
+        and modification time on the board, for the next sync.
+        """
+        command = """
+            import uos, ujson
+            def manifest(root, name, hashes):
+                known = {{}}
+                for path, digest in hashes.items():
+                    st = uos.stat(root + '/' + path)
+                    known[path] = [st[6], st[8], digest]
+                with open(root + '/' + name, 'w') as f:
+                    ujson.dump(known, f)
+            manifest({0!r}, {1!r}, {2!r})
+        """.format(remote_dir.rstrip('/'), MANIFEST_NAME, hashes)
+        # Uploads may have started the agent.
+        with self._raw_repl():
+            self._pyboard.exec_(textwrap.dedent(command))
+
+    @staticmethod
+    def _remote_path(remote_dir, path):
+        """Return the full path on the board of path within remote_dir."""
+        return (remote_dir.rstrip('/') + '/' + path).rstrip('/') or '/'
+
+
+# Directory listings of each board CachedFiles has talked to, by the board's
+# machine.unique_id(), so they outlive any one connection.
+_board_caches = {}
+
+
+class BoardCache(object):
+    """The last known state of a board's filesystem: the fingerprint it had
+    and the listings of the directories seen since.
+    """
+
+    def __init__(self):
+        self.fingerprint = None
+        self.listings = {}
+
+
+def _normpath(path):
+    """Return path as an absolute path on the board without a trailing /."""
+    return '/' + path.strip('/')
+
+
+class CachedFiles(Files):
+    """Files which remembers directory listings between calls (and between
+    connections to the same board).  A listing is only fetched again when
+    the board's fingerprint, its free space together with the size and
+    modification time of everything in its root, has changed since it was
+    cached.  Changes made through this class update the cache as they go.
+    """
+
+    def __init__(self, pyboard):
+        super(CachedFiles, self).__init__(pyboard)
+        self.board_id = None
+
+    @property
+    def cache(self):
+        """The BoardCache of the board, or None before it is identified."""
+        if self.board_id is None:
+            return None
+        return _board_caches.setdefault(self.board_id, BoardCache())
+
+    def cached_ls(self, directory='/'):
+        """Return the last known listing of directory without asking the
+        board, or None if it isn't known.  This can be shown straight away
+        while ls revalidates it.
+        """
+        if self.cache is None:
+            return None
+        listing = self.cache.listings.get(_normpath(directory))
+        return None if listing is None else list(listing)
+
+    def ls(self, directory='/'):
+        """List the contents of the specified directory, as Files.ls does,
+        from the cache if the board hasn't changed since.
+        """
+        directory = _normpath(directory)
+        while True:
+            known = ''
+            if self.cache is not None and directory in self.cache.listings:
+                known = self.cache.fingerprint
+            with self._raw_repl():
+                try:
+                    fingerprint, listing = self._fetch(known, directory)
+                except PyboardError as ex:
+                    # Check if this is an OSError #2, i.e. directory doesn't
+                    # exist and rethrow it as something more descriptive.
+                    message = ex.args[2].decode('utf-8')
+                    if message.find('OSError: [Errno 2] ENOENT') != -1:
+                        raise RuntimeError(
+                            'No such directory: {0}'.format(directory))
+                    else:
+                        raise ex
+            cache = self.cache
+            if fingerprint != cache.fingerprint:
+                cache.listings.clear()
+                cache.fingerprint = fingerprint
+            if listing is not None:
+                cache.listings[directory] = listing
+            # The listing is only missing if the fingerprint was checked
+            # against that of another board, so try again.
+            if directory in cache.listings:
+                return list(cache.listings[directory])
+
+    def put(self, filename, data, progress=None):
+        super(CachedFiles, self).put(filename, data, progress)
+        self._changed([filename], added=True)
+
+    def mkdir(self, directory):
+        super(CachedFiles, self).mkdir(directory)
+        self._changed([directory], added=True, is_dir=True)
+
+    def makedirs(self, directory, exist_ok=True):
+        created = super(CachedFiles, self).makedirs(directory, exist_ok)
+        if created:
+            self._changed(created, added=True, is_dir=True)
+        return created
+
+    def rm(self, filename):
+        super(CachedFiles, self).rm(filename)
+        self._changed([filename], added=False)
+
+    def rm_many(self, paths, recursive=False):
+        status = super(CachedFiles, self).rm_many(paths, recursive)
+        removed = [path for path, error in status.items() if error is None]
+        if removed:
+            self._changed(removed, added=False)
+        return status
+
+    def rmdir(self, directory):
+        super(CachedFiles, self).rmdir(directory)
+        self._changed([directory], added=False)
+
+    def sync(self, local_dir, remote_dir='/', dry_run=False, delete=True):
+        actions = super(CachedFiles, self).sync(local_dir, remote_dir,
+                                                dry_run, delete)
+        if actions and not dry_run and self.cache is not None:
+            # Too much may have changed to follow, so start again.
+            self.cache.listings.clear()
+        return actions
+
+    def _fetch(self, known, directory=None):
+        """Identify the board and return its fingerprint, along with the
+        listing of directory if one is given and the fingerprint isn't the
+        known one (otherwise None), in a single command.
+        """
+        command = """
+            import uos
+            def check(known, directory):
+                try:
+                    import machine, ubinascii
+                    print(ubinascii.hexlify(machine.unique_id()).decode())
+                except (ImportError, AttributeError):
+                    print('unknown')
+                s = uos.statvfs('/')
+                fingerprint = [s[3]]
+                for name in uos.listdir('/'):
+                    st = uos.stat('/' + name)
+                    fingerprint.append((name, st[6], st[8]))
+                fingerprint = repr(fingerprint)
+                print(fingerprint)
+                if directory and fingerprint != known:
+                    print(uos.listdir(directory))
+            check({0!r}, {1!r})
+        """.format(known, directory)
+        out = self._pyboard.exec_(textwrap.dedent(command))
+        lines = out.decode('utf-8').splitlines()
+        self.board_id = lines[0]
+        listing = ast.literal_eval(lines[2]) if len(lines) > 2 else None
+        return lines[1], listing
+
+    def _changed(self, paths, added, is_dir=False):
+        """Update the cached listings after paths were added (or removed), in
+        order, and take the board's new fingerprint, as the changes were our
+        own.
+        """
+        with self._raw_repl():
+            fingerprint, listing = self._fetch('')
+        cache = self.cache
+        for path in paths:
+            path = _normpath(path)
+            parent, name = path.rsplit('/', 1)
+            listing = cache.listings.get(parent or '/')
+            if listing is not None:
+                if added and name not in listing:
+                    listing.append(name)
+                elif not added and name in listing:
+                    listing.remove(name)
+            for directory in list(cache.listings):
+                if directory == path or directory.startswith(path + '/'):
+                    del cache.listings[directory]
+            if is_dir:
+                cache.listings[path] = []
+        cache.fingerprint = fingerprint
@@ -0,0 +1,292 @@
+"""
+Shrink Python source before it is sent to a board.
+
+minify strips comments, docstrings and blank lines, indents each block by a
+single space and joins statements split over several lines, optionally also
+renaming local variables to short names.  This saves serial time and the
+board's flash and RAM, at the cost of line numbers in the board's tracebacks,
+so it also returns a line map: for each line of the minified source, the line
+of the original it came from.
+
+Line maps are kept in line_maps by the name tracebacks give the script (e.g.
+'main.py', or '<stdin>' for a script which is run rather than uploaded), and
+map_traceback and TracebackMapper rewrite tracebacks to use the original line
+numbers again:
+
+    result = minify(source)
+    line_maps['main.py'] = result.line_map
+    print(map_traceback(output))
+"""
+import ast
+import builtins
+import collections
+import io
+import itertools
+import keyword
+import re
+import string
+import tokenize
+
+
+#: The line maps of scripts minified onto a board, by the file name its
+#: tracebacks give them (without a leading /).
+line_maps = {}
+
+Minified = collections.namedtuple('Minified', 'source line_map')
+
+_TRACEBACK_LINE = re.compile(rb'(File "([^"]*)", line )(\d+)')
+_TRACEBACK_PREFIX = b'  File "'
+# Functions which look at local variables by name.
+_INTROSPECTION = {'dir', 'eval', 'exec', 'locals', 'vars'}
+_SCOPES = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Lambda)
+_COMPREHENSIONS = (ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)
+
+
+def minify(source, rename_locals=False):
+    """Return a Minified tuple of the minified source (text or UTF-8 bytes)
+    and its line map.  Local variables of functions are renamed if
+    rename_locals is True; a function's parameters, and everything in a
+    function which defines others or could look its variables up by name,
+    are left alone.  Raises SyntaxError if the source isn't valid Python.
+    """
+    if isinstance(source, bytes):
+        source = source.decode('utf-8')
+    tree = ast.parse(source)
+    tokens = _tokenize(source)
+    docstrings = {}
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Module, ast.ClassDef, ast.FunctionDef,
+                             ast.AsyncFunctionDef)) and _docstring(node):
+            expr = node.body[0]
+            # A body which is only a docstring still needs a statement.
+            docstrings[(expr.lineno, expr.col_offset)] = (
+                (expr.end_lineno, expr.end_col_offset),
+                len(node.body) == 1 and not isinstance(node, ast.Module))
+    renames = _local_renames(tree, tokens, source) if rename_locals else {}
+    lines = []
+    line_map = []
+    depth = 0
+    words = []
+    rows = []
+    prev = None
+    skip_until = None
+    for tok in tokens:
+        if skip_until is not None:
+            if tok.end <= skip_until:
+                continue
+            skip_until = None
+            if tok.string == ';':
+                continue
+        if tok.type == tokenize.INDENT:
+            depth += 1
+        elif tok.type == tokenize.DEDENT:
+            depth -= 1
+        elif tok.type == tokenize.NEWLINE:
+            if words:
+                text = ''.join(words).rstrip(';')
+                lines.append(' ' * depth + text)
+                line_map.extend(rows)
+            words = []
+            rows = []
+        elif tok.type in (tokenize.COMMENT, tokenize.NL,
+                          tokenize.ENDMARKER):
+            continue
+        elif tok.start in docstrings:
+            skip_until, replace = docstrings[tok.start]
+            if replace:
+                words.append('pass')
+                rows.append(tok.start[0])
+        else:
+            text = renames.get(tok.start, tok.string)
+            if not words:
+                rows.append(tok.start[0])
+            elif _needs_space(prev, words[-1], text):
+                words.append(' ')
+            words.append(text)
+            prev = tok
+            # A string spanning lines carries them into the minified source.
+            rows.extend(range(tok.start[0] + 1,
+                              tok.start[0] + 1 + text.count('\n')))
+    if lines:
+        lines.append('')
+    return Minified('\n'.join(lines), line_map)
+
+
+def _tokenize(source):
+    """Return the tokens of source, with each f-string as a single STRING
+    token (as it is before Python 3.12) so it is copied as it is.
+    """
+    tokens = list(tokenize.generate_tokens(io.StringIO(source).readline))
+    if not hasattr(tokenize, 'FSTRING_START'):
+        return tokens
+    lines = source.splitlines(True)
+    result = []
+    nested = 0
+    for tok in tokens:
+        if tok.type == tokenize.FSTRING_START:
+            if not nested:
+                start = tok.start
+            nested += 1
+        elif tok.type == tokenize.FSTRING_END:
+            nested -= 1
+            if not nested:
+                text = ''.join(lines[start[0] - 1:tok.end[0]])
+                offset = len(text) - len(lines[tok.end[0] - 1])
+                text = text[start[1]:offset + tok.end[1]]
+                result.append(tokenize.TokenInfo(
+                    tokenize.STRING, text, start, tok.end, tok.line))
+        elif not nested:
+            result.append(tok)
+    return result
+
+
+def _docstring(node):
+    """Return whether the first statement of node's body is a docstring."""
+    first = node.body[0] if node.body else None
+    return isinstance(first, ast.Expr) and \
+        isinstance(first.value, ast.Constant) and \
+        isinstance(first.value.value, str)
+
+
+def _needs_space(prev, before, after):
+    """Return whether the text after must be kept apart from the text before
+    (which came from the token prev).
+    """
+    word = string.ascii_letters + string.digits + '_'
+    if (before[-1] in word or not before[-1].isascii()) and \
+            (after[0] in word + '"\'' or not after[0].isascii()):
+        return True
+    # '' 'x' isn't '''x'.
+    if before[-1] in '"\'' and after[0] in '"\'':
+        return True
+    # 1 .real isn't 1.real.
+    return prev.type == tokenize.NUMBER and after[0] == '.'
+
+
+def _local_renames(tree, tokens, source):
+    """Return a dict of the new names of local variables, by the position of
+    each token which refers to one.
+    """
+    taken = set(keyword.kwlist) | set(dir(builtins))
+    taken.update(tok.string for tok in tokens if tok.type == tokenize.NAME)
+    short = [name for name in _short_names() if name not in taken]
+    lines = source.splitlines()
+
+    def position(lineno, col_offset):
+        # The AST counts columns in UTF-8 bytes, tokenize in characters.
+        line = lines[lineno - 1].encode('utf-8')
+        return lineno, len(line[:col_offset].decode('utf-8'))
+
+    renames = {}
+    for node in ast.walk(tree):
+        if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            continue
+        names = _locals(node)
+        new = dict((old, new) for old, new in zip(sorted(names), short)
+                   if len(new) < len(old))
+        handlers = []
+        for child in ast.walk(node):
+            if isinstance(child, ast.Name) and child.id in new:
+                renames[position(child.lineno, child.col_offset)] = \
+                    new[child.id]
+            elif isinstance(child, ast.ExceptHandler) and child.name in new:
+                handlers.append(child)
+        for handler in handlers:
+            # The name isn't a node of its own: it follows the first 'as'.
+            start = position(handler.lineno, handler.col_offset)
+            after = [tok for tok in tokens if tok.start > start]
+            for prev, tok in zip(after, after[1:]):
+                if prev.string == 'as':
+                    renames[tok.start] = new[handler.name]
+                    break
+    return renames
+
+
+def _locals(function):
+    """Return the names of the local variables of the function which can be
+    safely renamed, or an empty set if none can.
+    """
+    names = set()
+    params = set()
+    args = function.args
+    for arg in args.posonlyargs + args.args + args.kwonlyargs + \
+            [args.vararg, args.kwarg]:
+        if arg is not None:
+            params.add(arg.arg)
+    imported = set()
+    stack = list(function.body)
+    while stack:
+        node = stack.pop()
+        if isinstance(node, _SCOPES + (ast.Global, ast.Nonlocal,
+                                       ast.JoinedStr)):
+            return set()
+        if isinstance(node, ast.Call) and \
+                isinstance(node.func, ast.Name) and \
+                node.func.id in _INTROSPECTION:
+            return set()
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            imported.update((alias.asname or alias.name).split('.')[0]
+                            for alias in node.names)
+        elif isinstance(node, ast.Name) and \
+                isinstance(node.ctx, (ast.Store, ast.Del)):
+            names.add(node.id)
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            names.add(node.name)
+        if isinstance(node, _COMPREHENSIONS):
+            # Their variables belong to them, not to the function.
+            for generator in node.generators:
+                stack.append(generator.iter)
+            continue
+        stack.extend(ast.iter_child_nodes(node))
+    return names - params - imported
+
+
+def _short_names():
+    """Yield a, b, ... z, then aa, ab ... zz."""
+    for size in (1, 2):
+        for letters in itertools.product(string.ascii_lowercase, repeat=size):
+            yield ''.join(letters)
+
+
+def map_traceback(text, maps=None):
+    """Return the traceback text (bytes or str) with line numbers in
+    minified scripts replaced by those in the original.
+    """
+    if isinstance(text, str):
+        return map_traceback(text.encode('utf-8'), maps).decode('utf-8')
+    maps = line_maps if maps is None else maps
+
+    def original(match):
+        line_map = maps.get(match.group(2).decode('utf-8').lstrip('/'))
+        number = int(match.group(3))
+        if line_map is None or not 0 < number <= len(line_map):
+            return match.group(0)
+        return match.group(1) + str(line_map[number - 1]).encode('ascii')
+
+    return _TRACEBACK_LINE.sub(original, text)
+
+
+class TracebackMapper(object):
+    """Rewrite tracebacks in output from a board as it arrives (see
+    map_traceback).  Output is passed straight on, except that the start of
+    a line which may be a traceback's is held back until its line number has
+    arrived (i.e. the end of the line).
+    """
+
+    def __init__(self, maps=None):
+        self.maps = line_maps if maps is None else maps
+        self._pending = b''
+
+    def feed(self, data):
+        """Return the data to show now that data has arrived."""
+        data = self._pending + data
+        self._pending = b''
+        if not self.maps:
+            return data
+        start = data.rfind(b'\n') + 1
+        tail = data[start:]
+        partial = _TRACEBACK_PREFIX.startswith(tail)
+        if tail and (partial or tail.startswith(_TRACEBACK_PREFIX)):
+            self._pending = tail
+            data = data[:start]
+        return map_traceback(data, self.maps)
@@ -64,6 +64,11 @@ Or:
 import sys
 import time
 import os
+import select
+import struct
+import codecs
+import binascii
+from contextlib import contextmanager
 
 try:
     stdout = sys.stdout.buffer
@@ -71,6 +76,9 @@ except AttributeError:
     # Python2 doesn't have buffer attr
     stdout = sys.stdout
 
+# Fallback wait between polls for transports without a file descriptor.
+READ_POLL_INTERVAL = 0.01
+
 def stdout_write_bytes(b):
     b = b.replace(b"\x04", b"")
     stdout.write(b)
@@ -94,8 +102,7 @@ class TelnetToSerial:
 
                 if b'for more information.' in self.tn.read_until(b'Type "help()" for more information.', timeout=read_timeout):
                     # login successful
-                    from collections import deque
-                    self.fifo = deque()
+                    self.fifo = bytearray()
                     return
 
         raise PyboardError('Failed to establish a telnet connection with the board')
@@ -110,36 +117,50 @@ class TelnetToSerial:
             # the telnet object might not exist yet, so ignore this one
             pass
 
+    def _fill(self):
+        # Move whatever telnetlib can give us without blocking into the fifo.
+        try:
+            data = self.tn.read_very_eager()
+        except EOFError:
+            return -1
+        self.fifo.extend(data)
+        return len(data)
+
     def read(self, size=1):
+        # read_timeout is an idle timeout: it restarts whenever data arrives.
+        deadline = None
+        if self.read_timeout is not None:
+            deadline = time.monotonic() + self.read_timeout
         while len(self.fifo) < size:
-            timeout_count = 0
-            data = self.tn.read_eager()
-            if len(data):
-                self.fifo.extend(data)
-                timeout_count = 0
-            else:
-                time.sleep(0.25)
-                if self.read_timeout is not None and timeout_count > 4 * self.read_timeout:
+            n = self._fill()
+            if n < 0:
+                # connection closed, return what we have
+                break
+            if n:
+                if deadline is not None:
+                    deadline = time.monotonic() + self.read_timeout
+                continue
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
                     break
-                timeout_count += 1
+            select.select([self.tn.get_socket()], [], [], remaining)
 
-        data = b''
-        while len(data) < size and len(self.fifo) > 0:
-            data += bytes([self.fifo.popleft()])
+        data = bytes(self.fifo[:size])
+        del self.fifo[:size]
         return data
 
     def write(self, data):
         self.tn.write(data)
         return len(data)
 
+    def fileno(self):
+        return self.tn.fileno()
+
     def inWaiting(self):
-        n_waiting = len(self.fifo)
-        if not n_waiting:
-            data = self.tn.read_eager()
-            self.fifo.extend(data)
-            return len(data)
-        else:
-            return n_waiting
+        self._fill()
+        return len(self.fifo)
 
 
 class ProcessToSerial:
@@ -147,42 +168,61 @@ class ProcessToSerial:
 
     def __init__(self, cmd):
         import subprocess
-        self.subp = subprocess.Popen(cmd.split(), bufsize=0, shell=True, preexec_fn=os.setsid,
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-
-        # Initially was implemented with selectors, but that adds Python3
-        # dependency. However, there can be race conditions communicating
-        # with a particular child process (like QEMU), and selectors may
-        # still work better in that case, so left inplace for now.
-        #
-        #import selectors
-        #self.sel = selectors.DefaultSelector()
-        #self.sel.register(self.subp.stdout, selectors.EVENT_READ)
-
-        import select
-        self.poll = select.poll()
-        self.poll.register(self.subp.stdout.fileno())
+        import selectors
+        # The whole command line goes to the shell; passing a list with
+        # shell=True would drop every argument after the first word.
+        self.subp = subprocess.Popen(cmd, bufsize=0, shell=True,
+                                     preexec_fn=os.setsid,
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE)
+
+        # Output is read with non-blocking os.read() calls into a buffer, so
+        # inWaiting() can report the real number of pending bytes and reads
+        # come off the pipe in bulk rather than a byte at a time.
+        self.fd = self.subp.stdout.fileno()
+        os.set_blocking(self.fd, False)
+        self.sel = selectors.DefaultSelector()
+        self.sel.register(self.fd, selectors.EVENT_READ)
+        self.buf = bytearray()
+        self.eof = False
 
     def close(self):
         import signal
+        self.sel.close()
         os.killpg(os.getpgid(self.subp.pid), signal.SIGTERM)
 
+    def _fill(self, timeout):
+        # Wait up to timeout (None: for ever) for output, then take all of it.
+        if self.eof or not self.sel.select(timeout):
+            return
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return
+            if not data:
+                # the process has exited
+                self.eof = True
+                return
+            self.buf.extend(data)
+
     def read(self, size=1):
-        data = b""
-        while len(data) < size:
-            data += self.subp.stdout.read(size - len(data))
+        while len(self.buf) < size and not self.eof:
+            self._fill(None)
+        data = bytes(self.buf[:size])
+        del self.buf[:size]
         return data
 
     def write(self, data):
         self.subp.stdin.write(data)
         return len(data)
 
+    def fileno(self):
+        return self.fd
+
     def inWaiting(self):
-        #res = self.sel.select(0)
-        res = self.poll.poll(0)
-        if res:
-            return 1
-        return 0
+        self._fill(0)
+        return len(self.buf)
 
 
 class ProcessPtyToTerminal:
@@ -199,9 +239,9 @@ class ProcessPtyToTerminal:
         pty_line = self.subp.stderr.readline().decode("utf-8")
         m = re.search(r"/dev/pts/[0-9]+", pty_line)
         if not m:
-            print("Error: unable to find PTY device in startup line:", pty_line)
             self.close()
-            sys.exit(1)
+            raise PyboardError(
+                'unable to find PTY device in startup line: ' + pty_line)
         pty = m.group()
         # rtscts, dsrdtr params are to workaround pyserial bug:
         # http://stackoverflow.com/questions/34831131/pyserial-does-not-play-well-with-virtual-port
@@ -217,12 +257,21 @@ class ProcessPtyToTerminal:
     def write(self, data):
         return self.ser.write(data)
 
+    def fileno(self):
+        return self.ser.fileno()
+
     def inWaiting(self):
         return self.ser.inWaiting()
 
 
 class Pyboard:
     def __init__(self, device, baudrate=115200, user='micro', password='python', wait=0):
+        # Receive buffer: read_until drains the transport in bulk and keeps
+        # anything past the terminator here for the next read.
+        self._rx = bytearray()
+        self.in_raw_repl = False
+        # Cleared once the firmware turns out not to support raw-paste mode.
+        self.use_raw_paste = True
         if device.startswith("exec:"):
             self.serial = ProcessToSerial(device[len("exec:"):])
         elif device.startswith("execpty:"):
@@ -257,61 +306,157 @@ class Pyboard:
         self.serial.close()
 
     def read_until(self, min_num_bytes, ending, timeout=10, data_consumer=None):
-        data = self.serial.read(min_num_bytes)
-        if data_consumer:
-            data_consumer(data)
-        timeout_count = 0
+        """Read until ending is received, or timeout seconds pass without any
+        new data arriving (None waits forever).  Everything the transport has
+        pending is drained in one go into self._rx; bytes received past ending
+        stay buffered for the next read."""
+        # The first bytes are waited for without a deadline, as they always
+        # have been: a command may run for a long time before printing.
+        while len(self._rx) < min_num_bytes:
+            self._fill(None)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        scan = 0        # where to resume looking for ending
+        consumed = 0    # how much has already gone to data_consumer
         while True:
-            if data.endswith(ending):
+            idx = self._rx.find(ending, scan)
+            if idx >= 0:
+                end = idx + len(ending)
                 break
-            elif self.serial.inWaiting() > 0:
-                new_data = self.serial.read(1)
-                data = data + new_data
-                if data_consumer:
-                    data_consumer(new_data)
-                timeout_count = 0
-            else:
-                timeout_count += 1
-                if timeout is not None and timeout_count >= 100 * timeout:
-                    break
-                time.sleep(0.01)
+            # Only the newly appended tail (plus a possible partial match of
+            # ending straddling the old boundary) needs searching next time.
+            scan = max(0, len(self._rx) - len(ending) + 1)
+            if data_consumer and consumed < len(self._rx):
+                data_consumer(bytes(self._rx[consumed:]))
+                consumed = len(self._rx)
+            if deadline is None:
+                self._fill(None)
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                end = len(self._rx)
+                break
+            if self._fill(remaining):
+                deadline = time.monotonic() + timeout
+        if data_consumer and consumed < end:
+            data_consumer(bytes(self._rx[consumed:end]))
+        data = bytes(self._rx[:end])
+        del self._rx[:end]
         return data
 
-    def enter_raw_repl(self):
-        self.serial.write(b'\r\x03\x03') # ctrl-C twice: interrupt any running program
+    def _fill(self, timeout, limit=None):
+        """Move everything the transport has pending (or at most limit bytes)
+        into self._rx, waiting up to timeout seconds (None for ever) for
+        something to arrive.  Returns the number of bytes added."""
+        n = self.serial.inWaiting()
+        if not n:
+            self._wait_readable(timeout)
+            n = self.serial.inWaiting()
+        if limit is not None:
+            n = min(n, limit)
+        if n:
+            self._rx.extend(self.serial.read(n))
+        return n
+
+    def _wait_readable(self, timeout):
+        # Block in the OS when the transport exposes a file descriptor,
+        # otherwise fall back to a short sleep.
+        try:
+            fd = self.serial.fileno()
+        except (AttributeError, IOError, ValueError):
+            time.sleep(READ_POLL_INTERVAL if timeout is None
+                       else max(0, min(READ_POLL_INTERVAL, timeout)))
+        else:
+            select.select([fd], [], [], timeout)
+
+    def _read(self, size):
+        """Read exactly size bytes, taking buffered data first."""
+        while len(self._rx) < size:
+            self._fill(None)
+        data = bytes(self._rx[:size])
+        del self._rx[:size]
+        return data
 
+    def read_exact(self, size, timeout=10):
+        """Read exactly size bytes, raising PyboardError if timeout seconds
+        pass without any new data arriving (None waits forever)."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while len(self._rx) < size:
+            remaining = (None if deadline is None
+                         else deadline - time.monotonic())
+            if remaining is not None and remaining <= 0:
+                raise PyboardError('timeout waiting for {} bytes'.format(size))
+            if self._fill(remaining) and timeout is not None:
+                deadline = time.monotonic() + timeout
+        data = bytes(self._rx[:size])
+        del self._rx[:size]
+        return data
+
+    def read_buffered(self):
+        """Return (and forget) whatever has been received but not yet read,
+        without waiting for more."""
+        data = bytes(self._rx)
+        del self._rx[:]
+        return data
+
+    def _flush_input(self):
         # flush input (without relying on serial.flushInput())
+        del self._rx[:]
         n = self.serial.inWaiting()
         while n > 0:
             self.serial.read(n)
             n = self.serial.inWaiting()
 
-        self.serial.write(b'\r\x01') # ctrl-A: enter raw REPL
-        data = self.read_until(1, b'raw REPL; CTRL-B to exit\r\n>')
-        if not data.endswith(b'raw REPL; CTRL-B to exit\r\n>'):
-            print(data)
-            raise PyboardError('could not enter raw repl')
+    def enter_raw_repl(self, soft_reset=True):
+        self.serial.write(b'\r\x03\x03') # ctrl-C twice: interrupt any running program
+        self._flush_input()
 
-        self.serial.write(b'\x04') # ctrl-D: soft reset
-        data = self.read_until(1, b'soft reboot\r\n')
-        if not data.endswith(b'soft reboot\r\n'):
-            print(data)
-            raise PyboardError('could not enter raw repl')
-        # By splitting this into 2 reads, it allows boot.py to print stuff,
-        # which will show up after the soft reboot and before the raw REPL.
-        # Modification from original pyboard.py below:
-        #   Add a small delay and send Ctrl-C twice after soft reboot to ensure
-        #   any main program loop in main.py is interrupted.
-        #time.sleep(0.5)
-        #self.serial.write(b'\x03\x03')
-        # End modification above.
+        self.serial.write(b'\r\x01') # ctrl-A: enter raw REPL
+        # The prompt after the banner is left in the buffer: it is either
+        # consumed by the soft reset below or by the first command.
         data = self.read_until(1, b'raw REPL; CTRL-B to exit\r\n')
         if not data.endswith(b'raw REPL; CTRL-B to exit\r\n'):
-            print(data)
-            raise PyboardError('could not enter raw repl')
+            raise PyboardError('could not enter raw repl: {!r}'.format(data))
+
+        if soft_reset:
+            self.serial.write(b'\x04') # ctrl-D: soft reset
+            data = self.read_until(1, b'soft reboot\r\n')
+            if not data.endswith(b'soft reboot\r\n'):
+                raise PyboardError(
+                    'could not enter raw repl: {!r}'.format(data))
+            # By splitting this into 2 reads, it allows boot.py to print
+            # stuff, which will show up after the soft reboot and before the
+            # raw REPL.
+            # Modification from original pyboard.py below:
+            #   Add a small delay and send Ctrl-C twice after soft reboot to
+            #   ensure any main program loop in main.py is interrupted.
+            #time.sleep(0.5)
+            #self.serial.write(b'\x03\x03')
+            # End modification above.
+            data = self.read_until(1, b'raw REPL; CTRL-B to exit\r\n')
+            if not data.endswith(b'raw REPL; CTRL-B to exit\r\n'):
+                raise PyboardError(
+                    'could not enter raw repl: {!r}'.format(data))
+        self.in_raw_repl = True
 
     def exit_raw_repl(self):
         self.serial.write(b'\r\x02') # ctrl-B: enter friendly REPL
+        self.in_raw_repl = False
+
+    @contextmanager
+    def raw_repl(self, soft_reset=True):
+        """Context manager keeping the board in raw REPL mode for any number
+        of commands.  Raw mode is entered once on the way in (with a soft
+        reset unless soft_reset is False, in which case the running program
+        is just interrupted) and left on the way out.  Nested uses, or uses
+        while raw mode was entered by hand, reuse the existing session."""
+        if self.in_raw_repl:
+            yield self
+            return
+        self.enter_raw_repl(soft_reset)
+        try:
+            yield self
+        finally:
+            self.exit_raw_repl()
 
     def follow(self, timeout, data_consumer=None):
         # wait for normal output
@@ -329,6 +474,44 @@ class Pyboard:
         # return normal and error output
         return data, data_err
 
+    def raw_paste_write(self, command_bytes):
+        # Read initial header, with window size.
+        data = self._read(2)
+        window_size = struct.unpack('<H', data)[0]
+        window_remain = window_size
+
+        # Write out the command_bytes data.
+        i = 0
+        while i < len(command_bytes):
+            while window_remain == 0 or self._rx or self.serial.inWaiting():
+                data = self._read(1)
+                if data == b'\x01':
+                    # Device indicated that a new window of data can be sent.
+                    window_remain += window_size
+                elif data == b'\x04':
+                    # Device indicated abrupt end.  Acknowledge it and finish.
+                    self.serial.write(b'\x04')
+                    return
+                else:
+                    # Unexpected data from device.
+                    raise PyboardError(
+                        'unexpected read during raw paste: {!r}'.format(data))
+            # Send out as much data as possible that fits within the allowed
+            # window.
+            b = command_bytes[i:min(i + window_remain, len(command_bytes))]
+            self.serial.write(b)
+            window_remain -= len(b)
+            i += len(b)
+
+        # Indicate end of data.
+        self.serial.write(b'\x04')
+
+        # Wait for device to acknowledge end of data.
+        data = self.read_until(1, b'\x04')
+        if not data.endswith(b'\x04'):
+            raise PyboardError(
+                'could not complete raw paste: {!r}'.format(data))
+
     def exec_raw_no_follow(self, command):
         if isinstance(command, bytes):
             command_bytes = command
@@ -340,6 +523,24 @@ class Pyboard:
         if not data.endswith(b'>'):
             raise PyboardError('could not enter raw repl')
 
+        if self.use_raw_paste:
+            # Try to enter raw-paste mode.
+            self.serial.write(b'\x05A\x01')
+            data = self._read(2)
+            if data == b'R\x01':
+                # Device supports raw-paste mode, write out the command using
+                # it; the device paces us with its flow-control window.
+                return self.raw_paste_write(command_bytes)
+            elif data != b'R\x00':
+                # Device doesn't understand raw-paste: the Ctrl-A just
+                # re-printed the raw REPL banner.
+                data = self.read_until(1, b'w REPL; CTRL-B to exit\r\n>')
+                if not data.endswith(b'w REPL; CTRL-B to exit\r\n>'):
+                    raise PyboardError(
+                        'could not enter raw repl: {!r}'.format(data))
+            # Don't try to use raw-paste mode again for this connection.
+            self.use_raw_paste = False
+
         # write command
         for i in range(0, len(command_bytes), 256):
             self.serial.write(command_bytes[i:min(i + 256, len(command_bytes))])
@@ -347,7 +548,7 @@ class Pyboard:
         self.serial.write(b'\x04')
 
         # check if we could exec command
-        data = self.serial.read(2)
+        data = self._read(2)
         if data != b'OK':
             raise PyboardError('could not exec command (response: %s)' % data)
 
@@ -355,6 +556,114 @@ class Pyboard:
         self.exec_raw_no_follow(command);
         return self.follow(timeout, data_consumer)
 
+    def iter_exec(self, command, timeout=10, chunk_size=1024):
+        """Run command and yield its output as it arrives, as a sequence of
+        ('stdout', text) and then ('stderr', text) tuples.  At most
+        chunk_size bytes are held on the host at a time, so the output of a
+        script which runs for ever can be consumed with flat memory.
+
+        timeout is an idle timeout (None to wait for ever); PyboardError is
+        raised if the device goes quiet for longer.  Closing the generator
+        before the command has finished interrupts it with Ctrl-C and
+        leaves the raw REPL ready for the next command."""
+        self.exec_raw_no_follow(command)
+        eofs = 2  # terminators still to come from the device
+        try:
+            for stream in ('stdout', 'stderr'):
+                decoder = codecs.getincrementaldecoder('utf-8')('replace')
+                while True:
+                    data, done = self._read_chunk(b'\x04', chunk_size, timeout)
+                    if done:
+                        eofs -= 1
+                    text = decoder.decode(data, final=done)
+                    if text:
+                        yield stream, text
+                    if done:
+                        break
+        finally:
+            if eofs:
+                self._interrupt(eofs)
+
+    def _read_chunk(self, ending, chunk_size, timeout):
+        """Return (data, found): up to chunk_size bytes of data received
+        before the single byte ending, and whether ending was reached (it is
+        consumed but not returned)."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._rx:
+            remaining = (None if deadline is None
+                         else deadline - time.monotonic())
+            if remaining is not None and remaining <= 0:
+                raise PyboardError('timeout waiting for command output')
+            self._fill(remaining, limit=chunk_size)
+        idx = self._rx.find(ending, 0, chunk_size)
+        if idx >= 0:
+            data = bytes(self._rx[:idx])
+            del self._rx[:idx + 1]
+            return data, True
+        data = bytes(self._rx[:chunk_size])
+        del self._rx[:chunk_size]
+        return data, False
+
+    def _interrupt(self, eofs):
+        # Ctrl-C the running command and throw away the rest of its output,
+        # up to the given number of remaining EOF markers.  Nothing may come
+        # back at all from a wedged device, so every wait is bounded.
+        self.serial.write(b'\x03')
+        for i in range(eofs):
+            data = self.read_until(0, b'\x04', timeout=1)
+            if not data.endswith(b'\x04'):
+                break
+
+    def exec_raw_batch(self, commands, timeout=10):
+        """Run several commands in a single raw REPL submission, one after the
+        other in the same global namespace, as separate exec_raw calls would.
+        Returns a list of (stdout, stderr) pairs, one for each command that
+        ran: the batch stops after the first command which raises, and that
+        command's traceback is its stderr."""
+        marker = '\x1e' + binascii.hexlify(os.urandom(6)).decode('ascii')
+        sources = []
+        for command in commands:
+            if isinstance(command, bytes):
+                command = command.decode('utf-8')
+            sources.append(repr(command))
+        # Every command's output is followed by the marker, its traceback
+        # (if any) and the marker again, so the two can be split back out.
+        program = (
+            'import sys\n'
+            'for _mu_s in ({sources},):\n'
+            '    _mu_e = None\n'
+            '    try:\n'
+            '        exec(_mu_s)\n'
+            '    except BaseException as e:\n'
+            '        _mu_e = e\n'
+            '    sys.stdout.write({marker!r})\n'
+            '    if _mu_e is not None:\n'
+            '        sys.print_exception(_mu_e, sys.stdout)\n'
+            '    sys.stdout.write({marker!r})\n'
+            '    if _mu_e is not None:\n'
+            '        break\n'
+            'del _mu_s, _mu_e\n'
+        ).format(sources=', '.join(sources), marker=marker)
+        ret, ret_err = self.exec_raw(program, timeout)
+        parts = ret.split(marker.encode('ascii'))
+        results = [(parts[i], parts[i + 1])
+                   for i in range(0, len(parts) - 1, 2)]
+        if ret_err:
+            # The batch itself was stopped (e.g. by Ctrl-C or running out of
+            # memory) partway through a command: blame that command.
+            results.append((parts[-1] if len(parts) % 2 else b'', ret_err))
+        return results
+
+    def exec_batch(self, commands, timeout=10):
+        """Run several commands in one round trip and return a list of their
+        outputs.  If one of them fails, PyboardError is raised with the same
+        arguments as exec_ plus the index of the failing command."""
+        results = self.exec_raw_batch(commands, timeout)
+        for index, (ret, ret_err) in enumerate(results):
+            if ret_err:
+                raise PyboardError('exception', ret, ret_err, index)
+        return [ret for ret, ret_err in results]
+
     def eval(self, expression):
         ret = self.exec_('print({})'.format(expression))
         ret = ret.strip()
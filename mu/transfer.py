@@ -0,0 +1,213 @@
+"""
+Copyright (c) 2015-2016 Nicholas H.Tollervey and others (see the AUTHORS file).
+
+Based upon work done for Puppy IDE by Dan Pope, Nicholas Tollervey and Damien
+George.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import collections
+import itertools
+import logging
+import queue
+from PyQt5.QtCore import QThread, pyqtSignal
+from mu.broker import get_broker
+from mu.resources import pyboard
+from mu.resources import files
+
+
+logger = logging.getLogger(__name__)
+
+
+#: A queued file operation: action is one of 'put', 'get', 'rm', 'df' or
+#: 'ls'.
+Job = collections.namedtuple('Job', 'id action remote local')
+
+
+class TransferCancelled(Exception):
+    """
+    Reported as the error of a job which was cancelled.
+    """
+
+
+class TransferManager(QThread):
+    """
+    Carries out file operations on a board in a worker thread, so the user
+    interface never waits on the device.
+
+    Jobs are queued with put, get and rm, which return an id for the job,
+    and run in order of priority (highest first) then of being queued. When
+    there is work to do the thread leases the port from its PortBroker and
+    runs queued jobs back-to-back in a single raw REPL session, emitting the
+    board's disk usage and files and releasing the port (and emitting idle)
+    once the queue is empty.
+    """
+
+    #: Emitted with the id of a job as it starts.
+    job_started = pyqtSignal(int)
+    #: Emitted with the id of a job, bytes transferred and the total size.
+    job_progress = pyqtSignal(int, int, int)
+    #: Emitted with the id of a job and the exception it failed with, or
+    #: None if it succeeded.
+    job_finished = pyqtSignal(int, object)
+    #: Emitted with the board's DiskUsage at the end of each session.
+    disk_usage = pyqtSignal(object)
+    #: Emitted with the names of the files on the board at the end of each
+    #: session.
+    listing = pyqtSignal(object)
+    #: Emitted when the queue is empty and the board has been released.
+    idle = pyqtSignal()
+
+    def __init__(self, port, parent=None):
+        super().__init__(parent)
+        self.port = port
+        self._queue = queue.PriorityQueue()
+        self._ids = itertools.count(1)
+        self._order = itertools.count()
+        self._cancelled = set()
+        self._stopping = False
+
+    def put(self, local, remote, priority=0):
+        """
+        Queue copying the local file to remote on the board.
+        """
+        return self._add('put', remote, local, priority)
+
+    def get(self, remote, local, priority=0):
+        """
+        Queue copying remote on the board to the local file.
+        """
+        return self._add('get', remote, local, priority)
+
+    def rm(self, remote, priority=0):
+        """
+        Queue removing remote from the board.
+        """
+        return self._add('rm', remote, None, priority)
+
+    def df(self, priority=0):
+        """
+        Queue checking the board's disk usage, which is emitted (as it is
+        after any other jobs) with disk_usage.
+        """
+        return self._add('df', None, None, priority)
+
+    def ls(self, priority=0):
+        """
+        Queue listing the files on the board, which are emitted (as they are
+        after any other jobs) with listing.
+        """
+        return self._add('ls', None, None, priority)
+
+    def _add(self, action, remote, local, priority):
+        job = Job(next(self._ids), action, remote, local)
+        self._queue.put((-priority, next(self._order), job))
+        if not self.isRunning():
+            self.start()
+        return job.id
+
+    def cancel(self, job_id):
+        """
+        Cancel the job: a queued job is dropped and a transfer in progress
+        stops as soon as the board allows. Either way the job finishes with
+        a TransferCancelled error.
+        """
+        self._cancelled.add(job_id)
+
+    def stop(self):
+        """
+        Cancel every job, then wait for the thread to finish.
+        """
+        self._stopping = True
+        # Wake the thread if it's waiting for work.
+        self._queue.put((float('-inf'), next(self._order), None))
+        self.wait()
+
+    def _next(self, block=True):
+        """
+        Return the next job to run, or None if there are none (or the
+        manager is stopping). Cancelled jobs are finished as they're passed
+        over.
+        """
+        while not self._stopping:
+            try:
+                job = self._queue.get(block)[2]
+            except queue.Empty:
+                return None
+            if job is None or job.id not in self._cancelled:
+                return job
+            self._finish(job, TransferCancelled())
+        return None
+
+    def _finish(self, job, error):
+        self._cancelled.discard(job.id)
+        self.job_finished.emit(job.id, error)
+
+    def run(self):
+        """
+        Wait for jobs and run them until stopped.
+        """
+        while True:
+            job = self._next()
+            if job is None:
+                break
+            try:
+                with get_broker(self.port).lease() as board:
+                    board_files = files.Files(board)
+                    with board_files.session():
+                        while job is not None:
+                            try:
+                                self._run_job(board_files, job)
+                            except TransferCancelled as ex:
+                                self._finish(job, ex)
+                            else:
+                                self._finish(job, None)
+                            job = self._next(block=False)
+                        self.disk_usage.emit(board_files.df())
+                        self.listing.emit(board_files.ls())
+            except (Exception, pyboard.PyboardError) as ex:
+                # The session can't be trusted after an error, so the rest
+                # of the queue starts again in a new one.
+                if job is not None:
+                    self._finish(job, ex)
+                else:
+                    logger.error(ex)
+            self.idle.emit()
+        # Anything left over was never started.
+        while True:
+            try:
+                job = self._queue.get(False)[2]
+            except queue.Empty:
+                break
+            if job is not None:
+                self._finish(job, TransferCancelled())
+
+    def _run_job(self, board_files, job):
+        """
+        Carry out the job using the board's Files.
+        """
+        self.job_started.emit(job.id)
+
+        def progress(done, total):
+            if job.id in self._cancelled or self._stopping:
+                raise TransferCancelled()
+            self.job_progress.emit(job.id, done, total)
+
+        if job.action == 'put':
+            with open(job.local, 'rb') as local:
+                board_files.put(job.remote, local.read(), progress)
+        elif job.action == 'get':
+            board_files.get_to(job.remote, job.local, progress=progress)
+        elif job.action == 'rm':
+            board_files.rm(job.remote)
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the agent which answers file requests on MicroPython boards.
+"""
+from unittest import mock
+import pytest
+from mu.resources import agent
+from mu.resources.minify import minify
+from mu.resources.pyboard import PyboardError
+
+
+def test_source():
+    """
+    The agent's source, and its minified form, are valid Python of this
+    version.
+    """
+    assert 'VERSION = {0}'.format(agent.VERSION) in agent.SOURCE
+    compile(agent.SOURCE, agent.AGENT_PATH, 'exec')
+    compile(minify(agent.SOURCE).source, agent.AGENT_PATH, 'exec')
+
+
+def test_start():
+    """
+    A board with this version of the agent starts it and says hello.
+    """
+    pyboard = mock.MagicMock()
+    pyboard.read_exact.side_effect = [b'M', b'A01']
+    assert agent.start(pyboard) == 1
+    command = pyboard.exec_raw_no_follow.call_args[0][0]
+    assert 'start({0}, 10000)'.format(agent.VERSION) in command
+    pyboard.follow.assert_not_called()
+
+
+def test_start_missing():
+    """
+    A board without the agent prints the version it has instead.
+    """
+    pyboard = mock.MagicMock()
+    pyboard.read_exact.return_value = b'0'
+    pyboard.follow.return_value = (b'\r\n', b'')
+    assert agent.start(pyboard) == 0
+
+
+def test_start_error():
+    """
+    A board which can't run the agent raises a PyboardError.
+    """
+    pyboard = mock.MagicMock()
+    pyboard.read_exact.return_value = b'\x04'
+    pyboard.read_until.return_value = b"AttributeError: 'buffer'\r\n\x04"
+    with pytest.raises(PyboardError) as ex:
+        agent.start(pyboard)
+    assert ex.value.args[2] == b"AttributeError: 'buffer'\r\n"
+
+
+def make_agent(*replies):
+    """
+    Return an Agent around a mock pyboard which gives the replies, and the
+    list the bytes it writes are added to.
+    """
+    pyboard = mock.MagicMock()
+    written = []
+    pyboard.serial.write.side_effect = written.append
+    pyboard.read_exact.side_effect = list(replies)
+    return agent.Agent(pyboard), written
+
+
+def test_requests():
+    """
+    Each request is framed with its opcode and length, and the result is
+    parsed.
+    """
+    client, written = make_agent(b'K0000000b', b"['main.py']",
+                                 b'K00000003', b'abc',
+                                 b'K00000000', b'')
+    assert client.ls('/') == ['main.py']
+    assert client.read('data.bin', 512, 256) == b'abc'
+    client.write('data.bin', b'xy', append=True)
+    assert written == [b'l00000001', b'/',
+                       b'r00000010', b'512 256 data.bin',
+                       b'w0000000c', b'adata.bin\0xy']
+
+
+def test_error():
+    """
+    An error on the board is raised as a PyboardError, and the agent is
+    still running.
+    """
+    client, written = make_agent(b'E0000001a', b'OSError: [Errno 2] ENOENT')
+    with pytest.raises(PyboardError) as ex:
+        client.rm('nope')
+    assert ex.value.args[2] == b'OSError: [Errno 2] ENOENT'
+    assert client.running
+
+
+def test_failure():
+    """
+    Once talking to the agent fails, it isn't running and isn't told to
+    stop.
+    """
+    client, written = make_agent(PyboardError('timeout waiting for 9 bytes'))
+    with pytest.raises(PyboardError):
+        client.mkdir('lib')
+    assert not client.running
+    client.stop()
+    assert written == [b'm00000003', b'lib']
+
+
+def test_stop():
+    """
+    Stopping the agent waits for the board to finish.
+    """
+    client, written = make_agent()
+    client._pyboard.follow.return_value = (b'', b'')
+    client.stop()
+    client.stop()
+    assert written == [b'q00000000']
+    client._pyboard.follow.assert_called_once_with(10)
+    assert not client.running
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the asyncio interface to MicroPython boards.
+"""
+from unittest import mock
+import asyncio
+import socket
+import pytest
+from mu.resources.aiopyboard import AsyncPyboard
+from mu.resources.pyboard import Pyboard, PyboardError
+
+
+class SocketSerial:
+    """
+    A serial-like object on one end of a socket pair.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.pending = bytearray()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def inWaiting(self):
+        try:
+            self.pending.extend(self.sock.recv(4096))
+        except BlockingIOError:
+            pass
+        return len(self.pending)
+
+    def read(self, size=1):
+        data = bytes(self.pending[:size])
+        del self.pending[:size]
+        return data
+
+    def write(self, data):
+        self.sock.sendall(data)
+        return len(data)
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    asyncio.set_event_loop(None)
+    loop.close()
+
+
+def make_board(loop):
+    """
+    Return an AsyncPyboard and the device end of its connection.
+    """
+    host, device = socket.socketpair()
+    with mock.patch('serial.Serial', return_value=SocketSerial(host)):
+        pyb = Pyboard('/dev/ttyACM0')
+    return AsyncPyboard(pyb, loop=loop), device
+
+
+def test_read_until(loop):
+    """
+    Data arriving in pieces is collected until the terminator, and anything
+    after it is kept for the next read.
+    """
+    board, device = make_board(loop)
+
+    async def go():
+        loop.call_later(0.01, device.send, b'abc')
+        loop.call_later(0.02, device.send, b'def\x04more')
+        return await board.read_until(1, b'\x04')
+
+    assert loop.run_until_complete(go()) == b'abcdef\x04'
+    assert bytes(board._rx) == b'more'
+    board.close()
+
+
+def test_read_until_timeout(loop):
+    """
+    If nothing more arrives within the timeout, the partial data is
+    returned.
+    """
+    board, device = make_board(loop)
+    device.send(b'partial')
+    result = loop.run_until_complete(board.read_until(1, b'>', timeout=0.05))
+    assert result == b'partial'
+    board.close()
+
+
+def test_connection_lost(loop):
+    """
+    A closed connection is reported as a PyboardError.
+    """
+    board, device = make_board(loop)
+    device.close()
+    with pytest.raises(PyboardError):
+        loop.run_until_complete(board.read_until(1, b'>'))
+    board.pyboard.close()
+
+
+def test_exec_raw(loop):
+    """
+    A command is sent and its stdout and stderr are returned.
+    """
+    board, device = make_board(loop)
+    board.pyboard.use_raw_paste = False
+    device.send(b'>OKhello\x04\x04>')
+    result = loop.run_until_complete(board.exec_raw('print("hello")'))
+    assert result == (b'hello', b'')
+    assert device.recv(100) == b'print("hello")\x04'
+    board.close()
+
+
+def test_exec_error(loop):
+    """
+    Errors raised on the device are raised as a PyboardError.
+    """
+    board, device = make_board(loop)
+    board.pyboard.use_raw_paste = False
+    device.send(b'>OK\x04Traceback\x04>')
+    with pytest.raises(PyboardError) as ex:
+        loop.run_until_complete(board.exec_('1/0'))
+    assert ex.value.args[2] == b'Traceback'
+    board.close()
+
+
+def test_many_boards(loop):
+    """
+    Several boards are driven concurrently from the one event loop.
+    """
+    boards = [make_board(loop) for i in range(5)]
+    for i, (board, device) in enumerate(boards):
+        board.pyboard.use_raw_paste = False
+        device.send('>OK{}\x04\x04>'.format(i).encode())
+
+    async def go():
+        return await asyncio.gather(*[board.exec_('x')
+                                      for board, device in boards])
+
+    results = loop.run_until_complete(go())
+    assert results == [b'0', b'1', b'2', b'3', b'4']
+    for board, device in boards:
+        board.close()
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for sharing a board's serial port.
+"""
+from unittest import mock
+import threading
+import time
+import pytest
+from serial.serialutil import SerialException
+import mu.broker
+from mu.resources.pyboard import PyboardError
+
+
+class FakeSerial:
+    """
+    A stand-in for a serial connection which the test sends data down, read
+    from another thread.
+    """
+
+    def __init__(self):
+        self.timeout = None
+        self.written = bytearray()
+        self.error = None
+        self._data = bytearray()
+        self._condition = threading.Condition()
+
+    def send(self, data):
+        with self._condition:
+            self._data.extend(data)
+            self._condition.notify_all()
+
+    def inWaiting(self):
+        with self._condition:
+            if self.error:
+                raise self.error
+            return len(self._data)
+
+    def read(self, size=1):
+        with self._condition:
+            if not self._data:
+                self._condition.wait(self.timeout)
+            data = bytes(self._data[:size])
+            del self._data[:size]
+            return data
+
+    def write(self, data):
+        self.written.extend(data)
+        return len(data)
+
+
+class FakePyboard:
+    """
+    Stands in for a Pyboard connected to a FakeSerial.
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.serial = FakeSerial()
+        self.buffered = b''
+        self.close = mock.MagicMock()
+
+    def read_buffered(self):
+        data, self.buffered = self.buffered, b''
+        return data
+
+
+@pytest.fixture(autouse=True)
+def fake_ports():
+    """
+    Each test starts without any brokers, and connects to fake boards.
+    """
+    with mock.patch.dict('mu.broker._brokers', clear=True), \
+            mock.patch('mu.broker.pyboard.Pyboard', side_effect=FakePyboard):
+        yield
+
+
+class Listener:
+    """
+    Collects what a broker passes it, from the broker's thread.
+    """
+
+    def __init__(self):
+        self.data = bytearray()
+        self._condition = threading.Condition()
+
+    def __call__(self, data):
+        with self._condition:
+            self.data.extend(data)
+            self._condition.notify_all()
+
+    def wait_for(self, data):
+        with self._condition:
+            assert self._condition.wait_for(lambda: data in self.data, 5)
+
+
+def test_get_broker():
+    """
+    There is one broker for each port.
+    """
+    broker = mu.broker.get_broker('/dev/ttyACM0')
+    assert mu.broker.get_broker('/dev/ttyACM0') is broker
+    assert mu.broker.get_broker('/dev/ttyACM1') is not broker
+
+
+def test_lease_keeps_port_open():
+    """
+    Leases are handed the same connection, which stays open between them.
+    """
+    broker = mu.broker.get_broker('/dev/ttyACM0')
+    with broker.lease() as first:
+        assert first.port == '/dev/ttyACM0'
+        assert first.serial.timeout == mu.broker.READ_INTERVAL
+    with broker.lease() as second:
+        assert second is first
+    assert first.close.call_count == 0
+
+
+def test_leases_are_exclusive():
+    """
+    A lease on a port waits for the one before to end, while a lease on
+    another port doesn't.
+    """
+    events = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with mu.broker.get_broker('/dev/ttyACM0').lease():
+            events.append('first')
+            started.set()
+            release.wait(5)
+            events.append('first done')
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    assert started.wait(5)
+    with mu.broker.get_broker('/dev/ttyACM1').lease():
+        events.append('other port')
+
+    def wait():
+        with mu.broker.get_broker('/dev/ttyACM0').lease():
+            events.append('second')
+
+    waiter = threading.Thread(target=wait)
+    waiter.start()
+    time.sleep(0.1)
+    assert events == ['first', 'other port']
+    release.set()
+    thread.join(5)
+    waiter.join(5)
+    assert events == ['first', 'other port', 'first done', 'second']
+
+
+def test_lease_timeout():
+    """
+    A lease with a timeout raises PortBusyError if the port is still leased
+    by then, rather than waiting for it.
+    """
+    broker = mu.broker.get_broker('/dev/ttyACM0')
+    with broker.lease():
+        with pytest.raises(mu.broker.PortBusyError):
+            with broker.lease(timeout=0):
+                pass
+    with broker.lease(timeout=0) as board:
+        assert board.port == '/dev/ttyACM0'
+
+
+def test_lease_serial_error():
+    """
+    A lease which fails with a serial error closes the connection, and the
+    next lease connects again.
+    """
+    broker = mu.broker.get_broker('/dev/ttyACM0')
+    with pytest.raises(SerialException):
+        with broker.lease() as first:
+            raise SerialException('gone')
+    first.close.assert_called_once_with()
+    with broker.lease() as second:
+        assert second is not first
+
+
+def test_listen():
+    """
+    The listener is passed what the board sends, except while the port is
+    leased; then it gets what the lease holder left unread once it ends.
+    Whatever it writes meanwhile is sent when the lease ends.
+    """
+    broker = mu.broker.get_broker('/dev/ttyACM0')
+    listener = Listener()
+    broker.listen(listener)
+    with broker.lease() as board:
+        board.serial.send(b'>>> ')
+    listener.wait_for(b'>>> ')
+    with broker.lease() as board:
+        broker.write(b'\x03')
+        assert board.serial.written == b''
+        board.serial.send(b'raw')
+        time.sleep(0.1)
+        assert board.serial.read(3) == b'raw'
+        board.buffered = b'output'
+    listener.wait_for(b'output')
+    assert bytes(listener.data) == b'>>> output'
+    assert board.serial.written == b'\x03'
+    broker.write(b'a')
+    assert board.serial.written == b'\x03a'
+    broker.unlisten()
+
+
+def test_listen_cannot_open():
+    """
+    Listening raises if the port can't be opened.
+    """
+    broker = mu.broker.get_broker('/dev/ttyACM0')
+    with mock.patch('mu.broker.pyboard.Pyboard',
+                    side_effect=PyboardError('failed to access')):
+        with pytest.raises(PyboardError):
+            broker.listen(Listener())
+
+
+def test_listen_serial_error():
+    """
+    If reading for the listener fails the connection is closed, and the
+    next user connects again.
+    """
+    broker = mu.broker.get_broker('/dev/ttyACM0')
+    broker.listen(Listener())
+    with broker.lease() as board:
+        board.serial.error = SerialException('gone')
+    for i in range(100):
+        if board.close.call_count:
+            break
+        time.sleep(0.05)
+    board.close.assert_called_once_with()
+    with broker.lease() as new_board:
+        assert new_board is not board
+
+
+def test_SharedPort():
+    """
+    The REPL's stand-in for a QSerialPort listens to the broker, and stops
+    when it's closed.
+    """
+    with mock.patch('mu.broker.get_broker') as mock_get_broker:
+        port = mu.broker.SharedPort()
+        port.setPortName('/dev/ttyACM0')
+        assert port.open(None)
+        port.write(b'a')
+        port.close()
+    broker = mock_get_broker.return_value
+    mock_get_broker.assert_called_once_with('/dev/ttyACM0')
+    assert broker.listen.call_count == 1
+    broker.write.assert_called_once_with(b'a')
+    broker.unlisten.assert_called_once_with()
+
+
+def test_SharedPort_read():
+    """
+    Data passed on by the broker is read with readAll once readyRead is
+    emitted.
+    """
+    port = mu.broker.SharedPort()
+    ready = mock.MagicMock()
+    port.readyRead.connect(ready)
+    port._received.emit(b'abc')
+    assert ready.call_count == 1
+    assert port.readAll() == b'abc'
+    assert port.readAll() == b''
+
+
+def test_SharedPort_cannot_open():
+    """
+    If the port can't be opened, open returns False and error says why.
+    """
+    with mock.patch('mu.broker.pyboard.Pyboard',
+                    side_effect=PyboardError('failed to access')):
+        port = mu.broker.SharedPort()
+        port.setPortName('/dev/ttyACM0')
+        assert not port.open(None)
+    assert port.error() == 'failed to access'
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for keeping track of connected boards.
+"""
+from unittest import mock
+import socket
+import threading
+from serial.tools.list_ports_common import ListPortInfo
+import mu.devices
+
+
+MICROBIT = (0x0D28, 0x0204)
+FEATHER = (0x239A, 0x8016)
+
+
+def port_info(device, ids):
+    """
+    Return what pyserial lists for a serial port of a USB device.
+    """
+    info = ListPortInfo(device)
+    info.vid, info.pid = ids
+    return info
+
+
+def make_sysfs(tmpdir, name, ids):
+    """
+    Add a block device to a fake sysfs, on a USB device with the given IDs.
+    """
+    usb = tmpdir.join('devices', 'usb1', name).ensure(dir=True)
+    usb.join('idVendor').write('{:04x}\n'.format(ids[0]))
+    usb.join('idProduct').write('{:04x}\n'.format(ids[1]))
+    block = usb.join('host0', 'block', name, name + '1').ensure(dir=True)
+    tmpdir.join('class', 'block').ensure(dir=True)
+    tmpdir.join('class', 'block', name + '1').mksymlinkto(block)
+
+
+def test_CONSTANTS():
+    """
+    Ensure the expected constants exist.
+    """
+    assert isinstance(mu.devices.BOARD_IDS, set)
+
+
+def test_scan_ports():
+    """
+    Serial ports of known boards are indexed by their USB IDs.
+    """
+    ports = [port_info('/dev/ttyS0', (None, None)),
+             port_info('/dev/ttyACM0', MICROBIT),
+             port_info('/dev/ttyACM1', (0x1234, 0x5678))]
+    registry = mu.devices.DeviceRegistry(mu.devices.BOARD_IDS)
+    with mock.patch('mu.devices.list_serial_ports', return_value=ports), \
+            mock.patch('mu.devices.SYS_BLOCK', '/nowhere'), \
+            mock.patch('mu.devices.uflash.find_microbit', return_value=None):
+        registry.scan()
+    assert registry.ports == {
+        MICROBIT: [mu.devices.Port('/dev/ttyACM0', 'ttyACM0')]}
+    assert registry.find_port() == ('/dev/ttyACM0', 'ttyACM0')
+    assert registry.find_mount() is None
+
+
+def test_scan_nothing_connected():
+    """
+    Without any known boards, lookups return None.
+    """
+    registry = mu.devices.DeviceRegistry(mu.devices.BOARD_IDS)
+    with mock.patch('mu.devices.list_serial_ports', return_value=[]), \
+            mock.patch('mu.devices.SYS_BLOCK', '/nowhere'), \
+            mock.patch('mu.devices.uflash.find_microbit', return_value=None):
+        registry.scan()
+    assert registry.find_port() is None
+    assert registry.find_mount() is None
+
+
+def test_scan_mounts_sysfs(tmpdir):
+    """
+    On Linux the mounted drives of known boards are found through sysfs,
+    by their USB IDs rather than their volume names.
+    """
+    make_sysfs(tmpdir, 'sdb', FEATHER)
+    make_sysfs(tmpdir, 'sdc', (0x1234, 0x5678))
+    mounts = tmpdir.join('mounts')
+    mounts.write('/dev/sda1 / ext4 rw 0 0\n'
+                 'proc /proc proc rw 0 0\n'
+                 '/dev/sdb1 /media/my\\040board vfat rw 0 0\n'
+                 '/dev/sdc1 /media/STICK vfat rw 0 0\n')
+    registry = mu.devices.DeviceRegistry(mu.devices.BOARD_IDS)
+    with mock.patch('mu.devices.list_serial_ports', return_value=[]), \
+            mock.patch('mu.devices.SYS_BLOCK',
+                       str(tmpdir.join('class', 'block'))), \
+            mock.patch('mu.devices.MOUNTS', str(mounts)), \
+            mock.patch('mu.devices.uflash.find_microbit') as mock_find:
+        registry.scan()
+    assert registry.mounts == {FEATHER: '/media/my board'}
+    assert registry.find_mount() == '/media/my board'
+    assert mock_find.call_count == 0
+
+
+def test_scan_mounts_volume_name():
+    """
+    Elsewhere the micro:bit's drive is found by its volume name.
+    """
+    registry = mu.devices.DeviceRegistry(mu.devices.BOARD_IDS)
+    with mock.patch('mu.devices.list_serial_ports', return_value=[]), \
+            mock.patch('mu.devices.SYS_BLOCK', '/nowhere'), \
+            mock.patch('mu.devices.uflash.find_microbit',
+                       return_value='E:\\'):
+        registry.scan()
+    assert registry.mounts == {MICROBIT: 'E:\\'}
+    with mock.patch('mu.devices.list_serial_ports', return_value=[]), \
+            mock.patch('mu.devices.SYS_BLOCK', '/nowhere'), \
+            mock.patch('mu.devices.uflash.find_microbit',
+                       side_effect=NotImplementedError):
+        registry.scan()
+    assert registry.mounts == {}
+
+
+def test_get_registry():
+    """
+    There is one registry for each set of boards, which scans as it starts.
+    """
+    with mock.patch.dict('mu.devices._registries', clear=True), \
+            mock.patch('mu.devices.DeviceRegistry') as mock_registry:
+        registry = mu.devices.get_registry()
+        assert mu.devices.get_registry() is registry
+    mock_registry.assert_called_once_with(frozenset(mu.devices.BOARD_IDS))
+    registry.start.assert_called_once_with()
+
+
+def test_watch_hotplug():
+    """
+    The registry rescans once a burst of hotplug events has settled.
+    """
+    events, hotplug = socket.socketpair()
+    hotplug.setblocking(False)
+    registry = mu.devices.DeviceRegistry(mu.devices.BOARD_IDS)
+    scanned = threading.Event()
+
+    def scan():
+        registry.stop()
+        scanned.set()
+
+    registry.scan = scan
+    with mock.patch('mu.devices._hotplug_socket', return_value=hotplug), \
+            mock.patch('mu.devices.SETTLE_TIME', 0), \
+            mock.patch('mu.devices.MOUNTS', '/nowhere'):
+        thread = threading.Thread(target=registry._watch)
+        thread.start()
+        events.send(b'add@/devices/usb1/1-1\0ACTION=add\0')
+        events.send(b'add@/devices/usb1/1-1/tty/ttyACM0\0ACTION=add\0')
+        assert scanned.wait(5)
+        thread.join(5)
+    assert not thread.is_alive()
+    assert hotplug.fileno() == -1
+    events.close()
+
+
+def test_watch_without_hotplug():
+    """
+    Without hotplug events the registry rescans every so often, until it's
+    stopped.
+    """
+    registry = mu.devices.DeviceRegistry(mu.devices.BOARD_IDS)
+    registry.scan = mock.MagicMock(side_effect=[Exception('BOOM'), None])
+    waits = []
+
+    def wait(timeout):
+        waits.append(timeout)
+        return len(waits) > 2
+
+    registry._stopping.wait = wait
+    with mock.patch('mu.devices._hotplug_socket', return_value=None):
+        registry._watch()
+    assert waits == [mu.devices.RESCAN_INTERVAL] * 3
+    assert registry.scan.call_count == 2
@@ -0,0 +1,1257 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the file operations on MicroPython boards.
+"""
+from unittest import mock
+import hashlib
+import io
+import struct
+import zlib
+import pytest
+import mu.resources.files as files
+from mu.resources.pyboard import Pyboard, PyboardError
+
+
+class RawREPLSerial:
+    """
+    A fake serial connection which answers like a board's raw REPL: commands
+    terminated by Ctrl-D are acknowledged and produce the (stdout, stderr)
+    returned by the respond function when given the command.
+    """
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.pending = bytearray()
+        self.line = bytearray()
+        self.written = bytearray()
+
+    def inWaiting(self):
+        return len(self.pending)
+
+    def read(self, size=1):
+        data = bytes(self.pending[:size])
+        del self.pending[:size]
+        return data
+
+    def write(self, data):
+        self.written.extend(data)
+        for byte in data:
+            if byte == 1:
+                self.line = bytearray()
+                self.pending.extend(b'raw REPL; CTRL-B to exit\r\n>')
+            elif byte == 3:
+                self.line = bytearray()
+            elif byte == 4 and not self.line:
+                self.pending.extend(b'OK\r\nMPY: soft reboot\r\n'
+                                    b'raw REPL; CTRL-B to exit\r\n>')
+            elif byte == 4:
+                out, err = self.respond(bytes(self.line))
+                self.line = bytearray()
+                self.pending.extend(b'OK' + out + b'\x04' + err + b'\x04>')
+            elif byte not in (2, 13):
+                self.line.append(byte)
+        return len(data)
+
+    def fileno(self):
+        raise AttributeError('no file descriptor')
+
+
+def make_files():
+    """
+    Return a Files instance wrapped around a mock pyboard.
+    """
+    pyboard = mock.MagicMock()
+    return files.Files(pyboard), pyboard
+
+
+def test_session():
+    """
+    A session keeps the pyboard in raw REPL mode until it ends.
+    """
+    board_files, pyboard = make_files()
+    with board_files.session(soft_reset=False):
+        pyboard.raw_repl.assert_called_once_with(False)
+        assert pyboard.raw_repl.return_value.__exit__.call_count == 0
+    assert pyboard.raw_repl.return_value.__exit__.call_count == 1
+
+
+def test_ls_uses_session():
+    """
+    Each operation runs inside a raw REPL session.
+    """
+    board_files, pyboard = make_files()
+    pyboard.exec_.return_value = b"['main.py']\r\n"
+    assert board_files.ls() == ['main.py']
+    pyboard.raw_repl.assert_called_once_with()
+    assert pyboard.raw_repl.return_value.__enter__.call_count == 1
+    assert pyboard.raw_repl.return_value.__exit__.call_count == 1
+    assert pyboard.enter_raw_repl.call_count == 0
+
+
+def test_rm_missing_file():
+    """
+    A missing file is reported as a RuntimeError.
+    """
+    board_files, pyboard = make_files()
+    error = b'Traceback\r\nOSError: [Errno 2] ENOENT\r\n'
+    pyboard.exec_.side_effect = PyboardError('exception', b'', error)
+    with pytest.raises(RuntimeError):
+        board_files.rm('foo.py')
+
+
+def test_rmdir():
+    """
+    A directory is removed along with everything in it without changing the
+    board's current directory, and a missing one is reported as a
+    RuntimeError.
+    """
+    board_files, pyboard = make_files()
+    board_files.rmdir('/lib')
+    command = pyboard.exec_.call_args[0][0]
+    assert command.endswith("rmtree('/lib')\n")
+    assert 'chdir' not in command
+    error = b'Traceback\r\nOSError: [Errno 2] ENOENT\r\n'
+    pyboard.exec_.side_effect = PyboardError('exception', b'', error)
+    with pytest.raises(RuntimeError):
+        board_files.rmdir('/lib')
+
+
+def test_rm_many():
+    """
+    Several paths are removed in one command, which reports those it
+    couldn't remove.
+    """
+    board_files, pyboard = make_files()
+    pyboard.iter_exec.return_value = iter([
+        ('stdout', '1 2\r\n2 '), ('stdout', '13\r\n3 5\r\n')])
+    status = board_files.rm_many(['a.py', 'b.py', 'lib', 'c.py'])
+    assert status == {
+        'a.py': None,
+        'b.py': 'No such file/directory',
+        'lib': 'Directory is not empty',
+        'c.py': 'OSError: [Errno 5]',
+    }
+    assert pyboard.iter_exec.call_count == 1
+    command = pyboard.iter_exec.call_args[0][0]
+    assert command.endswith(
+        "rm_many(['a.py', 'b.py', 'lib', 'c.py'], False)\n")
+
+
+def test_rm_many_nothing():
+    """
+    Removing no paths doesn't bother the board.
+    """
+    board_files, pyboard = make_files()
+    assert board_files.rm_many([], recursive=True) == {}
+    assert pyboard.iter_exec.call_count == 0
+
+
+def test_makedirs():
+    """
+    A directory and any missing parents are made in one command, which
+    returns those it created.
+    """
+    board_files, pyboard = make_files()
+    pyboard.iter_exec.return_value = iter([
+        ('stdout', '=/lib\r\n+/lib/a\r\n+/lib/a/b\r\n')])
+    assert board_files.makedirs('/lib/a/b') == ['/lib/a', '/lib/a/b']
+    assert pyboard.iter_exec.call_args[0][0].endswith(
+        "makedirs('/lib/a/b')\n")
+
+
+def test_makedirs_exists():
+    """
+    A directory which is already there is only an error if exist_ok is
+    False.
+    """
+    board_files, pyboard = make_files()
+    pyboard.iter_exec.side_effect = lambda command: iter([
+        ('stdout', '=/lib\r\n')])
+    assert board_files.makedirs('/lib') == []
+    with pytest.raises(files.DirectoryExistsError):
+        board_files.makedirs('/lib', exist_ok=False)
+
+
+def test_makedirs_file_in_the_way():
+    """
+    A file where a directory should be is reported as a RuntimeError.
+    """
+    board_files, pyboard = make_files()
+    pyboard.iter_exec.return_value = iter([
+        ('stdout', '=/lib\r\n!/lib/a\r\n')])
+    with pytest.raises(RuntimeError):
+        board_files.makedirs('/lib/a/b')
+
+
+def test_session_enters_raw_repl_once():
+    """
+    Several operations inside one session only enter (and soft reset) the
+    raw REPL once.
+    """
+    def respond(command):
+        if b'recv(' in command:
+            # No binary stdin, so the upload falls back to a batch.
+            return b'', b"AttributeError: no attribute 'buffer'\r\n"
+        if b'df(' in command:
+            return b'512 100 50 0\r\n', b''
+        if b'mu_agent' in command:
+            # The board doesn't have the agent.
+            return b'0\r\n', b''
+        return b"['main.py']\r\n", b''
+
+    serial = RawREPLSerial(respond)
+    with mock.patch('serial.Serial', return_value=serial):
+        pyboard = Pyboard('/dev/ttyACM0')
+    board_files = files.Files(pyboard)
+    with board_files.session():
+        assert board_files.ls() == ['main.py']
+        board_files.put('main.py', b'print(1)')
+    assert serial.written.count(b'\r\x01') == 1
+    assert serial.written.startswith(b'\r\x03\x03\r\x01\x04')
+    assert serial.written.count(b'\r\x02') == 1
+    # Only one empty command, i.e. one soft reset, was sent, the agent was
+    # looked for once, and the upload checked for space then fell back to a
+    # single batch.
+    assert serial.written.count(b'\x04') == 1 + 5
+    assert not pyboard.in_raw_repl
+
+
+def test_put_batches():
+    """
+    On a board which can't read binary data from stdin, an upload is sent as
+    batches of commands rather than one command for every chunk of the file.
+    """
+    board_files, pyboard = make_files()
+    pyboard.iter_exec.return_value = iter([
+        ('stderr', "AttributeError: no attribute 'buffer'\r\n")])
+    pyboard.exec_.return_value = b'512 100 50 0\r\n'
+    data = bytes(range(256)) * 5
+    board_files.put('data.bin', data)
+    batches = [c[0][0] for c in pyboard.exec_batch.call_args_list]
+    commands = [command for batch in batches for command in batch]
+    assert len(batches) == 2
+    assert commands[0] == "f = open('data.bin', 'wb')"
+    assert commands[-1] == 'f.close()'
+    written = b''.join(eval(c[len('f.write('):-1]) for c in commands[1:-1])
+    assert written == data
+
+
+def parse_upload(writes):
+    """
+    Return the modes and the (offset, data) blocks the host sent to the
+    receiver on the board, checking they end properly.
+    """
+    stream = b''.join(bytes(w) for w in writes)
+    mode, stream = stream[:2], stream[2:]
+    blocks = []
+    while True:
+        size, offset = struct.unpack('<HI', stream[:6])
+        if not size:
+            break
+        blocks.append((offset, stream[6:6 + size]))
+        stream = stream[6 + size:]
+    assert stream == b'\x00' * 6
+    return mode, blocks
+
+
+def test_put_streams_blocks():
+    """
+    An upload is streamed to a receiver on the board as blocks addressed by
+    their offset, keeping at most UPLOAD_WINDOW blocks unacknowledged.
+    """
+    board_files, pyboard = make_files()
+    data = bytes(range(256)) * 3 + b'end'
+    writes = []
+    pyboard.serial.write.side_effect = writes.append
+    in_flight = []
+
+    def device(command, chunk_size):
+        # No earlier upload to carry on from, and no zlib.
+        yield 'stdout', '0 - -\r\n'
+        yield 'stdout', '\x01'  # ready
+        for i in range(4):
+            in_flight.append((len(writes) - 1) // 2 - i)
+            yield 'stdout', '\x01'
+        yield 'stdout', '771\r\n'
+
+    pyboard.iter_exec.side_effect = device
+    board_files.put('data.bin', data)
+    assert "recv('data.bin', 'data.bin.part')" in \
+        pyboard.iter_exec.call_args[0][0]
+    assert max(in_flight) == files.UPLOAD_WINDOW
+    mode, blocks = parse_upload(writes)
+    assert mode == b'WR'
+    assert [offset for offset, block in blocks] == [0, 256, 512, 768]
+    assert b''.join(block for offset, block in blocks) == data
+    assert pyboard.exec_batch.call_count == 0
+
+
+def test_put_resumes():
+    """
+    An upload carries on from a partial earlier upload of the same data.
+    """
+    board_files, pyboard = make_files()
+    data = bytes(range(256)) * 3
+    writes = []
+    pyboard.serial.write.side_effect = writes.append
+    pyboard.iter_exec.return_value = iter([
+        ('stdout', '300 ' + hashlib.sha256(data[:300]).hexdigest() + ' -\r\n'),
+        ('stdout', '\x01'), ('stdout', '\x01'), ('stdout', '768\r\n')])
+    board_files.put('data.bin', data)
+    mode, blocks = parse_upload(writes)
+    assert mode == b'AR'
+    assert blocks == [(300, data[300:556]), (556, data[556:])]
+
+
+def test_put_restarts():
+    """
+    A partial earlier upload of different data is started again.
+    """
+    board_files, pyboard = make_files()
+    writes = []
+    pyboard.serial.write.side_effect = writes.append
+    pyboard.iter_exec.return_value = iter([
+        ('stdout', '3 ' + hashlib.sha256(b'abc').hexdigest() + ' -\r\n'),
+        ('stdout', '\x01'), ('stdout', '3\r\n')])
+    board_files.put('data.bin', b'xyz')
+    assert parse_upload(writes) == (b'WR', [(0, b'xyz')])
+
+
+def test_put_compressed():
+    """
+    If the board can decompress, compressible data is sent compressed and
+    the saving is reported.
+    """
+    board_files, pyboard = make_files()
+    data = b'time,value\n' + b'1,2\n' * 1000
+    writes = []
+    pyboard.serial.write.side_effect = writes.append
+    pyboard.iter_exec.return_value = iter([
+        ('stdout', '0 - uzlib\r\n'), *[('stdout', '\x01')] * 5,
+        ('stdout', '4011\r\n')])
+    board_files.put('log.csv', data)
+    mode, blocks = parse_upload(writes)
+    assert mode == b'WZ'
+    assert [offset for offset, block in blocks] == [0, 1024, 2048, 3072]
+    assert b''.join(zlib.decompress(block) for offset, block in blocks) == data
+    stats = board_files.last_transfer
+    assert stats.codec == 'uzlib'
+    assert stats.size == len(data)
+    assert stats.speedup > 10
+
+
+def test_put_incompressible():
+    """
+    Data which doesn't compress is sent as it is.
+    """
+    board_files, pyboard = make_files()
+    data = bytes(range(256))
+    writes = []
+    pyboard.serial.write.side_effect = writes.append
+    pyboard.iter_exec.return_value = iter([
+        ('stdout', '0 - deflate\r\n'), ('stdout', '\x01'),
+        ('stdout', '\x01'), ('stdout', '256\r\n')])
+    board_files.put('data.bin', data)
+    assert parse_upload(writes) == (b'WR', [(0, data)])
+    assert board_files.last_transfer.codec is None
+
+
+def test_put_stream_error():
+    """
+    An error on the board while uploading is raised.
+    """
+    board_files, pyboard = make_files()
+    pyboard.iter_exec.return_value = iter([
+        ('stdout', '0 - -\r\n'), ('stdout', '\x01'), ('stdout', '\x01'),
+        ('stderr', 'OSError: 28\r\n')])
+    with pytest.raises(PyboardError) as ex:
+        board_files.put('data.bin', b'x' * 10)
+    assert ex.value.args[2] == b'OSError: 28\r\n'
+    assert pyboard.exec_batch.call_count == 0
+
+
+def test_put_stream_size_mismatch():
+    """
+    The board must report having written every byte.
+    """
+    board_files, pyboard = make_files()
+    pyboard.iter_exec.return_value = iter([
+        ('stdout', '0 - -\r\n'), ('stdout', '\x01'), ('stdout', '\x01'),
+        ('stdout', '3\r\n')])
+    with pytest.raises(RuntimeError):
+        board_files.put('data.bin', b'x' * 10)
+
+
+def test_put_progress():
+    """
+    Progress is reported from where the upload starts and as each block is
+    acknowledged.
+    """
+    board_files, pyboard = make_files()
+    data = bytes(range(256)) * 2 + b'end'
+    pyboard.iter_exec.return_value = iter([
+        ('stdout', '0 - -\r\n'), *[('stdout', '\x01')] * 4,
+        ('stdout', '515\r\n')])
+    progress = mock.MagicMock()
+    board_files.put('data.bin', data, progress)
+    assert progress.call_args_list == [
+        mock.call(0, 515), mock.call(256, 515), mock.call(512, 515),
+        mock.call(515, 515)]
+
+
+def test_put_cancelled():
+    """
+    An exception from the progress callback cancels the upload: nothing more
+    is sent but the cancelling block, and the exception is raised once the
+    board has finished.
+    """
+    board_files, pyboard = make_files()
+    data = bytes(range(256)) * 4
+    writes = []
+    pyboard.serial.write.side_effect = writes.append
+    pyboard.iter_exec.return_value = iter([
+        ('stdout', '0 - -\r\n'), *[('stdout', '\x01')] * 3,
+        ('stdout', '-1\r\n')])
+    ex = KeyError('stop')
+    progress = mock.MagicMock(side_effect=[None, ex])
+    with pytest.raises(KeyError):
+        board_files.put('data.bin', data, progress)
+    stream = b''.join(bytes(w) for w in writes)
+    assert stream.endswith(struct.pack('<HI', 0, files.CANCEL_OFFSET))
+    # The two blocks in flight when it was cancelled, and no more.
+    assert len(stream) == 2 + 2 * (6 + 256) + 6
+    assert progress.call_count == 2
+
+
+def test_put_batches_progress():
+    """
+    Uploads sent as batches report progress after each batch.
+    """
+    board_files, pyboard = make_files()
+    pyboard.iter_exec.return_value = iter([
+        ('stderr', "AttributeError: no attribute 'buffer'\r\n")])
+    pyboard.exec_.return_value = b'512 100 50 0\r\n'
+    data = bytes(range(256)) * 5
+    progress = mock.MagicMock()
+    board_files.put('data.bin', data, progress)
+    assert progress.call_args_list == [
+        mock.call(31 * files.BUFFER_SIZE, 1280), mock.call(1280, 1280)]
+
+
+def test_df():
+    """
+    The board's disk usage is asked for every time, except inside a session
+    where it is asked for once.
+    """
+    board_files, pyboard = make_files()
+    pyboard.exec_.return_value = b'4096 256 100 0\r\n'
+    usage = board_files.df()
+    assert usage == files.DiskUsage(4096, 256, 100)
+    assert (usage.size, usage.free) == (1048576, 409600)
+    assert usage.blocks_for(4097) == 2
+    board_files.df()
+    assert pyboard.exec_.call_count == 2
+    with board_files.session():
+        board_files.df()
+        board_files.df()
+    assert pyboard.exec_.call_count == 3
+    board_files.df()
+    assert pyboard.exec_.call_count == 4
+
+
+def test_put_not_enough_space():
+    """
+    An upload which won't fit, counting whole blocks, is refused before any
+    data is sent.
+    """
+    board_files, pyboard = make_files()
+    writes = []
+    pyboard.serial.write.side_effect = writes.append
+    pyboard.iter_exec.return_value = iter([
+        ('stdout', '0 - - 512 20 3 0\r\n')])
+    with pytest.raises(files.NotEnoughSpaceError):
+        board_files.put('data.bin', b'x' * 1537)
+    assert writes == [b'XX']
+
+
+def test_put_resumed_space():
+    """
+    Resuming an upload only needs room for what is left of it, and inside a
+    session the disk usage is kept up to date without asking the board.
+    """
+    board_files, pyboard = make_files()
+    # Small uploads would otherwise go through the agent.
+    board_files.use_agent = False
+    data = b'x' * 2048
+    pyboard.iter_exec.return_value = iter([
+        ('stdout', '1024 {0} - 512 20 2 600\r\n'.format(
+            hashlib.sha256(data[:1024]).hexdigest())),
+        ('stdout', '\x01'), ('stdout', '\x01'), ('stdout', '\x01'),
+        ('stdout', '\x01'), ('stdout', '\x01'), ('stdout', '2048\r\n')])
+    with board_files.session():
+        board_files.put('data.bin', data)
+        # The partial upload's 2 blocks and the old file's 2 blocks became
+        # the new file's 4.
+        assert board_files.df() == files.DiskUsage(512, 20, 2)
+    assert pyboard.exec_.call_count == 0
+
+
+def test_put_batches_not_enough_space():
+    """
+    Uploads sent as batches check for space first too, counting the blocks
+    of the file they replace.
+    """
+    board_files, pyboard = make_files()
+    pyboard.iter_exec.return_value = iter([
+        ('stderr', "AttributeError: no attribute 'buffer'\r\n")])
+    pyboard.exec_.return_value = b'512 20 1 600\r\n'
+    board_files.put('data.bin', b'x' * 1536)
+    assert "df('data.bin')" in pyboard.exec_.call_args_list[0][0][0]
+    pyboard.iter_exec.return_value = iter([
+        ('stderr', "AttributeError: no attribute 'buffer'\r\n")])
+    pyboard.exec_batch.reset_mock()
+    with pytest.raises(files.NotEnoughSpaceError):
+        board_files.put('data.bin', b'x' * 1537)
+    assert pyboard.exec_batch.call_count == 0
+
+
+def test_put_minified():
+    """
+    With minify set, Python source is minified before it is uploaded and
+    its line map is kept.
+    """
+    board_files, pyboard = make_files()
+    board_files.minify = True
+    writes = []
+    pyboard.serial.write.side_effect = writes.append
+    pyboard.iter_exec.return_value = iter([
+        ('stdout', '0 - -\r\n'), ('stdout', '\x01'), ('stdout', '\x01'),
+        ('stdout', '15\r\n')])
+    with mock.patch.dict(files.line_maps, {}, clear=True):
+        board_files.put('/main.py', b'# Say hello\n\nprint("hello")\n')
+        assert files.line_maps == {'main.py': [3]}
+    assert parse_upload(writes) == (b'WR', [(0, b'print("hello")\n')])
+
+
+def test_put_not_minified():
+    """
+    Files which aren't Python source, or aren't valid Python, are uploaded
+    as they are, and any line map from an earlier upload is dropped.
+    """
+    board_files, pyboard = make_files()
+    board_files.minify = True
+    with mock.patch.dict(files.line_maps, {'main.py': [3]}, clear=True):
+        assert board_files._minify('main.py', b'def f(:\n') == b'def f(:\n'
+        assert files.line_maps == {}
+    board_files._put_stream = mock.MagicMock(return_value=True)
+    board_files.put('data.txt', b'# not python\n')
+    board_files._put_stream.assert_called_once_with(
+        'data.txt', b'# not python\n', None)
+
+
+def test_run_minified(tmpdir):
+    """
+    A minified script's traceback is given the original line numbers.
+    """
+    board_files, pyboard = make_files()
+    board_files.minify = True
+    script = tmpdir.join('script.py')
+    script.write_binary(b'"""Doc."""\n\nx = 1\n\n1 / 0\n')
+    error = b'Traceback:\r\n  File "<stdin>", line 2, in <module>\r\n'
+    pyboard.exec_.side_effect = PyboardError('exception', b'', error)
+    with mock.patch.dict(files.line_maps, {}, clear=True):
+        with pytest.raises(PyboardError) as ex:
+            board_files.run(str(script))
+    pyboard.exec_.assert_called_once_with(b'x=1\n1/0\n')
+    assert ex.value.args[2] == \
+        b'Traceback:\r\n  File "<stdin>", line 5, in <module>\r\n'
+
+
+def make_download(stream):
+    """
+    Return a Files instance wrapped around a mock pyboard which receives the
+    given bytes from the board after a command is run.
+    """
+    board_files, pyboard = make_files()
+    pending = io.BytesIO(stream)
+
+    def read_until(min_num_bytes, ending, timeout=10):
+        data = b''
+        while not data.endswith(ending):
+            data += pending.read(1)
+        return data
+
+    pyboard.read_exact.side_effect = lambda size: pending.read(size)
+    pyboard.read_until.side_effect = read_until
+    pyboard.follow.side_effect = lambda timeout: (read_until(1, b'\x04')[:-1],
+                                                  read_until(1, b'\x04')[:-1])
+    return board_files, pyboard
+
+
+def frames(data, digest=None, start=0):
+    """
+    Return the frames a board sends for a download of data from start.
+    """
+    if digest is None:
+        digest = hashlib.sha256(data).hexdigest().encode('ascii')
+    result = b'S' + struct.pack('<II', start, len(data))
+    for i in range(start, len(data), 4):
+        block = data[i:i + 4]
+        result += b'D' + bytes((len(block), 0)) + block
+    return result + b'H' + bytes((len(digest), 0)) + digest + b'\x04\x04'
+
+
+def test_get_to(tmpdir):
+    """
+    A download is written to the destination as it arrives and its hash is
+    checked.
+    """
+    data = b'\x04binary\r\ndata\x03'
+    board_files, pyboard = make_download(frames(data))
+    local = str(tmpdir.join('data.bin'))
+    assert board_files.get_to('data.bin', local, block_size=4) == len(data)
+    with open(local, 'rb') as f:
+        assert f.read() == data
+    program = pyboard.exec_raw_no_follow.call_args[0][0]
+    assert "send('data.bin', 4, 0, True)" in program
+
+
+def test_get_to_resumes(tmpdir):
+    """
+    A download to a path carries on from a partial earlier download.
+    """
+    data = b'0123456789abcdef'
+    board_files, pyboard = make_download(frames(data, start=8))
+    local = tmpdir.join('data.bin')
+    tmpdir.join('data.bin.part').write_binary(data[:8])
+    assert board_files.get_to('data.bin', str(local), block_size=4) == 16
+    assert local.read_binary() == data
+    assert not tmpdir.join('data.bin.part').exists()
+    program = pyboard.exec_raw_no_follow.call_args[0][0]
+    assert "send('data.bin', 4, 8, True)" in program
+
+
+def test_get_to_restarts(tmpdir):
+    """
+    A board which can't check the partial download sends it all again.
+    """
+    data = b'0123456789abcdef'
+    board_files, pyboard = make_download(frames(data, b''))
+    local = tmpdir.join('data.bin')
+    tmpdir.join('data.bin.part').write_binary(b'stale')
+    assert board_files.get_to('data.bin', str(local)) == 16
+    assert local.read_binary() == data
+
+
+def test_get_to_stale(tmpdir):
+    """
+    A stale partial download is caught by the hash and thrown away.
+    """
+    data = b'0123456789abcdef'
+    board_files, pyboard = make_download(frames(data, start=5))
+    local = tmpdir.join('data.bin')
+    tmpdir.join('data.bin.part').write_binary(b'stale')
+    with pytest.raises(RuntimeError):
+        board_files.get_to('data.bin', str(local))
+    assert not local.exists()
+    assert not tmpdir.join('data.bin.part').exists()
+
+
+def test_get_compressed():
+    """
+    Compressed frames from the board are decompressed, and the saving is
+    reported.
+    """
+    data = b'1,2\n' * 1000
+    compressed = zlib.compress(data)
+    digest = hashlib.sha256(data).hexdigest().encode('ascii')
+    board_files, pyboard = make_download(b''.join([
+        b'S', struct.pack('<II', 0, len(data)),
+        b'Z', struct.pack('<H', len(compressed)), compressed,
+        b'H\x40\x00', digest, b'\x04\x04']))
+    assert board_files.get('log.csv') == data
+    assert "send('log.csv', 1024, 0, True)" in \
+        pyboard.exec_raw_no_follow.call_args[0][0]
+    assert board_files.last_transfer.codec == 'deflate'
+    assert board_files.last_transfer.speedup > 10
+
+
+def test_get_corrupt():
+    """
+    A download whose hash doesn't match is an error.
+    """
+    board_files, pyboard = make_download(frames(b'data', b'0' * 64))
+    with pytest.raises(RuntimeError):
+        board_files.get('data.bin')
+
+
+def test_get_without_hash():
+    """
+    Boards which can't hash still send the file.
+    """
+    board_files, pyboard = make_download(frames(b'data', b''))
+    assert board_files.get('data.bin') == b'data'
+
+
+def test_get_missing_file():
+    """
+    A missing file is reported as a RuntimeError.
+    """
+    board_files, pyboard = make_download(
+        b'\x04Traceback\r\nOSError: [Errno 2] ENOENT\r\n\x04')
+    with pytest.raises(RuntimeError):
+        board_files.get('data.bin')
+
+
+def test_get_hex():
+    """
+    Boards without a binary stdout send the file as lines of hex.
+    """
+    board_files, pyboard = make_download(
+        b'\x04AttributeError: no attribute buffer\r\n\x04')
+    pyboard.iter_exec.return_value = iter([
+        ('stdout', '6461'), ('stdout', '7461\r\n00'), ('stdout', '\r\n')])
+    assert board_files.get('data.bin') == b'data\x00'
+
+
+def test_get_progress():
+    """
+    Progress is reported as each block of a download arrives.
+    """
+    board_files, pyboard = make_download(frames(b'0123456789'))
+    progress = mock.MagicMock()
+    board_files.get_to('data.bin', io.BytesIO(), 4, progress)
+    assert progress.call_args_list == [
+        mock.call(0, 10), mock.call(4, 10), mock.call(8, 10),
+        mock.call(10, 10)]
+
+
+def test_get_cancelled(tmpdir):
+    """
+    An exception from the progress callback asks the board to stop, and is
+    raised once it has.  The partial download is kept to carry on from.
+    """
+    data = b'0123456789'
+    stream = frames(data)
+    board_files, pyboard = make_download(
+        stream[:stream.index(b'D\x02')] + b'C\x04\x04')
+    local = tmpdir.join('data.bin')
+    progress = mock.MagicMock(side_effect=[None, None, KeyError('stop')])
+    with pytest.raises(KeyError):
+        board_files.get_to('data.bin', str(local), 4, progress)
+    pyboard.serial.write.assert_called_once_with(files.CANCEL_BYTE)
+    assert not local.exists()
+    assert tmpdir.join('data.bin.part').read_binary() == b'01234567'
+
+
+def test_get_cancelled_too_late():
+    """
+    If the board finished before it saw the cancel request, the raw REPL
+    line it was left in is cleared.
+    """
+    board_files, pyboard = make_download(frames(b'0123'))
+    progress = mock.MagicMock(side_effect=KeyError('stop'))
+    with pytest.raises(KeyError):
+        board_files.get_to('data.bin', io.BytesIO(), 4, progress)
+    assert pyboard.serial.write.call_args_list == [
+        mock.call(files.CANCEL_BYTE), mock.call(b'\x03')]
+
+
+def make_sync(tmpdir, remote_lines):
+    """
+    Return a Files instance whose board reports the given scan of its
+    files, and a local directory to sync with it.
+    """
+    local = tmpdir.mkdir('project')
+    local.join('main.py').write('print(1)\n')
+    local.mkdir('lib').join('util.py').write('x = 1\n')
+    local.mkdir('__pycache__').join('main.pyc').write('junk')
+    local.join('.hidden').write('secret')
+    board_files, pyboard = make_files()
+    pyboard.iter_exec.side_effect = lambda command: iter(
+        [('stdout', ''.join(line + '\r\n' for line in remote_lines))])
+    # Its filesystem has 50 free blocks of 512 bytes.
+    pyboard.exec_.return_value = b'512 100 50 0\r\n'
+    return board_files, pyboard, str(local)
+
+
+def digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def test_sync_dry_run(tmpdir):
+    """
+    A dry run reports what differs without changing anything.
+    """
+    board_files, pyboard, local = make_sync(tmpdir, [
+        'R',
+        'D\tlib',
+        'F\t' + digest(b'print(1)\n') + '\t9\tmain.py',
+        'F\t' + digest(b'old') + '\t3\tlib/util.py',
+        'F\t-\t10\tlib/other.py',
+        'D\tdocs',
+    ])
+    actions = board_files.sync(local, '/app', dry_run=True)
+    assert actions == [('rm', 'lib/other.py'), ('rmdir', 'docs'),
+                       ('put', 'lib/util.py')]
+    assert "scan('/app', '.mu_manifest.json')" in \
+        pyboard.iter_exec.call_args[0][0]
+    assert pyboard.exec_batch.call_count == 0
+    assert pyboard.exec_.call_count == 0
+
+
+def test_sync_unchanged(tmpdir):
+    """
+    Nothing is sent when the board already matches.
+    """
+    board_files, pyboard, local = make_sync(tmpdir, [
+        'R',
+        'D\tlib',
+        'F\t' + digest(b'print(1)\n') + '\t9\tmain.py',
+        'F\t' + digest(b'x = 1\n') + '\t6\tlib/util.py',
+    ])
+    assert board_files.sync(local) == []
+    assert pyboard.exec_batch.call_count == 0
+    assert pyboard.exec_.call_count == 0
+
+
+def test_sync_new_directory(tmpdir):
+    """
+    Syncing to a new directory creates it, uploads everything and leaves a
+    manifest of the hashes.
+    """
+    board_files, pyboard, local = make_sync(tmpdir, [])
+    with mock.patch.object(board_files, "_put") as put:
+        actions = board_files.sync(local, '/app', delete=False)
+    assert actions == [('mkdir', ''), ('mkdir', 'lib'), ('put', 'lib/util.py'),
+                       ('put', 'main.py')]
+    pyboard.exec_batch.assert_called_once_with([
+        'import uos', "uos.mkdir('/app')", "uos.mkdir('/app/lib')"])
+    assert put.call_args_list == [mock.call('/app/lib/util.py', b'x = 1\n'),
+                                  mock.call('/app/main.py', b'print(1)\n')]
+    manifest = pyboard.exec_.call_args[0][0]
+    assert repr(digest(b'x = 1\n')) in manifest
+    assert "manifest('/app', '.mu_manifest.json'" in manifest
+
+
+def test_sync_caches_local_hashes(tmpdir):
+    """
+    Local files are only hashed again once they have changed.
+    """
+    board_files, pyboard, local = make_sync(tmpdir, ['R'])
+    board_files.sync(local, dry_run=True)
+    with mock.patch('mu.resources.files.hashlib.sha256') as sha256:
+        board_files.sync(local, dry_run=True)
+    assert sha256.call_count == 0
+
+
+def test_sync_not_enough_space(tmpdir):
+    """
+    A sync which would fill the board up is refused before anything is
+    changed, allowing for what it removes and replaces.
+    """
+    board_files, pyboard, local = make_sync(tmpdir, [
+        'R',
+        'F\t-\t9\tmain.py',
+        'F\t-\t1024\told.bin',
+    ])
+    # lib and lib/util.py need a block each, main.py replaces itself and
+    # removing old.bin frees 2 blocks.
+    pyboard.exec_.return_value = b'512 100 0 0\r\n'
+    with mock.patch.object(board_files, '_put') as put:
+        with pytest.raises(files.NotEnoughSpaceError):
+            board_files.sync(local)
+        assert pyboard.exec_batch.call_count == 0
+        pyboard.exec_.return_value = b'512 100 1 0\r\n'
+        board_files.sync(local)
+    assert put.call_count == 2
+
+
+@mock.patch('mu.resources.files.agent.Agent')
+@mock.patch('mu.resources.files.agent.start',
+            return_value=files.agent.VERSION)
+def test_sync_in_session(mock_start, mock_agent, tmpdir):
+    """
+    Inside a session small files are uploaded through the agent, which is
+    stopped before the manifest is written.
+    """
+    board_files, pyboard, local = make_sync(tmpdir, ['R'])
+    client = mock_agent.return_value
+    client.exec_.return_value = '(512, 20, 10, 0)'
+    stopped = []
+    client.stop.side_effect = lambda: stopped.append(pyboard.exec_.call_count)
+    with board_files.session():
+        board_files.sync(local)
+    assert client.write.call_args_list == [
+        mock.call('/lib/util.py.part', b'x = 1\n', append=False),
+        mock.call('/main.py.part', b'print(1)\n', append=False)]
+    assert stopped == [pyboard.exec_.call_count - 1]
+    assert "manifest('', '.mu_manifest.json'" in \
+        pyboard.exec_.call_args[0][0]
+
+
+def test_walk():
+    """
+    The whole tree comes back from one command, with its metadata.
+    """
+    board_files, pyboard = make_files()
+    pyboard.iter_exec.return_value = iter([
+        ('stdout', 'D\t0\t10\t/lib\r\nF\t12\t20\t/main'),
+        ('stdout', '.py\r\nF\t3\t30\t/lib/a b.py\r\n')])
+    assert list(board_files.walk()) == [
+        files.FileInfo('/lib', True, 0, 10),
+        files.FileInfo('/main.py', False, 12, 20),
+        files.FileInfo('/lib/a b.py', False, 3, 30)]
+    assert pyboard.iter_exec.call_count == 1
+    assert pyboard.raw_repl.return_value.__exit__.call_count == 1
+
+
+def test_walk_missing_directory():
+    """
+    A missing directory is reported as a RuntimeError.
+    """
+    board_files, pyboard = make_files()
+    pyboard.iter_exec.return_value = iter([
+        ('stderr', 'Traceback\r\nOSError: [Errno 2] ENOENT\r\n')])
+    with pytest.raises(RuntimeError):
+        list(board_files.walk('/nope'))
+
+
+@mock.patch('mu.resources.files.agent.Agent')
+@mock.patch('mu.resources.files.agent.start',
+            return_value=files.agent.VERSION)
+def test_agent_used_in_session(mock_start, mock_agent):
+    """
+    Inside a session the agent is started once and answers ls, mkdir and rm,
+    then is stopped at the end.  Outside a session commands are sent.
+    """
+    board_files, pyboard = make_files()
+    client = mock_agent.return_value
+    client.ls.return_value = ['main.py']
+    with board_files.session():
+        assert board_files.ls() == ['main.py']
+        board_files.mkdir('lib')
+        board_files.rm('old.py')
+        client.stop.assert_not_called()
+    mock_start.assert_called_once_with(pyboard)
+    client.mkdir.assert_called_once_with('lib')
+    client.rm.assert_called_once_with('old.py')
+    client.stop.assert_called_once_with()
+    assert pyboard.exec_.call_count == 0
+    pyboard.exec_.return_value = b"['main.py']\r\n"
+    board_files.ls()
+    assert pyboard.exec_.call_count == 1
+    assert mock_start.call_count == 1
+
+
+@mock.patch('mu.resources.files.agent.Agent')
+@mock.patch('mu.resources.files.agent.start',
+            return_value=files.agent.VERSION)
+def test_agent_errors(mock_start, mock_agent):
+    """
+    Errors from the agent are reported as they are for commands.
+    """
+    board_files, pyboard = make_files()
+    client = mock_agent.return_value
+    client.ls.side_effect = PyboardError('exception', b'',
+                                         b'OSError: [Errno 2] ENOENT')
+    client.mkdir.side_effect = PyboardError('exception', b'',
+                                            b'OSError: [Errno 17] EEXIST')
+    client.rm.side_effect = PyboardError('exception', b'',
+                                         b'OSError: [Errno 13] EACCES')
+    with board_files.session():
+        with pytest.raises(RuntimeError):
+            board_files.ls('/nope')
+        with pytest.raises(files.DirectoryExistsError):
+            board_files.mkdir('lib')
+        with pytest.raises(RuntimeError) as ex:
+            board_files.rm('lib')
+    assert 'not empty' in str(ex.value)
+
+
+@mock.patch('mu.resources.files.agent.Agent')
+@mock.patch('mu.resources.files.agent.start', return_value=0)
+def test_agent_missing(mock_start, mock_agent):
+    """
+    A board without the agent is only asked once in a session, and gets
+    commands instead.
+    """
+    board_files, pyboard = make_files()
+    pyboard.exec_.return_value = b"['main.py']\r\n"
+    with board_files.session():
+        board_files.ls()
+        board_files.ls()
+    assert mock_start.call_count == 1
+    assert pyboard.exec_.call_count == 2
+    mock_agent.assert_not_called()
+
+
+@mock.patch('mu.resources.files.agent.Agent')
+@mock.patch('mu.resources.files.agent.start')
+def test_agent_stale(mock_start, mock_agent):
+    """
+    A board with another version of the agent has it replaced, and the new
+    one started.
+    """
+    board_files, pyboard = make_files()
+    mock_start.side_effect = [files.agent.VERSION + 1, files.agent.VERSION]
+    with mock.patch.object(board_files, 'install_agent') as install_agent:
+        with board_files.session():
+            board_files.ls()
+    install_agent.assert_called_once_with()
+    assert mock_start.call_count == 2
+    mock_agent.return_value.ls.assert_called_once_with('/')
+
+
+@mock.patch('mu.resources.files.agent.Agent')
+@mock.patch('mu.resources.files.agent.start',
+            return_value=files.agent.VERSION)
+def test_agent_stopped_for_commands(mock_start, mock_agent):
+    """
+    The agent is stopped before a command is sent, and started again when
+    it's next needed.
+    """
+    board_files, pyboard = make_files()
+    client = mock_agent.return_value
+    client.running = True
+    pyboard.exec_.side_effect = \
+        lambda command: client.stop.assert_called_once_with()
+    with board_files.session():
+        board_files.ls()
+        board_files.rmdir('lib')
+        board_files.ls()
+    assert mock_start.call_count == 2
+    assert client.stop.call_count == 2
+
+
+@mock.patch('mu.resources.files.agent.Agent')
+@mock.patch('mu.resources.files.agent.start',
+            return_value=files.agent.VERSION)
+def test_agent_failed(mock_start, mock_agent):
+    """
+    Once talking to the agent fails it isn't used again in the session.
+    """
+    board_files, pyboard = make_files()
+    client = mock_agent.return_value
+    client.running = True
+
+    def fail(path):
+        client.running = False
+        raise OSError('device disconnected')
+
+    client.ls.side_effect = fail
+    pyboard.exec_.return_value = b"['main.py']\r\n"
+    with board_files.session():
+        with pytest.raises(OSError):
+            board_files.ls()
+        assert board_files.ls() == ['main.py']
+    assert mock_start.call_count == 1
+
+
+def test_install_agent():
+    """
+    The agent is installed minified.
+    """
+    board_files, pyboard = make_files()
+    with mock.patch.object(board_files, '_put') as mock_put:
+        board_files.install_agent()
+    name, data = mock_put.call_args[0]
+    assert name == files.agent.AGENT_PATH
+    assert data == files.minify_source(files.agent.SOURCE).source.encode()
+
+
+@mock.patch('mu.resources.files.agent.Agent')
+@mock.patch('mu.resources.files.agent.start',
+            return_value=files.agent.VERSION)
+def test_put_agent(mock_start, mock_agent):
+    """
+    Inside a session a small upload goes through the agent, a block at a
+    time to a temporary file which is then renamed.
+    """
+    board_files, pyboard = make_files()
+    client = mock_agent.return_value
+    client.exec_.side_effect = ['(512, 20, 10, 600)', 'None']
+    progress = []
+    with board_files.session():
+        board_files.put('data.bin', b'x' * 300,
+                        progress=lambda *args: progress.append(args))
+        assert board_files.df() == files.DiskUsage(512, 20, 11)
+    assert client.write.call_args_list == [
+        mock.call('data.bin.part', b'x' * 256, append=False),
+        mock.call('data.bin.part', b'x' * 44, append=True)]
+    assert client.exec_.call_args_list == [
+        mock.call("df('data.bin')"),
+        mock.call("rename('data.bin.part', 'data.bin')")]
+    assert progress == [(0, 300), (256, 300), (300, 300)]
+    assert board_files.last_transfer.size == 300
+    assert pyboard.iter_exec.call_count == 0
+
+
+@mock.patch('mu.resources.files.agent.Agent')
+@mock.patch('mu.resources.files.agent.start',
+            return_value=files.agent.VERSION)
+def test_put_agent_not_enough_space(mock_start, mock_agent):
+    """
+    An upload through the agent which won't fit is refused before any data
+    is sent.  The file it replaces doesn't count, as it's only removed once
+    the upload is complete.
+    """
+    board_files, pyboard = make_files()
+    client = mock_agent.return_value
+    client.exec_.return_value = '(512, 20, 1, 600)'
+    with board_files.session():
+        with pytest.raises(files.NotEnoughSpaceError):
+            board_files.put('data.bin', b'x' * 1024)
+    client.write.assert_not_called()
+
+
+@mock.patch('mu.resources.files.agent.Agent')
+@mock.patch('mu.resources.files.agent.start',
+            return_value=files.agent.VERSION)
+def test_put_agent_failed(mock_start, mock_agent):
+    """
+    If an upload through the agent fails, the partial file is removed.
+    """
+    board_files, pyboard = make_files()
+    client = mock_agent.return_value
+    client.exec_.return_value = '(512, 20, 10, 0)'
+    error = PyboardError('exception', b'', b'OSError: 28\r\n')
+    client.write.side_effect = [None, error]
+    with board_files.session():
+        with pytest.raises(PyboardError):
+            board_files.put('data.bin', b'x' * 300)
+    client.rm.assert_called_once_with('data.bin.part')
+
+
+@mock.patch('mu.resources.files.agent.Agent')
+@mock.patch('mu.resources.files.agent.start',
+            return_value=files.agent.VERSION)
+def test_get_agent(mock_start, mock_agent):
+    """
+    Inside a session a small download goes through the agent, checking its
+    hash, while a big one is streamed.
+    """
+    board_files, pyboard = make_files()
+    client = mock_agent.return_value
+    data = bytes(range(256)) * 2
+    client.stat.return_value = (0x8000, 0, 0, 0, 0, 0, len(data), 0, 0, 0)
+    client.read.side_effect = lambda path, offset, size: \
+        data[offset:offset + size]
+    client.hash.return_value = hashlib.sha256(data).hexdigest()
+    progress = []
+    with board_files.session():
+        out = io.BytesIO()
+        board_files.get_to('data.bin', out, block_size=200,
+                           progress=lambda *args: progress.append(args))
+        assert out.getvalue() == data
+        assert progress == [(0, 512), (200, 512), (400, 512), (512, 512)]
+        client.hash.return_value = '0' * 64
+        with pytest.raises(RuntimeError):
+            board_files.get('data.bin')
+        client.stat.return_value = (0x8000, 0, 0, 0, 0, 0, 5000, 0, 0, 0)
+        pyboard.read_exact.side_effect = PyboardError('streamed')
+        with pytest.raises(PyboardError):
+            board_files.get('big.bin')
+    assert client.read.call_count == 4
+
+
+@mock.patch('mu.resources.files.agent.Agent')
+@mock.patch('mu.resources.files.agent.start',
+            return_value=files.agent.VERSION)
+def test_get_agent_missing(mock_start, mock_agent):
+    """
+    A missing file is reported as a RuntimeError.
+    """
+    board_files, pyboard = make_files()
+    mock_agent.return_value.stat.side_effect = PyboardError(
+        'exception', b'', b'OSError: [Errno 2] ENOENT')
+    with board_files.session():
+        with pytest.raises(RuntimeError):
+            board_files.get('nope.bin')
+
+
+@pytest.fixture
+def cached_files():
+    """
+    A CachedFiles instance wrapped around a mock pyboard, with no boards
+    cached yet.
+    """
+    with mock.patch.dict(files._board_caches, clear=True):
+        pyboard = mock.MagicMock()
+        yield files.CachedFiles(pyboard), pyboard
+
+
+def test_cached_ls(cached_files):
+    """
+    A listing is fetched once, and then comes from the cache while the
+    board's fingerprint stays the same.
+    """
+    board_files, pyboard = cached_files
+    assert board_files.cached_ls() is None
+    pyboard.exec_.return_value = b"1234\r\n[10]\r\n['main.py']\r\n"
+    assert board_files.ls() == ['main.py']
+    assert "check('', '/')" in pyboard.exec_.call_args[0][0]
+    pyboard.exec_.return_value = b"1234\r\n[10]\r\n"
+    assert board_files.ls() == ['main.py']
+    assert "check('[10]', '/')" in pyboard.exec_.call_args[0][0]
+    assert board_files.cached_ls() == ['main.py']
+    # Another connection to the same board shares the cache.
+    other = files.CachedFiles(mock.MagicMock())
+    other.board_id = '1234'
+    assert other.cached_ls() == ['main.py']
+
+
+def test_cached_ls_changed(cached_files):
+    """
+    When the board's fingerprint changes its cached listings are dropped.
+    """
+    board_files, pyboard = cached_files
+    pyboard.exec_.return_value = b"1234\r\n[10]\r\n['a.py']\r\n"
+    board_files.ls('/lib')
+    pyboard.exec_.return_value = b"1234\r\n[9]\r\n['main.py']\r\n"
+    assert board_files.ls() == ['main.py']
+    assert board_files.cached_ls('/lib') is None
+
+
+def test_cached_write_through(cached_files):
+    """
+    Changes made through the cache update it without listing again.
+    """
+    board_files, pyboard = cached_files
+    pyboard.exec_.return_value = b"1234\r\n[10]\r\n['main.py']\r\n"
+    board_files.ls()
+    pyboard.exec_.return_value = b"1234\r\n[8]\r\n"
+    with mock.patch('mu.resources.files.Files._put'):
+        board_files.put('/boot.py', b'x')
+    board_files.mkdir('/lib')
+    assert board_files.cached_ls() == ['main.py', 'boot.py', 'lib']
+    assert board_files.cached_ls('lib') == []
+    board_files.rm('main.py')
+    assert board_files.cached_ls() == ['boot.py', 'lib']
+    board_files.rmdir('/lib')
+    assert board_files.cached_ls('/lib') is None
+    # The new fingerprint was taken, so listing again needs no listdir.
+    assert board_files.ls() == ['boot.py']
+    assert "check('[8]', '/')" in pyboard.exec_.call_args[0][0]
+
+
+def test_cached_bulk_changes(cached_files):
+    """
+    Bulk changes update the cache for each path which changed, taking the
+    board's fingerprint once.
+    """
+    board_files, pyboard = cached_files
+    pyboard.exec_.return_value = b"1234\r\n[10]\r\n['main.py', 'lib']\r\n"
+    board_files.ls()
+    pyboard.exec_.return_value = b"1234\r\n[8]\r\n"
+    pyboard.iter_exec.return_value = iter([
+        ('stdout', '=/lib\r\n+/lib/a\r\n+/lib/a/b\r\n')])
+    board_files.makedirs('/lib/a/b')
+    assert board_files.cached_ls('/lib/a') == ['b']
+    assert board_files.cached_ls('/lib/a/b') == []
+    assert pyboard.exec_.call_count == 2
+    pyboard.iter_exec.return_value = iter([('stdout', '1 2\r\n')])
+    board_files.rm_many(['/lib', 'gone.py', 'main.py'], recursive=True)
+    assert board_files.cached_ls() == []
+    assert board_files.cached_ls('/lib/a') is None
+    assert pyboard.exec_.call_count == 3
@@ -8,6 +8,7 @@ from PyQt5.QtCore import QIODevice, Qt, QSize
 from PyQt5.QtGui import QTextCursor, QIcon
 from unittest import mock
 from mu import __version__
+from mu.resources.files import DiskUsage
 import os
 import platform
 import mu.interface
@@ -957,6 +958,7 @@ def test_Window_add_filesystem():
     w.splitter.setSizes.assert_called_once_with([66, 33])
     mock_fs.setFocus.assert_called_once_with()
     w.connect_zoom.assert_called_once_with(mock_fs)
+    mock_fs.transfers.df.assert_called_once_with()
 
 
 def test_Window_add_repl():
@@ -996,6 +998,7 @@ def test_Window_remove_filesystem():
     mock_fs.deleteLater = mock.MagicMock(return_value=None)
     w.fs = mock_fs
     w.remove_filesystem()
+    mock_fs.transfers.stop.assert_called_once_with()
     mock_fs.setParent.assert_called_once_with(None)
     mock_fs.deleteLater.assert_called_once_with()
     assert w.fs is None
@@ -1011,6 +1014,7 @@ def test_Window_remove_repl():
     mock_repl.deleteLater = mock.MagicMock(return_value=None)
     w.repl = mock_repl
     w.remove_repl()
+    mock_repl.disconnect.assert_called_once_with()
     mock_repl.setParent.assert_called_once_with(None)
     mock_repl.deleteLater.assert_called_once_with()
     assert w.repl is None
@@ -1296,7 +1300,7 @@ def test_REPLPane_init_default_args():
     mock_serial.readyRead.connect = mock.MagicMock(return_value=None)
     mock_serial.write = mock.MagicMock(return_value=None)
     mock_serial_class = mock.MagicMock(return_value=mock_serial)
-    with mock.patch('mu.interface.QSerialPort', mock_serial_class):
+    with mock.patch('mu.interface.SharedPort', mock_serial_class):
         rp = mu.interface.REPLPane('COM0')
     assert mock_serial_class.call_count == 1
     mock_serial.setPortName.assert_called_once_with('COM0')
@@ -1315,7 +1319,7 @@ def test_REPLPane_init_cannot_open():
     mock_serial.setBaudRate = mock.MagicMock(return_value=None)
     mock_serial.open = mock.MagicMock(return_value=False)
     mock_serial_class = mock.MagicMock(return_value=mock_serial)
-    with mock.patch('mu.interface.QSerialPort', mock_serial_class):
+    with mock.patch('mu.interface.SharedPort', mock_serial_class):
         with pytest.raises(IOError):
             mu.interface.REPLPane('COM0')
 
@@ -1336,7 +1340,7 @@ def test_REPLPane_paste():
     mock_clipboard.text.return_value = 'paste me!'
     mock_application = mock.MagicMock()
     mock_application.clipboard.return_value = mock_clipboard
-    with mock.patch('mu.interface.QSerialPort', mock_serial_class):
+    with mock.patch('mu.interface.SharedPort', mock_serial_class):
         with mock.patch('mu.interface.QApplication', mock_application):
             rp = mu.interface.REPLPane('COM0')
             mock_serial.write.reset_mock()
@@ -1360,7 +1364,7 @@ def test_REPLPane_paste_only_works_if_there_is_something_to_paste():
     mock_clipboard.text.return_value = ''
     mock_application = mock.MagicMock()
     mock_application.clipboard.return_value = mock_clipboard
-    with mock.patch('mu.interface.QSerialPort', mock_serial_class):
+    with mock.patch('mu.interface.SharedPort', mock_serial_class):
         with mock.patch('mu.interface.QApplication', mock_application):
             rp = mu.interface.REPLPane('COM0')
             mock_serial.write.reset_mock()
@@ -1385,7 +1389,7 @@ def test_REPLPane_context_menu():
     mock_platform.system.return_value = 'WinNT'
     mock_qmenu = mock.MagicMock()
     mock_qmenu_class = mock.MagicMock(return_value=mock_qmenu)
-    with mock.patch('mu.interface.QSerialPort', mock_serial_class), \
+    with mock.patch('mu.interface.SharedPort', mock_serial_class), \
             mock.patch('mu.interface.platform', mock_platform), \
             mock.patch('mu.interface.QMenu', mock_qmenu_class), \
             mock.patch('mu.interface.QCursor'):
@@ -1420,7 +1424,7 @@ def test_REPLPane_context_menu_darwin():
     mock_platform.system.return_value = 'Darwin'
     mock_qmenu = mock.MagicMock()
     mock_qmenu_class = mock.MagicMock(return_value=mock_qmenu)
-    with mock.patch('mu.interface.QSerialPort', mock_serial_class), \
+    with mock.patch('mu.interface.SharedPort', mock_serial_class), \
             mock.patch('mu.interface.platform', mock_platform), \
             mock.patch('mu.interface.QMenu', mock_qmenu_class), \
             mock.patch('mu.interface.QCursor'):
@@ -1449,7 +1453,7 @@ def test_REPLPane_cursor_to_end():
     mock_serial.open = mock.MagicMock(return_value=True)
     mock_serial_class = mock.MagicMock(return_value=mock_serial)
     mock_text_cursor = mock.MagicMock()
-    with mock.patch('mu.interface.QSerialPort', mock_serial_class):
+    with mock.patch('mu.interface.SharedPort', mock_serial_class):
         rp = mu.interface.REPLPane('COM0')
         rp.textCursor = mock.MagicMock(return_value=mock_text_cursor)
         rp.setTextCursor = mock.MagicMock()
@@ -1467,7 +1471,7 @@ def test_REPLPane_set_theme():
     mock_serial.setBaudRate = mock.MagicMock(return_value=None)
     mock_serial.open = mock.MagicMock(return_value=True)
     mock_serial_class = mock.MagicMock(return_value=mock_serial)
-    with mock.patch('mu.interface.QSerialPort', mock_serial_class):
+    with mock.patch('mu.interface.SharedPort', mock_serial_class):
         rp = mu.interface.REPLPane('COM0')
         rp.setStyleSheet = mock.MagicMock(return_value=None)
         rp.set_theme('day')
@@ -1487,13 +1491,54 @@ def test_REPLPane_on_serial_read():
     mock_serial.open = mock.MagicMock(return_value=True)
     mock_serial.readAll = mock.MagicMock(return_value='abc'.encode('utf-8'))
     mock_serial_class = mock.MagicMock(return_value=mock_serial)
-    with mock.patch('mu.interface.QSerialPort', mock_serial_class):
+    with mock.patch('mu.interface.SharedPort', mock_serial_class):
         rp = mu.interface.REPLPane('COM0')
         rp.process_bytes = mock.MagicMock()
         rp.on_serial_read()
         rp.process_bytes.assert_called_once_with(bytes('abc'.encode('utf-8')))
 
 
+def test_REPLPane_on_serial_read_traceback():
+    """
+    Tracebacks from a minified script are shown with its original line
+    numbers.
+    """
+    mock_serial = mock.MagicMock()
+    mock_serial.open = mock.MagicMock(return_value=True)
+    mock_serial.readAll = mock.MagicMock(
+        return_value=b'  File "main.py", line 2, in <module>\r\n')
+    mock_serial_class = mock.MagicMock(return_value=mock_serial)
+    with mock.patch('mu.interface.SharedPort', mock_serial_class), \
+            mock.patch.dict('mu.resources.minify.line_maps',
+                            {'main.py': [4, 9]}, clear=True):
+        rp = mu.interface.REPLPane('COM0')
+        rp.process_bytes = mock.MagicMock()
+        rp.on_serial_read()
+    rp.process_bytes.assert_called_once_with(
+        b'  File "main.py", line 9, in <module>\r\n')
+
+
+def test_REPLPane_keyPressEvent_return_drops_stdin_map():
+    """
+    Once the user enters something at the REPL, tracebacks from <stdin> are
+    no longer from a minified script which was run.
+    """
+    mock_serial = mock.MagicMock()
+    mock_serial.open = mock.MagicMock(return_value=True)
+    mock_serial_class = mock.MagicMock(return_value=mock_serial)
+    with mock.patch('mu.interface.SharedPort', mock_serial_class), \
+            mock.patch.dict('mu.resources.minify.line_maps',
+                            {'<stdin>': [3], 'main.py': [1]}, clear=True):
+        rp = mu.interface.REPLPane('COM0')
+        mock_serial.write.reset_mock()
+        data = mock.MagicMock()
+        data.key = mock.MagicMock(return_value=Qt.Key_Return)
+        data.text = mock.MagicMock(return_value='\r')
+        rp.keyPressEvent(data)
+        assert rp.tracebacks.maps == {'main.py': [1]}
+    mock_serial.write.assert_called_once_with(b'\r')
+
+
 def test_REPLPane_keyPressEvent():
     """
     Ensure key presses in the REPL are handled correctly.
@@ -1504,7 +1549,7 @@ def test_REPLPane_keyPressEvent():
     mock_serial.open = mock.MagicMock(return_value=True)
     mock_serial.write = mock.MagicMock(return_value=None)
     mock_serial_class = mock.MagicMock(return_value=mock_serial)
-    with mock.patch('mu.interface.QSerialPort', mock_serial_class):
+    with mock.patch('mu.interface.SharedPort', mock_serial_class):
         rp = mu.interface.REPLPane('COM0')
         mock_serial.write.reset_mock()  # write is called during __init__()
         data = mock.MagicMock
@@ -1525,7 +1570,7 @@ def test_REPLPane_keyPressEvent_backspace():
     mock_serial.open = mock.MagicMock(return_value=True)
     mock_serial.write = mock.MagicMock(return_value=None)
     mock_serial_class = mock.MagicMock(return_value=mock_serial)
-    with mock.patch('mu.interface.QSerialPort', mock_serial_class):
+    with mock.patch('mu.interface.SharedPort', mock_serial_class):
         rp = mu.interface.REPLPane('COM0')
         mock_serial.write.reset_mock()  # write is called during __init__()
         data = mock.MagicMock
@@ -1546,7 +1591,7 @@ def test_REPLPane_keyPressEvent_up():
     mock_serial.open = mock.MagicMock(return_value=True)
     mock_serial.write = mock.MagicMock(return_value=None)
     mock_serial_class = mock.MagicMock(return_value=mock_serial)
-    with mock.patch('mu.interface.QSerialPort', mock_serial_class):
+    with mock.patch('mu.interface.SharedPort', mock_serial_class):
         rp = mu.interface.REPLPane('COM0')
         mock_serial.write.reset_mock()  # write is called during __init__()
         data = mock.MagicMock
@@ -1567,7 +1612,7 @@ def test_REPLPane_keyPressEvent_down():
     mock_serial.open = mock.MagicMock(return_value=True)
     mock_serial.write = mock.MagicMock(return_value=None)
     mock_serial_class = mock.MagicMock(return_value=mock_serial)
-    with mock.patch('mu.interface.QSerialPort', mock_serial_class):
+    with mock.patch('mu.interface.SharedPort', mock_serial_class):
         rp = mu.interface.REPLPane('COM0')
         mock_serial.write.reset_mock()  # write is called during __init__()
         data = mock.MagicMock
@@ -1588,7 +1633,7 @@ def test_REPLPane_keyPressEvent_right():
     mock_serial.open = mock.MagicMock(return_value=True)
     mock_serial.write = mock.MagicMock(return_value=None)
     mock_serial_class = mock.MagicMock(return_value=mock_serial)
-    with mock.patch('mu.interface.QSerialPort', mock_serial_class):
+    with mock.patch('mu.interface.SharedPort', mock_serial_class):
         rp = mu.interface.REPLPane('COM0')
         mock_serial.write.reset_mock()  # write is called during __init__()
         data = mock.MagicMock
@@ -1609,7 +1654,7 @@ def test_REPLPane_keyPressEvent_left():
     mock_serial.open = mock.MagicMock(return_value=True)
     mock_serial.write = mock.MagicMock(return_value=None)
     mock_serial_class = mock.MagicMock(return_value=mock_serial)
-    with mock.patch('mu.interface.QSerialPort', mock_serial_class):
+    with mock.patch('mu.interface.SharedPort', mock_serial_class):
         rp = mu.interface.REPLPane('COM0')
         mock_serial.write.reset_mock()  # write is called during __init__()
         data = mock.MagicMock
@@ -1630,7 +1675,7 @@ def test_REPLPane_keyPressEvent_home():
     mock_serial.open = mock.MagicMock(return_value=True)
     mock_serial.write = mock.MagicMock(return_value=None)
     mock_serial_class = mock.MagicMock(return_value=mock_serial)
-    with mock.patch('mu.interface.QSerialPort', mock_serial_class):
+    with mock.patch('mu.interface.SharedPort', mock_serial_class):
         rp = mu.interface.REPLPane('COM0')
         mock_serial.write.reset_mock()  # write is called during __init__()
         data = mock.MagicMock
@@ -1651,7 +1696,7 @@ def test_REPLPane_keyPressEvent_end():
     mock_serial.open = mock.MagicMock(return_value=True)
     mock_serial.write = mock.MagicMock(return_value=None)
     mock_serial_class = mock.MagicMock(return_value=mock_serial)
-    with mock.patch('mu.interface.QSerialPort', mock_serial_class):
+    with mock.patch('mu.interface.SharedPort', mock_serial_class):
         rp = mu.interface.REPLPane('COM0')
         mock_serial.write.reset_mock()  # write is called during __init__()
         data = mock.MagicMock
@@ -1672,7 +1717,7 @@ def test_REPLPane_keyPressEvent_CTRL_C_Darwin():
     mock_serial.open = mock.MagicMock(return_value=True)
     mock_serial.write = mock.MagicMock(return_value=None)
     mock_serial_class = mock.MagicMock(return_value=mock_serial)
-    with mock.patch('mu.interface.QSerialPort', mock_serial_class):
+    with mock.patch('mu.interface.SharedPort', mock_serial_class):
         rp = mu.interface.REPLPane('COM0')
         rp.copy = mock.MagicMock()
         mock_serial.write.reset_mock()  # write is called during __init__()
@@ -1694,7 +1739,7 @@ def test_REPLPane_keyPressEvent_CTRL_V_Darwin():
     mock_serial.open = mock.MagicMock(return_value=True)
     mock_serial.write = mock.MagicMock(return_value=None)
     mock_serial_class = mock.MagicMock(return_value=mock_serial)
-    with mock.patch('mu.interface.QSerialPort', mock_serial_class):
+    with mock.patch('mu.interface.SharedPort', mock_serial_class):
         rp = mu.interface.REPLPane('COM0')
         rp.paste = mock.MagicMock()
         mock_serial.write.reset_mock()  # write is called during __init__()
@@ -1716,7 +1761,7 @@ def test_REPLPane_keyPressEvent_meta():
     mock_serial.open = mock.MagicMock(return_value=True)
     mock_serial.write = mock.MagicMock(return_value=None)
     mock_serial_class = mock.MagicMock(return_value=mock_serial)
-    with mock.patch('mu.interface.QSerialPort', mock_serial_class):
+    with mock.patch('mu.interface.SharedPort', mock_serial_class):
         rp = mu.interface.REPLPane('COM0')
         mock_serial.write.reset_mock()  # write is called during __init__()
         data = mock.MagicMock
@@ -1747,7 +1792,7 @@ def test_REPLPane_process_bytes():
     mock_tc.movePosition = mock.MagicMock(side_effect=[True, False, True,
                                                        True])
     mock_tc.deleteChar = mock.MagicMock(return_value=None)
-    with mock.patch('mu.interface.QSerialPort', mock_serial_class):
+    with mock.patch('mu.interface.SharedPort', mock_serial_class):
         rp = mu.interface.REPLPane('COM0')
         rp.textCursor = mock.MagicMock(return_value=mock_tc)
         rp.setTextCursor = mock.MagicMock(return_value=None)
@@ -1785,7 +1830,7 @@ def test_REPLPane_process_bytes_VT100():
     mock_tc.movePosition = mock.MagicMock(return_value=False)
     mock_tc.removeSelectedText = mock.MagicMock()
     mock_tc.deleteChar = mock.MagicMock(return_value=None)
-    with mock.patch('mu.interface.QSerialPort', mock_serial_class):
+    with mock.patch('mu.interface.SharedPort', mock_serial_class):
         rp = mu.interface.REPLPane('COM0')
         rp.textCursor = mock.MagicMock(return_value=mock_tc)
         rp.setTextCursor = mock.MagicMock(return_value=None)
@@ -1830,7 +1875,7 @@ def test_REPLPane_clear():
     mock_serial.setBaudRate = mock.MagicMock(return_value=None)
     mock_serial.open = mock.MagicMock(return_value=True)
     mock_serial_class = mock.MagicMock(return_value=mock_serial)
-    with mock.patch('mu.interface.QSerialPort', mock_serial_class):
+    with mock.patch('mu.interface.SharedPort', mock_serial_class):
         rp = mu.interface.REPLPane('COM0')
         rp.setText = mock.MagicMock(return_value=None)
         rp.clear()
@@ -1898,7 +1943,7 @@ def test_MicrobitFileList_init():
 
 def test_MicrobitFileList_dropEvent():
     """
-    Ensure a valid drop event is handled as expected.
+    Ensure a valid drop event queues the upload.
     """
     mock_event = mock.MagicMock()
     source = mu.interface.LocalFileList('homepath')
@@ -1906,32 +1951,20 @@ def test_MicrobitFileList_dropEvent():
     mock_item.text.return_value = 'foo.py'
     source.currentItem = mock.MagicMock(return_value=mock_item)
     mock_event.source.return_value = source
-    mock_context = mock.MagicMock()
-    mock_serial = mock.MagicMock()
-    mock_serial.port = 'COM0'
-    mock_context.__enter__.return_value = mock_serial
     mfs = mu.interface.MicrobitFileList('homepath')
-    mfs.disable = mock.MagicMock()
-    mfs.enable = mock.MagicMock()
     mfs.parent = mock.MagicMock()
-    with mock.patch('mu.interface.microfs.get_serial',
-                    return_value=mock_context), \
-            mock.patch('mu.interface.MuFileList.dropEvent',
-                       return_value=None) as mock_dropEvent, \
-            mock.patch('mu.interface.microfs.put',
-                       return_value=True) as mock_put:
+    with mock.patch('mu.interface.MuFileList.dropEvent',
+                    return_value=None) as mock_dropEvent:
         mfs.dropEvent(mock_event)
-        mfs.disable.assert_called_once_with(source)
-        home = os.path.join('homepath', 'foo.py')
-        mock_put.assert_called_once_with(mock_serial, home)
-        mock_dropEvent.assert_called_once_with(mock_event)
-        mfs.enable.assert_called_once_with(source)
-        mfs.parent().ls.assert_called_once_with()
+    home = os.path.join('homepath', 'foo.py')
+    mfs.parent().transfers.put.assert_called_once_with(home, 'foo.py')
+    mock_dropEvent.assert_called_once_with(mock_event)
 
 
-def test_MicrobitFileList_dropEvent_error():
+def test_MicrobitFileList_dropEvent_no_overwrite():
     """
-    Ensure that if an error occurs there is no change in the file list state.
+    Ensure nothing is queued if the user decides not to overwrite an
+    existing file.
     """
     mock_event = mock.MagicMock()
     source = mu.interface.LocalFileList('homepath')
@@ -1939,22 +1972,15 @@ def test_MicrobitFileList_dropEvent_error():
     mock_item.text.return_value = 'foo.py'
     source.currentItem = mock.MagicMock(return_value=mock_item)
     mock_event.source.return_value = source
-    mock_context = mock.MagicMock()
-    mock_serial = mock.MagicMock()
-    mock_serial.port = 'COM0'
-    mock_context.__enter__.return_value = mock_serial
     mfs = mu.interface.MicrobitFileList('homepath')
-    mfs.disable = mock.MagicMock()
-    mfs.enable = mock.MagicMock()
-    ex = IOError('BANG')
-    with mock.patch('mu.interface.microfs.get_serial',
-                    return_value=mock_context), \
-            mock.patch('mu.interface.microfs.put', side_effect=ex), \
-            mock.patch('mu.interface.logger.error', return_value=None) as log:
+    mfs.addItem('foo.py')
+    mfs.parent = mock.MagicMock()
+    mfs.show_confirm_overwrite_dialog = mock.MagicMock(return_value=False)
+    with mock.patch('mu.interface.MuFileList.dropEvent',
+                    return_value=None) as mock_dropEvent:
         mfs.dropEvent(mock_event)
-        log.assert_called_once_with(ex)
-        mfs.disable.assert_called_once_with(source)
-        mfs.enable.assert_called_once_with(source)
+    assert mfs.parent().transfers.put.call_count == 0
+    assert mock_dropEvent.call_count == 0
 
 
 def test_MicrobitFileList_dropEvent_wrong_source():
@@ -1966,19 +1992,15 @@ def test_MicrobitFileList_dropEvent_wrong_source():
     source = mock.MagicMock()
     mock_event.source.return_value = source
     mfs = mu.interface.MicrobitFileList('homepath')
-    mfs.disable = mock.MagicMock()
-    mfs.enable = mock.MagicMock()
-    with mock.patch('mu.interface.microfs.put', return_value=None) as mp:
-        mfs.dropEvent(mock_event)
-        assert mp.call_count == 0
-    mfs.disable.assert_called_once_with(source)
-    mfs.enable.assert_called_once_with(source)
+    mfs.parent = mock.MagicMock()
+    mfs.dropEvent(mock_event)
+    assert mfs.parent().transfers.put.call_count == 0
 
 
 def test_MicrobitFileList_contextMenuEvent():
     """
     Ensure that the menu displayed when a file on the micro:bit is
-    right-clicked works as expected when activated.
+    right-clicked queues its removal when activated.
     """
     mock_menu = mock.MagicMock()
     mock_action = mock.MagicMock()
@@ -1988,58 +2010,32 @@ def test_MicrobitFileList_contextMenuEvent():
     mock_current = mock.MagicMock()
     mock_current.text.return_value = 'foo.py'
     mfs.currentItem = mock.MagicMock(return_value=mock_current)
+    mfs.currentRow = mock.MagicMock(return_value=2)
     mfs.mapToGlobal = mock.MagicMock(return_value=None)
-    mfs.setDisabled = mock.MagicMock(return_value=None)
-    mfs.setAcceptDrops = mock.MagicMock(return_value=None)
-    mock_context = mock.MagicMock()
-    mock_serial = mock.MagicMock()
-    mock_serial.port = 'COM0'
-    mock_context.__enter__.return_value = mock_serial
+    mfs.takeItem = mock.MagicMock(return_value=None)
+    mfs.parent = mock.MagicMock()
     mock_event = mock.MagicMock()
-    with mock.patch('mu.interface.microfs.get_serial',
-                    return_value=mock_context), \
-            mock.patch('mu.interface.microfs.rm',
-                       return_value=None) as mock_rm, \
-            mock.patch('mu.interface.QMenu', return_value=mock_menu):
+    with mock.patch('mu.interface.QMenu', return_value=mock_menu):
         mfs.contextMenuEvent(mock_event)
-        mock_rm.assert_called_once_with(mock_serial, 'foo.py')
-        assert mfs.setDisabled.call_count == 2
-        assert mfs.setAcceptDrops.call_count == 2
+    mfs.parent().transfers.rm.assert_called_once_with('foo.py')
+    mfs.takeItem.assert_called_once_with(2)
 
 
-def test_MicrobitFileList_contextMenuEvent_error():
+def test_MicrobitFileList_contextMenuEvent_dismissed():
     """
-    Ensure that if there's an error while preparing for the rm operation that
-    it aborts without enacting.
+    Ensure nothing is removed if the menu is dismissed.
     """
     mock_menu = mock.MagicMock()
-    mock_action = mock.MagicMock()
-    mock_menu.addAction.return_value = mock_action
-    mock_menu.exec_.return_value = mock_action
+    mock_menu.exec_.return_value = None
     mfs = mu.interface.MicrobitFileList('homepath')
-    mock_current = mock.MagicMock()
-    mock_current.text.return_value = 'foo.py'
-    mfs.currentItem = mock.MagicMock(return_value=mock_current)
     mfs.mapToGlobal = mock.MagicMock(return_value=None)
-    mfs.setDisabled = mock.MagicMock(return_value=None)
-    mfs.setAcceptDrops = mock.MagicMock(return_value=None)
     mfs.takeItem = mock.MagicMock(return_value=None)
-    mock_context = mock.MagicMock()
-    mock_serial = mock.MagicMock()
-    mock_serial.port = 'COM0'
-    mock_context.__enter__.return_value = mock_serial
+    mfs.parent = mock.MagicMock()
     mock_event = mock.MagicMock()
-    ex = IOError('BANG')
-    with mock.patch('mu.interface.microfs.get_serial',
-                    return_value=mock_context), \
-            mock.patch('mu.interface.microfs.rm', side_effect=ex), \
-            mock.patch('mu.interface.QMenu', return_value=mock_menu), \
-            mock.patch('mu.interface.logger.error', return_value=None) as log:
+    with mock.patch('mu.interface.QMenu', return_value=mock_menu):
         mfs.contextMenuEvent(mock_event)
-        log.assert_called_once_with(ex)
-        assert mfs.takeItem.call_count == 0
-        assert mfs.setDisabled.call_count == 2
-        assert mfs.setAcceptDrops.call_count == 2
+    assert mfs.parent().transfers.rm.call_count == 0
+    assert mfs.takeItem.call_count == 0
 
 
 def test_LocalFileList_init():
@@ -2053,7 +2049,7 @@ def test_LocalFileList_init():
 
 def test_LocalFileList_dropEvent():
     """
-    Ensure a valid drop event is handled as expected.
+    Ensure a valid drop event queues the download.
     """
     mock_event = mock.MagicMock()
     source = mu.interface.MicrobitFileList('homepath')
@@ -2061,32 +2057,20 @@ def test_LocalFileList_dropEvent():
     mock_item.text.return_value = 'foo.py'
     source.currentItem = mock.MagicMock(return_value=mock_item)
     mock_event.source.return_value = source
-    mock_context = mock.MagicMock()
-    mock_serial = mock.MagicMock()
-    mock_serial.port = 'COM0'
-    mock_context.__enter__.return_value = mock_serial
     lfs = mu.interface.LocalFileList('homepath')
-    lfs.disable = mock.MagicMock()
-    lfs.enable = mock.MagicMock()
     lfs.parent = mock.MagicMock()
-    with mock.patch('mu.interface.microfs.get_serial',
-                    return_value=mock_context), \
-            mock.patch('mu.interface.MuFileList.dropEvent',
-                       return_value=None) as mock_dropEvent, \
-            mock.patch('mu.interface.microfs.get',
-                       return_value=True) as mock_get:
+    with mock.patch('mu.interface.MuFileList.dropEvent',
+                    return_value=None) as mock_dropEvent:
         lfs.dropEvent(mock_event)
-        lfs.disable.assert_called_once_with(source)
-        home = os.path.join('homepath', 'foo.py')
-        mock_get.assert_called_once_with(mock_serial, 'foo.py', home)
-        mock_dropEvent.assert_called_once_with(mock_event)
-        lfs.enable.assert_called_once_with(source)
-        lfs.parent().ls.assert_called_once_with()
+    home = os.path.join('homepath', 'foo.py')
+    lfs.parent().transfers.get.assert_called_once_with('foo.py', home)
+    mock_dropEvent.assert_called_once_with(mock_event)
 
 
-def test_LocalFileList_dropEvent_error():
+def test_LocalFileList_dropEvent_no_overwrite():
     """
-    Ensure that if an error occurs there is no change in the file list state.
+    Ensure nothing is queued if the user decides not to overwrite an
+    existing file.
     """
     mock_event = mock.MagicMock()
     source = mu.interface.MicrobitFileList('homepath')
@@ -2094,40 +2078,26 @@ def test_LocalFileList_dropEvent_error():
     mock_item.text.return_value = 'foo.py'
     source.currentItem = mock.MagicMock(return_value=mock_item)
     mock_event.source.return_value = source
-    mock_context = mock.MagicMock()
-    mock_serial = mock.MagicMock()
-    mock_serial.port = 'COM0'
-    mock_context.__enter__.return_value = mock_serial
     lfs = mu.interface.LocalFileList('homepath')
-    lfs.disable = mock.MagicMock()
-    lfs.enable = mock.MagicMock()
-    ex = IOError('BANG')
-    with mock.patch('mu.interface.microfs.get_serial',
-                    return_value=mock_context), \
-            mock.patch('mu.interface.microfs.get', side_effect=ex), \
-            mock.patch('mu.interface.logger.error', return_value=None) as log:
-        lfs.dropEvent(mock_event)
-        log.assert_called_once_with(ex)
-        lfs.disable.assert_called_once_with(source)
-        lfs.enable.assert_called_once_with(source)
+    lfs.addItem('foo.py')
+    lfs.parent = mock.MagicMock()
+    lfs.show_confirm_overwrite_dialog = mock.MagicMock(return_value=False)
+    lfs.dropEvent(mock_event)
+    assert lfs.parent().transfers.get.call_count == 0
 
 
 def test_LocalFileList_dropEvent_wrong_source():
     """
-    Ensure that only drop events whose origins are LocalFileList objects are
-    handled.
+    Ensure that only drop events whose origins are MicrobitFileList objects
+    are handled.
     """
     mock_event = mock.MagicMock()
     source = mock.MagicMock()
     mock_event.source.return_value = source
     lfs = mu.interface.LocalFileList('homepath')
-    lfs.disable = mock.MagicMock()
-    lfs.enable = mock.MagicMock()
-    with mock.patch('mu.interface.microfs.put', return_value=None) as mp:
-        lfs.dropEvent(mock_event)
-        assert mp.call_count == 0
-    lfs.disable.assert_called_once_with(source)
-    lfs.enable.assert_called_once_with(source)
+    lfs.parent = mock.MagicMock()
+    lfs.dropEvent(mock_event)
+    assert lfs.parent().transfers.get.call_count == 0
 
 
 def test_FileSystemPane_init():
@@ -2140,34 +2110,68 @@ def test_FileSystemPane_init():
     mock_ls.assert_called_once_with()
     assert isinstance(fsp.microbit_label, QLabel)
     assert isinstance(fsp.local_label, QLabel)
+    assert isinstance(fsp.microbit_space, QLabel)
     assert isinstance(fsp.microbit_fs, QListWidget)
     assert isinstance(fsp.local_fs, QListWidget)
+    assert isinstance(fsp.transfers, mu.interface.TransferManager)
 
 
 def test_FileSystemPane_ls():
     """
-    Ensure the ls method works as expected.
+    Ensure the ls method lists the local files, and queues listing the
+    board's rather than waiting for it.
     """
-    microbit_files = ['foo.py', 'bar.py', 'baz.py']
     local_files = ['spam.py', 'eggs.py']
-    # MOCK ALL TEH THIGNS!
-    with mock.patch('mu.interface.MicrobitFileList.clear',
-                    return_value=None) as mfs_clear, \
-            mock.patch('mu.interface.LocalFileList.clear',
-                       return_value=None) as lfs_clear, \
-            mock.patch('mu.interface.microfs.ls',
-                       return_value=microbit_files), \
-            mock.patch('mu.interface.microfs.get_serial', return_value=None), \
+    with mock.patch('mu.interface.LocalFileList.clear',
+                    return_value=None) as lfs_clear, \
+            mock.patch('mu.interface.TransferManager.ls') as mock_ls, \
             mock.patch('mu.interface.os.listdir', return_value=local_files), \
             mock.patch('mu.interface.os.path.isfile', return_value=True), \
             mock.patch('mu.interface.os.path.join', return_value=None):
         fsp = mu.interface.FileSystemPane(None, 'homepath')
-        mfs_clear.assert_called_once_with()
+        mock_ls.assert_called_once_with()
         lfs_clear.assert_called_once_with()
-        assert fsp.microbit_fs.count() == 3
         assert fsp.local_fs.count() == 2
 
 
+def test_FileSystemPane_on_listing():
+    """
+    The files on the board are shown once they're listed.
+    """
+    with mock.patch('mu.interface.FileSystemPane.ls', return_value=None):
+        fsp = mu.interface.FileSystemPane(None, 'homepath')
+    fsp.on_listing(['foo.py', 'bar.py', 'baz.py'])
+    assert fsp.microbit_fs.count() == 3
+    fsp.on_listing(['foo.py'])
+    assert fsp.microbit_fs.count() == 1
+
+
+def test_FileSystemPane_on_disk_usage():
+    """
+    The free space on the board is shown, unless the board can't tell.
+    """
+    with mock.patch('mu.interface.FileSystemPane.ls', return_value=None):
+        fsp = mu.interface.FileSystemPane(None, 'homepath')
+    fsp.on_disk_usage(DiskUsage(4096, 512, 300))
+    assert fsp.microbit_space.text() == '1,200 KB free of 2,048 KB'
+    fsp.on_disk_usage(DiskUsage(0, 0, 0))
+    assert fsp.microbit_space.text() == ''
+
+
+def test_FileSystemPane_on_job_finished():
+    """
+    Failed file operations are logged.
+    """
+    with mock.patch('mu.interface.FileSystemPane.ls', return_value=None):
+        fsp = mu.interface.FileSystemPane(None, 'homepath')
+    ex = IOError('BANG')
+    with mock.patch('mu.interface.logger.error', return_value=None) as log:
+        fsp.on_job_finished(1, None)
+        assert log.call_count == 0
+        fsp.on_job_finished(2, ex)
+    log.assert_called_once_with(ex)
+
+
 def test_FileSystemPane_set_theme_day():
     """
     Ensures the day theme is set.
@@ -2200,12 +2204,14 @@ def test_FileSystemPane_set_font_size():
     fsp.font = mock.MagicMock()
     fsp.microbit_label = mock.MagicMock()
     fsp.local_label = mock.MagicMock()
+    fsp.microbit_space = mock.MagicMock()
     fsp.microbit_fs = mock.MagicMock()
     fsp.local_fs = mock.MagicMock()
     fsp.set_font_size(22)
     fsp.font.setPointSize.assert_called_once_with(22)
     fsp.microbit_label.setFont.assert_called_once_with(fsp.font)
     fsp.local_label.setFont.assert_called_once_with(fsp.font)
+    fsp.microbit_space.setFont.assert_called_once_with(fsp.font)
     fsp.microbit_fs.setFont.assert_called_once_with(fsp.font)
     fsp.local_fs.setFont.assert_called_once_with(fsp.font)
 
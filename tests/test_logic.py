@@ -6,6 +6,7 @@ import sys
 import os.path
 import json
 import pytest
+import mu.devices
 import mu.logic
 from PyQt5.QtWidgets import QMessageBox
 from unittest import mock
@@ -28,45 +29,35 @@ def test_CONSTANTS():
     assert mu.logic.HOME_DIRECTORY
     assert mu.logic.DATA_DIR
     assert mu.logic.WORKSPACE_NAME
-    assert isinstance(mu.logic.BOARD_IDS, set)
 
 
-def test_find_microbit_no_ports():
+def test_find_microbit_no_device():
     """
-    There are no connected devices so return None.
+    If no known board is connected, return None.
     """
-    with mock.patch('mu.logic.QSerialPortInfo.availablePorts',
-                    return_value=[]):
+    with mock.patch('mu.logic.get_registry') as mock_get_registry:
+        mock_get_registry.return_value.find_port.return_value = None
         assert mu.logic.find_microbit() is None
 
 
-def test_find_microbit_no_device():
+def test_find_microbit_with_device():
     """
-    None of the connected devices is a micro:bit so return None.
+    If a device is found, return its port's device, which is what brokers
+    are keyed by.
     """
-    mock_port = mock.MagicMock()
-    mock_port.productIdentifier = mock.MagicMock(return_value=666)
-    mock_port.vendorIdentifier = mock.MagicMock(return_value=999)
-    with mock.patch('mu.logic.QSerialPortInfo.availablePorts',
-                    return_value=[mock_port, ]):
-        assert mu.logic.find_microbit() is None
+    port = mu.devices.Port('/dev/ttyACM0', 'ttyACM0')
+    with mock.patch('mu.logic.get_registry') as mock_get_registry:
+        mock_get_registry.return_value.find_port.return_value = port
+        assert mu.logic.find_microbit() == '/dev/ttyACM0'
 
 
-def test_find_microbit_with_device():
+def test_find_microbit_path():
     """
-    If a device is found, return the port name.
+    The board's mount point comes from the device registry.
     """
-    mock_port = mock.MagicMock()
-    for vid, pid in mu.logic.BOARD_IDS:
-        mock_port.vid = vid
-        mock_port.productIdentifier = mock.MagicMock()
-        mock_port.productIdentifier.return_value = pid
-        mock_port.vendorIdentifier = mock.MagicMock()
-        mock_port.vendorIdentifier.return_value = vid
-        mock_port.portName = mock.MagicMock(return_value='COM0')
-        with mock.patch('mu.logic.QSerialPortInfo.availablePorts',
-                        return_value=[mock_port, ]):
-            assert mu.logic.find_microbit() == 'COM0'
+    with mock.patch('mu.logic.get_registry') as mock_get_registry:
+        mock_get_registry.return_value.find_mount.return_value = '/media/MB'
+        assert mu.logic.find_microbit_path() == '/media/MB'
 
 
 def test_get_settings_app_path():
@@ -349,6 +340,8 @@ def test_REPL_posix():
     with mock.patch('os.name', 'posix'):
         r = mu.logic.REPL('ttyACM0')
         assert r.port == '/dev/ttyACM0'
+        r = mu.logic.REPL('/dev/ttyACM0')
+        assert r.port == '/dev/ttyACM0'
 
 
 def test_REPL_nt():
@@ -406,6 +399,23 @@ def test_editor_restore_session():
     view.set_theme.assert_called_once_with('night')
 
 
+def test_editor_restore_session_minify():
+    """
+    The minifier settings are restored onto Files.
+    """
+    view = mock.MagicMock()
+    ed = mu.logic.Editor(view)
+    session = json.dumps({'minify': True, 'rename_locals': True})
+    mock_open = mock.mock_open(read_data=session)
+    with mock.patch('builtins.open', mock_open), \
+            mock.patch('os.path.exists', return_value=True), \
+            mock.patch.object(mu.logic.files.Files, 'minify', False), \
+            mock.patch.object(mu.logic.files.Files, 'rename_locals', False):
+        ed.restore_session()
+        assert mu.logic.files.Files.minify is True
+        assert mu.logic.files.Files.rename_locals is True
+
+
 def test_editor_restore_session_missing_files():
     """
     Missing files that were opened tabs in the previous session are safely
@@ -518,8 +528,8 @@ def test_flash_with_attached_device():
     """
     with mock.patch('mu.logic.uflash.hexlify', return_value=''), \
             mock.patch('mu.logic.uflash.embed_hex', return_value='foo'), \
-            mock.patch('mu.logic.uflash.find_microbit', return_value='bar'),\
-            mock.patch('mu.logic.os.path.exists', return_value=True),\
+            mock.patch('mu.logic.find_microbit_path', return_value='bar'), \
+            mock.patch('mu.logic.os.path.exists', return_value=True), \
             mock.patch('mu.logic.uflash.save_hex', return_value=None) as s:
         view = mock.MagicMock()
         view.current_tab.text = mock.MagicMock(return_value='')
@@ -531,6 +541,27 @@ def test_flash_with_attached_device():
         s.assert_called_once_with('foo', hex_file_path)
 
 
+def test_flash_minified():
+    """
+    With minify set, the script is minified before it is flashed and its
+    line map is kept for the device's tracebacks.
+    """
+    with mock.patch('mu.logic.uflash.hexlify', return_value='') as h, \
+            mock.patch('mu.logic.uflash.embed_hex', return_value='foo'), \
+            mock.patch('mu.logic.find_microbit_path', return_value='bar'), \
+            mock.patch('mu.logic.os.path.exists', return_value=True), \
+            mock.patch('mu.logic.uflash.save_hex', return_value=None), \
+            mock.patch.object(mu.logic.files.Files, 'minify', True), \
+            mock.patch.dict(mu.logic.minify.line_maps, {}, clear=True):
+        view = mock.MagicMock()
+        view.current_tab.text = mock.MagicMock(
+            return_value='# Comment\n\nprint( 1 )\n')
+        ed = mu.logic.Editor(view)
+        ed.flash()
+        assert mu.logic.minify.line_maps == {'__main__': [3]}
+    h.assert_called_once_with(b'print(1)\n')
+
+
 def test_flash_with_attached_device_and_custom_runtime():
     """
     Ensure the expected calls are made to uFlash and a helpful status message
@@ -551,8 +582,8 @@ def test_flash_user_specified_device_path():
     """
     with mock.patch('mu.logic.uflash.hexlify', return_value=''), \
             mock.patch('mu.logic.uflash.embed_hex', return_value='foo'), \
-            mock.patch('mu.logic.uflash.find_microbit', return_value=None),\
-            mock.patch('mu.logic.os.path.exists', return_value=True),\
+            mock.patch('mu.logic.find_microbit_path', return_value=None), \
+            mock.patch('mu.logic.os.path.exists', return_value=True), \
             mock.patch('mu.logic.uflash.save_hex', return_value=None) as s:
         view = mock.MagicMock()
         view.get_microbit_path = mock.MagicMock(return_value='bar')
@@ -576,8 +607,8 @@ def test_flash_existing_user_specified_device_path():
     """
     with mock.patch('mu.logic.uflash.hexlify', return_value=''), \
             mock.patch('mu.logic.uflash.embed_hex', return_value='foo'), \
-            mock.patch('mu.logic.uflash.find_microbit', return_value=None),\
-            mock.patch('mu.logic.os.path.exists', return_value=True),\
+            mock.patch('mu.logic.find_microbit_path', return_value=None), \
+            mock.patch('mu.logic.os.path.exists', return_value=True), \
             mock.patch('mu.logic.uflash.save_hex', return_value=None) as s:
         view = mock.MagicMock()
         view.get_microbit_path = mock.MagicMock(return_value='bar')
@@ -600,8 +631,8 @@ def test_flash_path_specified_does_not_exist():
     """
     with mock.patch('mu.logic.uflash.hexlify', return_value=''), \
             mock.patch('mu.logic.uflash.embed_hex', return_value='foo'), \
-            mock.patch('mu.logic.uflash.find_microbit', return_value=None),\
-            mock.patch('mu.logic.os.path.exists', return_value=False),\
+            mock.patch('mu.logic.find_microbit_path', return_value=None), \
+            mock.patch('mu.logic.os.path.exists', return_value=False), \
             mock.patch('mu.logic.os.makedirs', return_value=None), \
             mock.patch('mu.logic.uflash.save_hex', return_value=None) as s:
         view = mock.MagicMock()
@@ -629,7 +660,7 @@ def test_flash_without_device():
     """
     with mock.patch('mu.logic.uflash.hexlify', return_value=''), \
             mock.patch('mu.logic.uflash.embed_hex', return_value='foo'), \
-            mock.patch('mu.logic.uflash.find_microbit', return_value=None), \
+            mock.patch('mu.logic.find_microbit_path', return_value=None), \
             mock.patch('mu.logic.uflash.save_hex', return_value=None) as s:
         view = mock.MagicMock()
         view.get_microbit_path = mock.MagicMock(return_value=None)
@@ -665,13 +696,55 @@ def test_flash_script_too_big():
                                               'Warning')
 
 
+def test_run():
+    """
+    The script is run on the board through the port's broker, which shares
+    the connection with the REPL.
+    """
+    view = mock.MagicMock()
+    view.current_tab.path = 'foo.py'
+    ed = mu.logic.Editor(view)
+    with mock.patch('mu.logic.Editor.save'), \
+            mock.patch('mu.logic.find_microbit',
+                       return_value='/dev/ttyACM0'), \
+            mock.patch('mu.logic.get_broker') as mock_get_broker, \
+            mock.patch('mu.logic.files.Files') as mock_files:
+        ed.run()
+    mock_get_broker.assert_called_once_with('/dev/ttyACM0')
+    lease = mock_get_broker.return_value.lease
+    lease.assert_called_once_with(timeout=0)
+    mock_files.assert_called_once_with(lease.return_value.__enter__())
+    mock_files.return_value.run.assert_called_once_with('foo.py', False)
+    assert view.show_message.call_count == 0
+
+
+def test_run_device_busy():
+    """
+    If file transfers are using the board, the user is told to wait rather
+    than the window freezing until they finish.
+    """
+    view = mock.MagicMock()
+    view.current_tab.path = 'foo.py'
+    ed = mu.logic.Editor(view)
+    with mock.patch('mu.logic.Editor.save'), \
+            mock.patch('mu.logic.find_microbit',
+                       return_value='/dev/ttyACM0'), \
+            mock.patch('mu.logic.get_broker') as mock_get_broker, \
+            mock.patch('mu.logic.files.Files') as mock_files:
+        lease = mock_get_broker.return_value.lease
+        lease.return_value.__enter__.side_effect = mu.logic.PortBusyError()
+        ed.run()
+    assert mock_files.call_count == 0
+    assert view.show_message.call_args[0][0] == 'The device is busy.'
+
+
 def test_add_fs_no_repl():
     """
     It's possible to add the file system pane if the REPL is inactive.
     """
     view = mock.MagicMock()
     ed = mu.logic.Editor(view)
-    with mock.patch('mu.logic.microfs.get_serial', return_value=True):
+    with mock.patch('mu.logic.find_microbit', return_value='ttyACM0'):
         ed.add_fs()
     workspace = mu.logic.get_workspace_dir()
     view.add_filesystem.assert_called_once_with(home=workspace)
@@ -685,7 +758,7 @@ def test_add_fs_with_repl():
     view = mock.MagicMock()
     ed = mu.logic.Editor(view)
     ed.repl = True
-    with mock.patch('mu.logic.microfs.get_serial', return_value=True):
+    with mock.patch('mu.logic.find_microbit', return_value='ttyACM0'):
         ed.add_fs()
     assert view.add_filesystem.call_count == 0
 
@@ -696,9 +769,8 @@ def test_add_fs_no_device():
     """
     view = mock.MagicMock()
     view.show_message = mock.MagicMock()
-    ex = IOError('BOOM')
     ed = mu.logic.Editor(view)
-    with mock.patch('mu.logic.microfs.get_serial', side_effect=ex):
+    with mock.patch('mu.logic.find_microbit', return_value=None):
         ed.add_fs()
     assert view.show_message.call_count == 1
 
@@ -1349,6 +1421,8 @@ def test_quit_save_theme():
                         in mock_open.return_value.write.call_args_list])
     session = json.loads(recovered)
     assert session['theme'] == 'night'
+    assert session['minify'] is False
+    assert session['rename_locals'] is False
 
 
 def test_quit_calls_sys_exit():
@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the micro:bit file system commands.
+"""
+from unittest import mock
+import binascii
+import io
+import itertools
+import re
+import struct
+import pytest
+from mu.contrib import microfs
+
+
+class FakeMicrobit:
+    """
+    A fake serial connection which answers like a micro:bit's raw REPL:
+    commands produce the (stdout, stderr) returned by the respond function
+    when given the command.  Unless raw_paste is False, commands may be sent
+    in raw-paste mode with the given window size.
+    """
+
+    def __init__(self, respond, raw_paste=True, window=32):
+        self.respond = respond
+        self.raw_paste = raw_paste
+        self.window = window
+        self.pending = bytearray()
+        self.line = bytearray()
+        self.written = bytearray()
+        self.pasting = False
+        self.credit = 0
+
+    @property
+    def in_waiting(self):
+        return len(self.pending)
+
+    def read(self, size=1):
+        data = bytes(self.pending[:size])
+        del self.pending[:size]
+        return data
+
+    def reset_input_buffer(self):
+        del self.pending[:]
+
+    def write(self, data):
+        self.written.extend(data)
+        for byte in data:
+            if self.pasting:
+                self.paste(byte)
+            elif byte == 1 and self.raw_paste and self.line == b'\x05A':
+                self.line = bytearray()
+                self.pasting = True
+                self.credit = self.window
+                self.pending.extend(b'R\x01' + struct.pack('<H', self.window))
+            elif byte == 1:
+                self.line = bytearray()
+                self.pending.extend(b'raw REPL; CTRL-B to exit\r\n>')
+            elif byte == 3:
+                self.line = bytearray()
+            elif byte == 4:
+                command = bytes(self.line)
+                self.line = bytearray()
+                self.run(command, b'OK')
+            elif byte not in (2, 13):
+                self.line.append(byte)
+        return len(data)
+
+    def paste(self, byte):
+        if byte == 4:
+            self.pasting = False
+            command = bytes(self.line)
+            self.line = bytearray()
+            self.run(command, b'\x04')
+            return
+        # The host must never send more than the window allows.
+        assert self.credit > 0
+        self.credit -= 1
+        self.line.append(byte)
+        if len(self.line) % self.window == 0:
+            self.credit += self.window
+            self.pending.extend(b'\x01')
+
+    def run(self, command, start):
+        """
+        Run the command, which the micro:bit acknowledged with start.
+        """
+        out, err = self.respond(command)
+        self.pending.extend(start + out + b'\x04' + err + b'\x04>')
+
+
+class FakeFileMicrobit(FakeMicrobit):
+    """
+    A FakeMicrobit which runs the programs put and get send on the files in
+    a dict, in binary or (for a port which can't) in hex.
+    """
+
+    def __init__(self, files, binary=True, **kwargs):
+        super().__init__(self.os, **kwargs)
+        self.files = files
+        self.binary = binary
+        self.upload = None
+        self.incoming = bytearray()
+
+    def run(self, command, start):
+        match = re.search(rb"_(put|get)\('([^']*)'", command)
+        if match is None:
+            return super().run(command, start)
+        self.pending.extend(start)
+        action, name = match.groups()
+        name = name.decode()
+        mode = b'B' if self.binary else b'H'
+        if action == b'put' and name != 'bad':
+            self.upload = (name, bytearray())
+            self.pending.extend(mode + b'\r\n')
+        elif action == b'get' and name in self.files:
+            data = self.files[name]
+            header = '{0} '.format(len(data)).encode() + mode + b'\r\n'
+            self.pending.extend(header)
+            for i in range(0, len(data), 256):
+                block = data[i:i + 256]
+                if self.binary:
+                    self.pending.extend(block)
+                else:
+                    self.pending.extend(binascii.hexlify(block) + b'\r\n')
+            self.pending.extend(b'\x04\x04>')
+        else:
+            self.pending.extend(b'\x04Traceback (most recent call last):\r\n'
+                                b'OSError: [Errno 2] ENOENT\r\n\x04>')
+
+    def os(self, command):
+        """
+        Run the commands ls and rm send.
+        """
+        if command == b'print(os.listdir())':
+            return repr(sorted(self.files)).encode() + b'\r\n', b''
+        match = re.match(rb"os.remove\('([^']*)'\)", command)
+        if match and match.group(1).decode() in self.files:
+            del self.files[match.group(1).decode()]
+        elif match:
+            return b'', b'OSError: [Errno 2] ENOENT\r\n'
+        return b'', b''
+
+    def write(self, data):
+        if self.upload is None:
+            return super().write(data)
+        self.written.extend(data)
+        self.incoming.extend(data if self.binary else
+                             binascii.unhexlify(bytes(data)))
+        while len(self.incoming) >= 2:
+            size = struct.unpack('<H', self.incoming[:2])[0]
+            if not size:
+                del self.incoming[:2]
+                name, received = self.upload
+                self.files[name] = bytes(received)
+                self.upload = None
+                self.pending.extend(b'\x04\x04>')
+                break
+            if len(self.incoming) < 2 + size:
+                break
+            self.upload[1].extend(self.incoming[2:2 + size])
+            del self.incoming[:2 + size]
+            self.pending.extend(b'.')
+        return len(data)
+
+
+def test_execute_raw_paste():
+    """
+    Commands are sent in raw-paste mode, within the window the micro:bit
+    gives, and the board is taken out of raw mode afterwards.
+    """
+    commands = []
+
+    def respond(command):
+        commands.append(command)
+        return b'ok\r\n', b''
+
+    serial = FakeMicrobit(respond, window=8)
+    long_command = 'print("{}")'.format('x' * 50)
+    assert microfs.execute(['import os', long_command], serial) == \
+        (b'ok\r\nok\r\n', b'')
+    assert commands == [b'import os', long_command.encode()]
+    assert serial.written.count(b'\x05A\x01') == 2
+    assert serial.written.endswith(b'\x02')
+
+
+def test_execute_old_firmware():
+    """
+    Firmware without raw-paste mode is only asked once, and gets the commands
+    in slices.
+    """
+    serial = FakeMicrobit(lambda command: (command + b'\r\n', b''),
+                          raw_paste=False)
+    with mock.patch('mu.contrib.microfs.time.sleep') as mock_sleep:
+        out, err = microfs.execute(['a' * 40, 'b'], serial)
+    assert (out, err) == (b'a' * 40 + b'\r\nb\r\n', b'')
+    assert serial.written.count(b'\x05A\x01') == 1
+    assert mock_sleep.call_count == 3
+
+
+def test_execute_error():
+    """
+    An error stops the commands and is returned, leaving raw mode.
+    """
+    serial = FakeMicrobit(lambda command: (b'', b'OSError: 2\r\n'))
+    assert microfs.execute(['a', 'b'], serial) == (b'', b'OSError: 2\r\n')
+    assert serial.written.count(b'\x05A\x01') == 1
+    assert serial.written.endswith(b'\x02')
+
+
+def test_execute_timeout():
+    """
+    A micro:bit which doesn't answer raises an IOError.
+    """
+    serial = mock.MagicMock()
+    serial.in_waiting = 0
+    serial.read.return_value = b''
+    with mock.patch('mu.contrib.microfs._now',
+                    side_effect=itertools.count(0, 4)):
+        with pytest.raises(IOError):
+            microfs.execute(['import os'], serial)
+
+
+def test_read_until():
+    """
+    Reads wait for whatever has arrived rather than a byte at a time, and the
+    deadline is put back each time something arrives.
+    """
+    serial = mock.MagicMock()
+    serial.in_waiting = 3
+    serial.read.side_effect = [b'abc', b'', b'de\x04', b'>']
+    with mock.patch('mu.contrib.microfs._now',
+                    side_effect=itertools.count(0, 4)):
+        assert microfs.read_until(serial, b'\x04>') == b'abcde\x04>'
+    assert serial.read.call_args_list[0] == mock.call(3)
+
+
+@pytest.mark.parametrize('binary', [True, False])
+def test_put(tmpdir, binary):
+    """
+    A file is streamed to the micro:bit a block at a time, in binary or hex,
+    reporting progress.
+    """
+    data = bytes(range(256)) * 2 + b'end'
+    local = tmpdir.join('data.bin')
+    local.write_binary(data)
+    files = {}
+    serial = FakeFileMicrobit(files, binary)
+    progress = []
+    assert microfs.put(serial, str(local),
+                       progress=lambda *args: progress.append(args))
+    assert files == {'data.bin': data}
+    assert progress == [(0, 515), (256, 515), (512, 515), (515, 515)]
+    assert serial.written.endswith(b'\x02')
+
+
+def test_put_target(tmpdir):
+    """
+    The file can be given another name on the micro:bit.
+    """
+    local = tmpdir.join('data.bin')
+    local.write_binary(b'')
+    files = {}
+    microfs.put(FakeFileMicrobit(files, raw_paste=False), str(local),
+                'other.bin')
+    assert files == {'other.bin': b''}
+
+
+def test_put_cancelled(tmpdir):
+    """
+    An exception raised by progress ends the file where it got to, and is
+    then raised.
+    """
+    local = tmpdir.join('data.bin')
+    local.write_binary(b'x' * 600)
+    files = {}
+    serial = FakeFileMicrobit(files)
+
+    def progress(sent, size):
+        if sent:
+            raise KeyboardInterrupt()
+
+    with pytest.raises(KeyboardInterrupt):
+        microfs.put(serial, str(local), progress=progress)
+    assert files == {'data.bin': b'x' * 256}
+    assert serial.upload is None
+
+
+def test_put_error(tmpdir):
+    """
+    An error on the micro:bit is raised as an IOError.
+    """
+    local = tmpdir.join('data.bin')
+    local.write_binary(b'x')
+    with pytest.raises(IOError) as ex:
+        microfs.put(FakeFileMicrobit({}), str(local), 'bad')
+    assert str(ex.value) == 'OSError: [Errno 2] ENOENT'
+    with pytest.raises(IOError):
+        microfs.put(FakeFileMicrobit({}), str(tmpdir.join('missing')))
+
+
+@pytest.mark.parametrize('binary', [True, False])
+def test_get(tmpdir, binary):
+    """
+    A file is written locally as it arrives, in binary or hex, reporting
+    progress.
+    """
+    data = bytes(range(256)) + b'end'
+    serial = FakeFileMicrobit({'data.bin': data}, binary)
+    local = tmpdir.join('copy.bin')
+    progress = []
+    assert microfs.get(serial, 'data.bin', str(local),
+                       progress=lambda *args: progress.append(args))
+    assert local.read_binary() == data
+    assert progress == [(0, 259), (256, 259), (259, 259)]
+
+
+def test_get_missing(tmpdir):
+    """
+    A missing file raises an IOError.
+    """
+    with pytest.raises(IOError):
+        microfs.get(FakeFileMicrobit({}), 'nope', str(tmpdir.join('nope')))
+
+
+def test_session():
+    """
+    Inside a session, raw mode is only entered and left once.
+    """
+    serial = FakeMicrobit(lambda command: (b'', b''))
+    with microfs.session(serial):
+        microfs.execute(['a'], serial)
+        with microfs.session(serial):
+            microfs.execute(['b'], serial)
+        assert not serial.written.count(b'\x02')
+    assert serial.written.count(b'\r\x01') == 1
+    assert serial.written.count(b'\x02') == 1
+    microfs.execute(['c'], serial)
+    assert serial.written.count(b'\r\x01') == 2
+
+
+def test_shell_batch(tmpdir, monkeypatch):
+    """
+    Commands read from a file run one after another in one session, with
+    glob patterns matched against local files for put and the device's for
+    rm and get.  A failed command doesn't stop the rest.
+    """
+    monkeypatch.chdir(tmpdir)
+    tmpdir.join('a.py').write_binary(b'a')
+    tmpdir.join('b.py').write_binary(b'b')
+    tmpdir.join('notes.txt').write_binary(b'n')
+    files = {'data.csv': b'1', 'log.csv': b'2', 'keep.txt': b'k'}
+    serial = FakeFileMicrobit(files)
+    stdin = io.StringIO('put *.py\n'
+                        'rm *.csv\n'
+                        '\n'
+                        'get keep.txt\n'
+                        'ls\n'
+                        'bogus\n'
+                        'rm *.csv\n'
+                        'rm "no such.txt"\n')
+    stdout = io.StringIO()
+    assert not microfs.shell(serial, stdin, stdout)
+    assert files == {'a.py': b'a', 'b.py': b'b', 'keep.txt': b'k'}
+    assert tmpdir.join('keep.txt').read_binary() == b'k'
+    assert stdout.getvalue().splitlines() == [
+        'a.py b.py keep.txt',
+        'Unknown command: bogus',
+        'No such file: *.csv',
+        'OSError: [Errno 2] ENOENT']
+    assert serial.written.count(b'\r\x01') == 1
+    assert serial.written.endswith(b'\x02')
+
+
+def test_shell_interrupted(tmpdir, monkeypatch):
+    """
+    Ctrl-C at the interactive shell's prompt stops the command, not the
+    shell, and puts the device back into raw mode.
+    """
+    monkeypatch.setattr(microfs, 'HISTORY_FILE', str(tmpdir.join('history')))
+    serial = FakeFileMicrobit({})
+    stdin = mock.MagicMock()
+    stdin.isatty.return_value = True
+    stdout = io.StringIO()
+    with mock.patch('builtins.input', side_effect=[KeyboardInterrupt, 'ls',
+                                                   'exit']):
+        assert microfs.shell(serial, stdin, stdout)
+    assert serial.written.count(b'\r\x01') == 2
+    assert serial.written.endswith(b'\x02')
+
+
+def test_main_shell():
+    """
+    'ufs shell' runs the shell on the micro:bit, exiting with 1 if a command
+    failed.
+    """
+    with mock.patch('mu.contrib.microfs.get_serial') as mock_serial, \
+            mock.patch('mu.contrib.microfs.shell',
+                       return_value=False) as mock_shell:
+        with pytest.raises(SystemExit) as ex:
+            microfs.main(['shell'])
+    assert ex.value.code == 1
+    mock_shell.assert_called_once_with(
+        mock_serial.return_value.__enter__.return_value)
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for minifying source sent to MicroPython boards.
+"""
+import pytest
+from mu.resources.minify import minify, map_traceback, TracebackMapper
+
+
+SOURCE = '''"""A module docstring."""
+import time  # a comment
+
+
+def nothing():
+    """Only a docstring."""
+
+
+class Counter:
+    """A class docstring."""
+
+    def add(self, values):
+        total = 0
+        for value in values:
+            total += value
+        return (total,
+                len(values))
+
+
+def average(values):
+    try:
+        result = sum(values) / len(values)
+    except ZeroDivisionError as error:
+        result = str(error)
+    return dict(result=result)
+'''
+
+
+def run(source):
+    """
+    Return the names the source defines when run.
+    """
+    names = {}
+    exec(source, names)
+    return names
+
+
+def test_minify():
+    """
+    Comments, docstrings and blank lines go, blocks are indented by one space
+    and statements are joined onto one line.
+    """
+    result = minify(SOURCE)
+    assert result.source == (
+        'import time\n'
+        'def nothing():\n'
+        ' pass\n'
+        'class Counter:\n'
+        ' def add(self,values):\n'
+        '  total=0\n'
+        '  for value in values:\n'
+        '   total+=value\n'
+        '  return(total,len(values))\n'
+        'def average(values):\n'
+        ' try:\n'
+        '  result=sum(values)/len(values)\n'
+        ' except ZeroDivisionError as error:\n'
+        '  result=str(error)\n'
+        ' return dict(result=result)\n')
+    assert result.line_map == [2, 5, 6, 9, 12, 13, 14, 15, 16, 20, 21, 22, 23,
+                               24, 25]
+    assert run(result.source)['Counter']().add([1, 2]) == (3, 2)
+
+
+def test_minify_bytes():
+    """
+    Source may be given as UTF-8 bytes.
+    """
+    assert minify('x = "é"  # é\n'.encode('utf-8')).source == 'x="é"\n'
+
+
+def test_minify_keeps_tokens_apart():
+    """
+    Spaces are kept where leaving them out would change the meaning.
+    """
+    source = 'x = 1 .real if "" "a" else b"b"\n'
+    assert minify(source).source == 'x=1 .real if "" "a"else b"b"\n'
+
+
+def test_minify_multiline_string():
+    """
+    A string spanning several lines keeps them in the line map.
+    """
+    source = 'x = 1\n\ny = """a\nb"""\nz = 2\n'
+    result = minify(source)
+    assert result.source == 'x=1\ny="""a\nb"""\nz=2\n'
+    assert result.line_map == [1, 3, 4, 5]
+
+
+def test_minify_syntax_error():
+    """
+    Invalid source raises a SyntaxError.
+    """
+    with pytest.raises(SyntaxError):
+        minify('def f(:\n')
+
+
+def test_rename_locals():
+    """
+    Local variables get short names, while parameters, attributes and
+    keyword arguments keep theirs.
+    """
+    result = minify(SOURCE, rename_locals=True)
+    assert ' a=0\n' in result.source
+    assert 'for b in values' in result.source
+    assert 'except ZeroDivisionError as a:' in result.source
+    assert 'return dict(result=b)' in result.source
+    names = run(result.source)
+    assert names['average']([1, 2]) == {'result': 1.5}
+    assert names['average']([]) == {'result': 'division by zero'}
+
+
+def test_rename_locals_unsafe():
+    """
+    Functions whose variables may be looked up by name, or which define
+    other functions, are left alone.
+    """
+    source = ('def f():\n'
+              '    value = 1\n'
+              '    return locals()\n'
+              'def g():\n'
+              '    value = 1\n'
+              '    return lambda: value\n'
+              'def h():\n'
+              '    global value\n'
+              '    value = 1\n')
+    assert minify(source, rename_locals=True).source == minify(source).source
+
+
+def test_map_traceback():
+    """
+    Line numbers in tracebacks of minified scripts are mapped back to the
+    original, others are left alone.
+    """
+    maps = {'main.py': [2, 5, 6]}
+    traceback = ('Traceback (most recent call last):\r\n'
+                 '  File "main.py", line 3, in <module>\r\n'
+                 '  File "lib.py", line 3, in f\r\n'
+                 '  File "/main.py", line 9, in <module>\r\n')
+    assert map_traceback(traceback, maps) == (
+        'Traceback (most recent call last):\r\n'
+        '  File "main.py", line 6, in <module>\r\n'
+        '  File "lib.py", line 3, in f\r\n'
+        '  File "/main.py", line 9, in <module>\r\n')
+    assert map_traceback(b'File "/main.py", line 2', maps) == \
+        b'File "/main.py", line 5'
+
+
+def test_traceback_mapper():
+    """
+    Output arriving in pieces is passed on at once, except for the start of
+    a line which may be part of a traceback.
+    """
+    mapper = TracebackMapper({'main.py': [10, 20]})
+    assert mapper.feed(b'>>> x\r\n  Fi') == b'>>> x\r\n'
+    assert mapper.feed(b'le "main.py", li') == b''
+    assert mapper.feed(b'ne 2, in <module>\r\n>>> ') == \
+        b'  File "main.py", line 20, in <module>\r\n>>> '
+
+
+def test_traceback_mapper_no_maps():
+    """
+    Without any line maps, output is passed straight on.
+    """
+    mapper = TracebackMapper({})
+    assert mapper.feed(b'  Fi') == b'  Fi'
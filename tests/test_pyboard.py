@@ -0,0 +1,462 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the pyboard module used to talk to MicroPython boards.
+"""
+from unittest import mock
+import itertools
+import os
+import pytest
+import mu.resources.pyboard as pyboard
+
+
+class FakeSerial:
+    """
+    A stand-in for a serial connection. Each entry in chunks becomes readable
+    only after the previous one has been read, as if the device was sending
+    them one after another.
+    """
+
+    def __init__(self, *chunks):
+        self.chunks = list(chunks)
+        self.pending = bytearray()
+        self.written = bytearray()
+        self.reads = []
+
+    def inWaiting(self):
+        if not self.pending and self.chunks:
+            self.pending.extend(self.chunks.pop(0))
+        return len(self.pending)
+
+    def read(self, size=1):
+        self.inWaiting()
+        data = bytes(self.pending[:size])
+        del self.pending[:size]
+        self.reads.append(size)
+        return data
+
+    def write(self, data):
+        self.written.extend(data)
+        return len(data)
+
+    def fileno(self):
+        raise AttributeError('no file descriptor')
+
+
+def make_pyboard(serial):
+    """
+    Return a Pyboard instance connected to the given fake serial object.
+    """
+    with mock.patch('serial.Serial', return_value=serial):
+        return pyboard.Pyboard('/dev/ttyACM0')
+
+
+def test_read_until_bulk():
+    """
+    Everything the transport has pending is read in a single call rather than
+    one byte at a time.
+    """
+    serial = FakeSerial(b'x' * 20000 + b'>')
+    pyb = make_pyboard(serial)
+    data = pyb.read_until(1, b'>')
+    assert data == b'x' * 20000 + b'>'
+    assert serial.reads == [20001]
+
+
+def test_read_until_keeps_data_after_ending():
+    """
+    Bytes which arrive after the terminator are kept for the next read.
+    """
+    serial = FakeSerial(b'out\x04err\x04>')
+    pyb = make_pyboard(serial)
+    assert pyb.follow(10) == (b'out', b'err')
+    assert pyb.read_until(1, b'>') == b'>'
+
+
+def test_read_until_ending_split_across_reads():
+    """
+    A terminator which arrives in pieces is still found.
+    """
+    serial = FakeSerial(b'raw REPL; CTRL', b'-B to exit\r\n>', b'tail')
+    pyb = make_pyboard(serial)
+    data = pyb.read_until(1, b'raw REPL; CTRL-B to exit\r\n>')
+    assert data == b'raw REPL; CTRL-B to exit\r\n>'
+
+
+def test_read_until_data_consumer():
+    """
+    The data consumer sees the output as it arrives, up to and including the
+    terminator but nothing beyond it.
+    """
+    serial = FakeSerial(b'abc', b'def\x04ghi')
+    pyb = make_pyboard(serial)
+    consumer = mock.MagicMock()
+    pyb.read_until(1, b'\x04', data_consumer=consumer)
+    received = b''.join(c[0][0] for c in consumer.call_args_list)
+    assert received == b'abcdef\x04'
+
+
+def test_read_until_timeout():
+    """
+    If no new data arrives before the deadline, whatever was received so far
+    is returned.
+    """
+    serial = FakeSerial(b'partial')
+    pyb = make_pyboard(serial)
+    # Each reading of the clock is five seconds later than the last.
+    ticks = itertools.count(step=5)
+    with mock.patch('mu.resources.pyboard.time.monotonic',
+                    side_effect=lambda: next(ticks)), \
+            mock.patch('mu.resources.pyboard.time.sleep'):
+        data = pyb.read_until(1, b'>', timeout=10)
+    assert data == b'partial'
+
+
+def test_read_until_waits_on_file_descriptor():
+    """
+    Transports with a file descriptor are waited on with select instead of
+    sleeping.
+    """
+    serial = FakeSerial(b'a', b'>')
+    serial.fileno = mock.MagicMock(return_value=3)
+    pyb = make_pyboard(serial)
+    serial.inWaiting = mock.MagicMock(side_effect=[1, 0, 1, 0])
+    serial.read = mock.MagicMock(side_effect=[b'a', b'>'])
+    with mock.patch('mu.resources.pyboard.select.select') as mock_select:
+        assert pyb.read_until(1, b'>') == b'a>'
+    assert mock_select.call_count == 1
+    assert mock_select.call_args[0][0] == [3]
+
+
+def test_exec_raw_no_follow_bad_response():
+    """
+    A PyboardError is raised if the device does not acknowledge the command.
+    """
+    serial = FakeSerial(b'>', b'NO')
+    pyb = make_pyboard(serial)
+    pyb.use_raw_paste = False
+    with pytest.raises(pyboard.PyboardError):
+        pyb.exec_raw_no_follow('print(1)')
+
+
+def test_enter_raw_repl_soft_reset():
+    """
+    By default entering the raw REPL soft resets the board.
+    """
+    # The leading empty chunk is what the input flush sees.
+    serial = FakeSerial(b'', b'raw REPL; CTRL-B to exit\r\n>',
+                        b'soft reboot\r\n', b'raw REPL; CTRL-B to exit\r\n>')
+    pyb = make_pyboard(serial)
+    pyb.enter_raw_repl()
+    assert b'\x04' in serial.written
+    assert pyb.in_raw_repl
+    pyb.exit_raw_repl()
+    assert not pyb.in_raw_repl
+
+
+def test_enter_raw_repl_no_soft_reset():
+    """
+    Without a soft reset the running program is only interrupted and the
+    prompt is left for the first command.
+    """
+    serial = FakeSerial(b'', b'raw REPL; CTRL-B to exit\r\n>')
+    pyb = make_pyboard(serial)
+    pyb.enter_raw_repl(soft_reset=False)
+    assert serial.written == b'\r\x03\x03\r\x01'
+    assert pyb.in_raw_repl
+    assert pyb.read_until(1, b'>') == b'>'
+
+
+def test_raw_repl_session():
+    """
+    The raw_repl context manager enters raw mode once, however many times it
+    is nested, and leaves it at the end.
+    """
+    pyb = make_pyboard(FakeSerial())
+    pyb.enter_raw_repl = mock.MagicMock(
+        side_effect=lambda soft_reset: setattr(pyb, 'in_raw_repl', True))
+    pyb.exit_raw_repl = mock.MagicMock()
+    with pyb.raw_repl(soft_reset=False):
+        with pyb.raw_repl():
+            pass
+        assert pyb.exit_raw_repl.call_count == 0
+    pyb.enter_raw_repl.assert_called_once_with(False)
+    pyb.exit_raw_repl.assert_called_once_with()
+
+
+def test_raw_repl_session_exits_on_error():
+    """
+    Raw mode is left even if a command in the session fails.
+    """
+    pyb = make_pyboard(FakeSerial())
+    pyb.enter_raw_repl = mock.MagicMock()
+    pyb.exit_raw_repl = mock.MagicMock()
+    with pytest.raises(pyboard.PyboardError):
+        with pyb.raw_repl():
+            raise pyboard.PyboardError('boom')
+    pyb.exit_raw_repl.assert_called_once_with()
+
+
+def test_exec_raw_no_follow_raw_paste():
+    """
+    When the device supports raw-paste mode the command is sent within the
+    flow-control window the device advertises, without the OK handshake.
+    """
+    serial = FakeSerial(b'>', b'R\x01\x08\x00', b'', b'\x04')
+    pyb = make_pyboard(serial)
+    pyb.exec_raw_no_follow('x=1')
+    assert serial.written == b'\x05A\x01x=1\x04'
+    assert pyb.use_raw_paste
+
+
+def test_raw_paste_write_waits_for_window():
+    """
+    Once the window is used up nothing more is sent until the device grants
+    another one.
+    """
+    serial = FakeSerial(b'\x02\x00', b'', b'\x01', b'', b'\x04')
+    pyb = make_pyboard(serial)
+    pyb.serial.write = mock.MagicMock()
+    pyb.raw_paste_write(b'abcd')
+    assert pyb.serial.write.call_args_list == [
+        mock.call(b'ab'), mock.call(b'cd'), mock.call(b'\x04')]
+
+
+def test_exec_raw_no_follow_raw_paste_unsupported():
+    """
+    Firmware without raw-paste mode falls back to the chunked raw REPL and
+    raw-paste is not tried again.
+    """
+    serial = FakeSerial(b'>', b'raw REPL; CTRL-B to exit\r\n>', b'OK')
+    pyb = make_pyboard(serial)
+    with mock.patch('mu.resources.pyboard.time.sleep'):
+        pyb.exec_raw_no_follow('x=1')
+    assert serial.written == b'\x05A\x01x=1\x04'
+    assert not pyb.use_raw_paste
+
+
+def make_telnet(*responses):
+    """
+    Return a logged-in TelnetToSerial whose telnet connection gives the
+    responses in turn (and then nothing) to non-blocking reads.
+    """
+    telnet = pyboard.TelnetToSerial.__new__(pyboard.TelnetToSerial)
+    telnet.tn = mock.MagicMock()
+    telnet.tn.read_very_eager.side_effect = itertools.chain(
+        responses, itertools.repeat(b''))
+    telnet.read_timeout = 10
+    telnet.fifo = bytearray()
+    return telnet
+
+
+def test_telnet_read_bulk():
+    """
+    Data is buffered in bulk and handed out without waiting when enough is
+    already there.
+    """
+    telnet = make_telnet(b'hello world')
+    assert telnet.inWaiting() == 11
+    with mock.patch('mu.resources.pyboard.select.select') as mock_select:
+        assert telnet.read(5) == b'hello'
+        assert telnet.read(6) == b' world'
+    assert mock_select.call_count == 0
+
+
+def test_telnet_read_waits_on_socket():
+    """
+    When no data is ready the socket is waited on with select rather than
+    sleeping.
+    """
+    telnet = make_telnet(b'', b'ab')
+    with mock.patch('mu.resources.pyboard.select.select') as mock_select:
+        assert telnet.read(2) == b'ab'
+    mock_select.assert_called_once_with([telnet.tn.get_socket()], [], [],
+                                        mock.ANY)
+
+
+def test_telnet_read_timeout():
+    """
+    The read gives up once read_timeout seconds pass without new data.
+    """
+    telnet = make_telnet(b'a')
+    ticks = itertools.count(step=5)
+    with mock.patch('mu.resources.pyboard.time.monotonic',
+                    side_effect=lambda: next(ticks)), \
+            mock.patch('mu.resources.pyboard.select.select'):
+        assert telnet.read(10) == b'a'
+
+
+def test_telnet_read_connection_closed():
+    """
+    A closed connection ends the read with whatever was received.
+    """
+    telnet = make_telnet()
+    telnet.tn.read_very_eager.side_effect = [b'abc', EOFError()]
+    assert telnet.read(10) == b'abc'
+
+
+@pytest.mark.skipif(os.name != 'posix', reason='needs a POSIX shell')
+def test_process_to_serial_bulk():
+    """
+    The process's output is buffered in bulk and inWaiting reports how much
+    is really pending.
+    """
+    proc = pyboard.ProcessToSerial('cat')
+    try:
+        proc.write(b'hello world')
+        while proc.inWaiting() < 11:
+            proc._fill(1)
+        assert proc.inWaiting() == 11
+        assert proc.read(11) == b'hello world'
+    finally:
+        proc.close()
+
+
+@pytest.mark.skipif(os.name != 'posix', reason='needs a POSIX shell')
+def test_process_to_serial_exit():
+    """
+    The whole command line is run, and reading past the end of the output of
+    a finished process returns what there was instead of blocking.
+    """
+    proc = pyboard.ProcessToSerial('echo hello world')
+    try:
+        assert proc.read(100) == b'hello world\n'
+    finally:
+        proc.sel.close()
+
+
+def test_iter_exec():
+    """
+    Output is yielded as it arrives, in bounded chunks, with stdout and
+    stderr kept apart and UTF-8 characters split across chunks decoded
+    correctly.
+    """
+    serial = FakeSerial(b'>', b'OK', b'hello \xc3', b'\xa9t\xc3\xa9\x04',
+                        b'oops\x04>')
+    pyb = make_pyboard(serial)
+    pyb.use_raw_paste = False
+    with mock.patch('mu.resources.pyboard.time.sleep'):
+        result = list(pyb.iter_exec('print(1)', chunk_size=4))
+    assert ''.join(t for s, t in result if s == 'stdout') == 'hello été'
+    assert ''.join(t for s, t in result if s == 'stderr') == 'oops'
+    assert max(serial.reads) <= 4
+    assert pyb.read_until(1, b'>') == b'>'
+
+
+def test_iter_exec_cancel():
+    """
+    Closing the generator early interrupts the command with Ctrl-C and
+    discards the rest of its output.
+    """
+    serial = FakeSerial(b'>', b'OK', b'data', b'', b'more\x04Interrupt\x04>')
+    pyb = make_pyboard(serial)
+    pyb.use_raw_paste = False
+    with mock.patch('mu.resources.pyboard.time.sleep'):
+        output = pyb.iter_exec('while True: print(1)')
+        assert next(output) == ('stdout', 'data')
+        output.close()
+    assert serial.written.endswith(b'\x03')
+    assert pyb.read_until(1, b'>') == b'>'
+
+
+def test_iter_exec_timeout():
+    """
+    A device which goes quiet for longer than the timeout causes an error.
+    """
+    serial = FakeSerial(b'>', b'OK')
+    pyb = make_pyboard(serial)
+    pyb.use_raw_paste = False
+    ticks = itertools.count(step=5)
+    with mock.patch('mu.resources.pyboard.time.monotonic',
+                    side_effect=lambda: next(ticks)), \
+            mock.patch('mu.resources.pyboard.time.sleep'):
+        with pytest.raises(pyboard.PyboardError):
+            list(pyb.iter_exec('import time; time.sleep(60)', timeout=10))
+
+
+def test_exec_batch():
+    """
+    Several commands are sent as one program and the output of each is split
+    back out.
+    """
+    pyb = make_pyboard(FakeSerial())
+    with mock.patch('mu.resources.pyboard.os.urandom',
+                    return_value=b'\x00' * 6):
+        marker = b'\x1e000000000000'
+        with mock.patch.object(pyb, 'exec_raw',
+                               return_value=(b'1\r\n' + marker * 4,
+                                             b'')) as ex:
+            assert pyb.exec_batch(['print(1)', 'x = 2']) == [b'1\r\n', b'']
+    program = ex.call_args[0][0]
+    assert program.count('exec(') == 1
+    assert "'print(1)', 'x = 2'" in program
+    assert ex.call_count == 1
+
+
+def test_exec_batch_error():
+    """
+    The command which failed is reported, and the batch stops there.
+    """
+    pyb = make_pyboard(FakeSerial())
+    marker = b'\x1e000000000000'
+    output = b''.join([b'ok', marker, marker, b'partial', marker,
+                       b'Traceback', marker])
+    with mock.patch('mu.resources.pyboard.os.urandom',
+                    return_value=b'\x00' * 6), \
+            mock.patch.object(pyb, 'exec_raw', return_value=(output, b'')):
+        assert pyb.exec_raw_batch(['a', 'b', 'c']) == [
+            (b'ok', b''), (b'partial', b'Traceback')]
+        with pytest.raises(pyboard.PyboardError) as ex:
+            pyb.exec_batch(['a', 'b', 'c'])
+    assert ex.value.args == ('exception', b'partial', b'Traceback', 1)
+
+
+def test_exec_batch_interrupted():
+    """
+    If the batch as a whole is stopped, the command running at the time is
+    blamed.
+    """
+    pyb = make_pyboard(FakeSerial())
+    marker = b'\x1e000000000000'
+    with mock.patch('mu.resources.pyboard.os.urandom',
+                    return_value=b'\x00' * 6), \
+            mock.patch.object(pyb, 'exec_raw',
+                              return_value=(b'ok' + marker + marker + b'xy',
+                                            b'KeyboardInterrupt')):
+        assert pyb.exec_raw_batch(['a', 'b']) == [
+            (b'ok', b''), (b'xy', b'KeyboardInterrupt')]
+
+
+def test_read_exact():
+    """
+    Exactly the number of bytes asked for is returned, however they arrive.
+    """
+    pyb = make_pyboard(FakeSerial(b'ab', b'cdef'))
+    with mock.patch('mu.resources.pyboard.time.sleep'):
+        assert pyb.read_exact(3) == b'abc'
+        assert pyb.read_exact(3) == b'def'
+
+
+def test_read_exact_timeout():
+    """
+    If the bytes don't arrive in time an error is raised.
+    """
+    pyb = make_pyboard(FakeSerial(b'ab'))
+    ticks = itertools.count(step=5)
+    with mock.patch('mu.resources.pyboard.time.monotonic',
+                    side_effect=lambda: next(ticks)), \
+            mock.patch('mu.resources.pyboard.time.sleep'):
+        with pytest.raises(pyboard.PyboardError):
+            pyb.read_exact(3)
+
+
+def test_read_buffered():
+    """
+    Data received past the end of a read is handed over once, and nothing
+    more is read from the transport.
+    """
+    serial = FakeSerial(b'ok>out', b'more')
+    pyb = make_pyboard(serial)
+    assert pyb.read_until(1, b'>') == b'ok>'
+    assert pyb.read_buffered() == b'out'
+    assert pyb.read_buffered() == b''
+    assert serial.chunks == [b'more']
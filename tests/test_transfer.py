@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the background transfer manager.
+"""
+from unittest import mock
+import threading
+from PyQt5.QtCore import Qt, QThread
+import mu.transfer
+from mu.resources.pyboard import PyboardError
+
+
+def run_jobs(manager, count):
+    """
+    Run the manager's queued jobs in its thread and return the (job id,
+    error) each finished with, once count of them have.
+    """
+    finished = []
+    done = threading.Event()
+
+    def on_finished(job_id, error):
+        finished.append((job_id, error))
+        if len(finished) == count:
+            done.set()
+
+    manager.job_finished.connect(on_finished, Qt.DirectConnection)
+    QThread.start(manager)
+    assert done.wait(5)
+    manager.stop()
+    return finished
+
+
+def make_manager():
+    """
+    Return a TransferManager which doesn't start its thread as jobs are
+    queued, so tests can queue several first.
+    """
+    manager = mu.transfer.TransferManager('/dev/ttyACM0')
+    manager.start = mock.MagicMock()
+    return manager
+
+
+def test_jobs_share_a_session(tmpdir):
+    """
+    Queued jobs run by priority, then in order, back-to-back in one session.
+    """
+    local = tmpdir.join('main.py')
+    local.write_binary(b'print(1)')
+    manager = make_manager()
+    put_id = manager.put(str(local), 'main.py')
+    rm_id = manager.rm('old.py', priority=1)
+    get_id = manager.get('data.csv', str(tmpdir.join('data.csv')))
+    with mock.patch('mu.transfer.get_broker') as mock_get_broker, \
+            mock.patch('mu.transfer.files.Files') as mock_files:
+        finished = run_jobs(manager, 3)
+    assert finished == [(rm_id, None), (put_id, None), (get_id, None)]
+    mock_get_broker.assert_called_once_with('/dev/ttyACM0')
+    lease = mock_get_broker.return_value.lease
+    assert lease.call_count == 1
+    mock_files.assert_called_once_with(lease.return_value.__enter__())
+    board_files = mock_files.return_value
+    assert board_files.session.call_count == 1
+    assert [c[0] for c in board_files.method_calls
+            if c[0] in ('put', 'get_to', 'rm')] == ['rm', 'put', 'get_to']
+    assert board_files.put.call_args[0][:2] == ('main.py', b'print(1)')
+    board_files.get_to.assert_called_once_with(
+        'data.csv', str(tmpdir.join('data.csv')), progress=mock.ANY)
+    assert lease.return_value.__exit__.call_count == 1
+
+
+def test_progress():
+    """
+    Progress reported by a transfer is emitted with the job's id.
+    """
+    manager = make_manager()
+    job_id = manager.get('data.csv', 'data.csv')
+    progress = []
+    manager.job_progress.connect(lambda *args: progress.append(args),
+                                 Qt.DirectConnection)
+    with mock.patch('mu.transfer.get_broker'), \
+            mock.patch('mu.transfer.files.Files') as mock_files:
+        def get_to(remote, local, progress):
+            progress(0, 10)
+            progress(10, 10)
+        mock_files.return_value.get_to.side_effect = get_to
+        run_jobs(manager, 1)
+    assert progress == [(job_id, 0, 10), (job_id, 10, 10)]
+
+
+def test_disk_usage():
+    """
+    The board's disk usage is emitted at the end of each session, which a
+    df job asks for on its own.
+    """
+    manager = make_manager()
+    job_id = manager.df()
+    usage = []
+    manager.disk_usage.connect(usage.append, Qt.DirectConnection)
+    with mock.patch('mu.transfer.get_broker'), \
+            mock.patch('mu.transfer.files.Files') as mock_files:
+        finished = run_jobs(manager, 1)
+    assert finished == [(job_id, None)]
+    assert usage == [mock_files.return_value.df.return_value]
+
+
+def test_listing():
+    """
+    The files on the board are emitted at the end of each session, which an
+    ls job asks for on its own.
+    """
+    manager = make_manager()
+    job_id = manager.ls()
+    listings = []
+    manager.listing.connect(listings.append, Qt.DirectConnection)
+    with mock.patch('mu.transfer.get_broker'), \
+            mock.patch('mu.transfer.files.Files') as mock_files:
+        mock_files.return_value.ls.return_value = ['main.py']
+        finished = run_jobs(manager, 1)
+    assert finished == [(job_id, None)]
+    assert listings == [['main.py']]
+
+
+def test_cancel_queued():
+    """
+    A cancelled job which hasn't started is dropped.
+    """
+    manager = make_manager()
+    first = manager.rm('a.py')
+    second = manager.rm('b.py')
+    manager.cancel(first)
+    with mock.patch('mu.transfer.get_broker'), \
+            mock.patch('mu.transfer.files.Files') as mock_files:
+        finished = run_jobs(manager, 2)
+    assert finished[1] == (second, None)
+    assert finished[0][0] == first
+    assert isinstance(finished[0][1], mu.transfer.TransferCancelled)
+    mock_files.return_value.rm.assert_called_once_with('b.py')
+
+
+def test_cancel_in_flight():
+    """
+    Cancelling a transfer in progress makes its next progress report raise,
+    and the next job still runs in the same session.
+    """
+    manager = make_manager()
+    first = manager.get('a.bin', 'a.bin')
+    second = manager.rm('b.py')
+
+    def get_to(remote, local, progress):
+        progress(0, 10)
+        manager.cancel(first)
+        progress(5, 10)
+
+    with mock.patch('mu.transfer.get_broker'), \
+            mock.patch('mu.transfer.files.Files') as mock_files:
+        mock_files.return_value.get_to.side_effect = get_to
+        finished = run_jobs(manager, 2)
+    assert isinstance(finished[0][1], mu.transfer.TransferCancelled)
+    assert finished[1] == (second, None)
+    assert mock_files.return_value.session.call_count == 1
+
+
+def test_error_reconnects():
+    """
+    A job which fails reports its error, and the rest of the queue runs in a
+    new session, after the port has been released.
+    """
+    manager = make_manager()
+    first = manager.rm('a.py')
+    second = manager.rm('b.py')
+    ex = PyboardError('exception', b'', b'OSError: 5\r\n')
+    with mock.patch('mu.transfer.get_broker') as mock_get_broker, \
+            mock.patch('mu.transfer.files.Files') as mock_files:
+        mock_files.return_value.rm.side_effect = [ex, None]
+        finished = run_jobs(manager, 2)
+    assert finished == [(first, ex), (second, None)]
+    lease = mock_get_broker.return_value.lease
+    assert lease.return_value.__exit__.call_count == 2
+    assert mock_files.return_value.session.call_count == 2
+
+
+def test_stop_cancels_queue():
+    """
+    Jobs still queued when the manager stops are cancelled.
+    """
+    manager = make_manager()
+    job_id = manager.rm('a.py')
+    finished = []
+    manager.job_finished.connect(lambda *args: finished.append(args),
+                                 Qt.DirectConnection)
+    manager._stopping = True
+    with mock.patch('mu.transfer.get_broker') as mock_get_broker:
+        manager.run()
+    assert mock_get_broker.call_count == 0
+    assert finished[0][0] == job_id
+    assert isinstance(finished[0][1], mu.transfer.TransferCancelled)